@@ -8,6 +8,6 @@ apt-get update
 apt-get install -y git build-essential python3-dev libnetfilter-queue-dev
 
 pip3 install --upgrade pip setuptools
-pip3 install pip-review ipython dnspython aiohttp scapy-python3 pyyaml NetfilterQueue ryu python-iptables pyroute2
+pip3 install pip-review ipython dnspython aiohttp scapy-python3 pyyaml NetfilterQueue ryu python-iptables pyroute2 numpy
 ### Update all pip packages
 pip-review --auto -v
@@ -16,6 +16,8 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 # ./synproxy_dataplane.py --nic-wan test_wan0 --nic-wanp test_wan0p --ipaddr 127.0.0.1 --port 12345 --default-tcpmss 1460 --default-tcpsack 1 --default-tcpwscale 7 --standalone
 # Run standalone modifying networking from the process
 # ./synproxy_dataplane.py --nic-wan test_wan0 --nic-wanp test_wan0p --ipaddr 127.0.0.1 --port 12345 --default-tcpmss 1460 --default-tcpsack 1 --default-tcpwscale 7 --standalone --secure-net 195.148.124.0/24 195.148.125.201/32 --default-gw
+# Run with connections stored in ipsets grouped by TCP options profile
+# ./synproxy_dataplane.py --nic-wan test_wan0 --nic-wanp test_wan0p --ipaddr 127.0.0.1 --port 12345 --ipset
 
 
 import asyncio
@@ -29,7 +31,15 @@ import subprocess
 import sys
 from contextlib import suppress
 
-from helpers_n_wrappers import iptc_helper3, container3
+from helpers_n_wrappers import iptc_helper3, iproute2_helper3, container3
+from pyroute2.ipset import PortEntry
+
+
+# SYNPROXY control protocol v2 / header (magic, version, count, seq) followed by count v1 messages
+SYNPROXY_V2_MAGIC   = 0xFF
+SYNPROXY_V2_VERSION = 0x02
+SYNPROXY_V2_HEADER  = struct.Struct('!BBHI')
+SYNPROXY_V1_MSGLEN  = 12
 
 
 def synproxy_build_message(mode, ipaddr, port, proto, tcpmss, tcpsack, tcpwscale):
@@ -318,6 +328,25 @@ class SYNProxyDataplane():
 
 
     def process_message(self, data, addr):
+        # Return result
+        if self._process_message(data, addr):
+            return b'1\n'
+        else:
+            return b'0\n'
+
+    def process_batch(self, messages, addr):
+        """ Process a list of messages of a v2 frame and return a list of results """
+        results = []
+        for data in messages:
+            try:
+                ret = self._process_message(data, addr)
+            except Exception as e:
+                self._logger.warning('Failed to process message {} / {}'.format(data, e))
+                ret = False
+            results.append(1 if ret else 0)
+        return results
+
+    def _process_message(self, data, addr):
         # Parse received message
         mode, ipaddr, port, proto, tcpmss, tcpsack, tcpwscale = synproxy_parse_message(data)
         self._logger.debug('Data received from {}: {}'.format(addr, (mode, ipaddr, port, proto, tcpmss, tcpsack, tcpwscale)))
@@ -330,11 +359,7 @@ class SYNProxyDataplane():
             ret = self._do_mod(ipaddr, port, proto, tcpmss, tcpsack, tcpwscale)
         elif mode == 'del':
             ret = self._do_del(ipaddr, port, proto)
-        # Return result
-        if ret:
-            return b'1\n'
-        else:
-            return b'0\n'
+        return ret
 
     @asyncio.coroutine
     def monitor(self, interval):
@@ -389,6 +414,19 @@ class SYNProxyDataplane():
         return rule_d
 
 
+    def _ipt_position(self, ipaddr, port):
+        # Define inserting position in filter.synproxy_chain based on n-tuple match
+        if ipaddr != '0.0.0.0' and port != 0:
+            # 3-tuple connection, higher priority
+            return 1
+        elif ipaddr != '0.0.0.0' and port == 0:
+            # 3-tuple connection with wildcard port, higher priority than default
+            return -3
+        elif ipaddr == '0.0.0.0':
+            # Default connection, lowest priority
+            return -2
+        raise Exception('Unsupported! {}'.format((ipaddr, port)))
+
     def _do_flush(self, ipaddr):
         # Flush connections based on IP address
         if ipaddr == '0.0.0.0':
@@ -425,18 +463,7 @@ class SYNProxyDataplane():
 
     def _do_add(self, ipaddr, port, proto, tcpmss, tcpsack, tcpwscale):
         # Add a connection based on given parameters
-        # Define inserting position based on n-tuple match
-        if ipaddr != '0.0.0.0' and port != 0:
-            # 3-tuple connection, higher priority
-            pos = 1
-        elif ipaddr != '0.0.0.0' and port == 0:
-            # 3-tuple connection with wildcard port, higher priority than default
-            pos = -3
-        elif ipaddr == '0.0.0.0':
-            # Default connection, lowest priority
-            pos = -2
-        else:
-            raise Exception('Unsupported! {}'.format(ipaddr, proto, port, tcpmss, tcpsack, tcpwscale))
+        pos = self._ipt_position(ipaddr, port)
 
         if self.connectiontable.has((ipaddr, port, proto)):
             connection = self.connectiontable.get((ipaddr, port, proto))
@@ -454,18 +481,7 @@ class SYNProxyDataplane():
 
     def _do_mod(self, ipaddr, port, proto, tcpmss, tcpsack, tcpwscale):
         # Modify a connection based on given parameters
-        # Define inserting position based on n-tuple match
-        if ipaddr != '0.0.0.0' and port != 0:
-            # 3-tuple connection, higher priority
-            pos = 1
-        elif ipaddr != '0.0.0.0' and port == 0:
-            # 3-tuple connection with wildcard port, higher priority than default
-            pos = -3
-        elif ipaddr == '0.0.0.0':
-            # Default connection, lowest priority
-            pos = -2
-        else:
-            raise Exception('Unsupported! {}'.format(ipaddr, proto, port, tcpmss, tcpsack, tcpwscale))
+        pos = self._ipt_position(ipaddr, port)
 
         if self.connectiontable.has((ipaddr, port, proto)):
             connection = self.connectiontable.get((ipaddr, port, proto))
@@ -505,12 +521,196 @@ class SYNProxyDataplane():
         return True
 
 
+class SYNProxyDataplaneIPSet(SYNProxyDataplane):
+    """
+    SYNPROXY dataplane backed by ipsets.
+
+    Connections are grouped by (mss, sack, wscale) profile in hash:ip,port sets for
+    3-tuple connections and hash:ip sets for wildcard port connections, with a single
+    SYNPROXY rule per profile. The default connection remains an iptables rule.
+
+    Resulting order of filter.synproxy_chain:
+        1. jump synproxy_ipport   (3-tuple connections)
+        2. jump synproxy_ip       (wildcard port connections)
+        3. SYNPROXY dst 0.0.0.0/0 (default connection)
+        4. ctstate INVALID DROP
+    """
+    CHAIN_IPPORT = 'synproxy_ipport'
+    CHAIN_IP     = 'synproxy_ip'
+    IPSET_PREFIX = 'spx_'
+
+    def __init__(self, **kwargs):
+        # Profile (stype, tcpmss, tcpsack, tcpwscale) -> ipset name
+        self._profiles = {}
+        self.ipset_maxelem = kwargs.get('ipset_maxelem', 262144)
+        super().__init__(**kwargs)
+
+    def ipt_init_flows(self):
+        super().ipt_init_flows()
+        self._logger.info('Initialize iptables chains and ipsets for SYNPROXY profiles')
+        # Add custom chains and flush previous profile rules
+        for chain in (self.CHAIN_IPPORT, self.CHAIN_IP):
+            iptc_helper3.add_chain('filter', chain, ipv6=False, silent=True)
+            iptc_helper3.flush_chain('filter', chain, ipv6=False, silent=False)
+        # Destroy ipsets of previous profiles, these are no longer referenced
+        for entry in iproute2_helper3.ipset_list():
+            name = entry.get_attr('IPSET_ATTR_SETNAME')
+            if name.startswith(self.IPSET_PREFIX):
+                iproute2_helper3.ipset_destroy(name)
+        ## filter.synproxy_chain / 3-tuple connections have higher priority than wildcard port connections
+        rule_d = {'protocol': 'tcp', 'target': self.CHAIN_IP}
+        iptc_helper3.add_rule('filter', 'synproxy_chain', rule_d, position=1, ipv6=False)
+        rule_d = {'protocol': 'tcp', 'target': self.CHAIN_IPPORT}
+        iptc_helper3.add_rule('filter', 'synproxy_chain', rule_d, position=1, ipv6=False)
+
+    def _ipt_position(self, ipaddr, port):
+        # Only the default connection is an iptables rule, right before the INVALID DROP rule
+        if ipaddr == '0.0.0.0':
+            return -1
+        return super()._ipt_position(ipaddr, port)
+
+    def _get_profile_ipset(self, port, tcpmss, tcpsack, tcpwscale):
+        # Return the ipset of the profile, create set and rule if it does not exist
+        stype = 'hash:ip,port' if port != 0 else 'hash:ip'
+        key = (stype, tcpmss, tcpsack, tcpwscale)
+        if key in self._profiles:
+            return self._profiles[key]
+
+        name = '{}{}_{}_{}_{}'.format(self.IPSET_PREFIX, 'ipp' if port != 0 else 'ip', tcpmss, tcpsack, tcpwscale)
+        self._logger.info('Create profile ipset {} / mss={} sack={} wscale={}'.format(name, tcpmss, tcpsack, tcpwscale))
+        iproute2_helper3.ipset_create(name, stype=stype, maxelem=self.ipset_maxelem)
+        # Build profile rule from the connection rule
+        rule_d = self._build_ipt_synproxy_rule('0.0.0.0', 0, 6, tcpmss, tcpsack, tcpwscale)
+        del rule_d['dst']
+        if port != 0:
+            rule_d['set'] = {'match-set': [name, 'dst,dst']}
+            chain = self.CHAIN_IPPORT
+        else:
+            rule_d['set'] = {'match-set': [name, 'dst']}
+            chain = self.CHAIN_IP
+        iptc_helper3.add_rule('filter', chain, rule_d, position=0, ipv6=False)
+        self._profiles[key] = name
+        return name
+
+    def _ipset_entry(self, ipaddr, port, proto):
+        # Return tuple (entry, etype) of the connection
+        if port == 0:
+            return (ipaddr, 'ip')
+        return ((ipaddr, PortEntry(port, protocol=proto or socket.IPPROTO_TCP)), 'ip,port')
+
+    def _ipset_add(self, connection):
+        name = self._get_profile_ipset(connection.port, connection.tcpmss, connection.tcpsack, connection.tcpwscale)
+        entry, etype = self._ipset_entry(connection.ipaddr, connection.port, connection.proto)
+        iproute2_helper3.ipset_add(name, entry, etype=etype)
+        connection.ipset = name
+
+    def _ipset_delete(self, connection):
+        entry, etype = self._ipset_entry(connection.ipaddr, connection.port, connection.proto)
+        try:
+            iproute2_helper3.ipset_delete(connection.ipset, entry, etype=etype)
+        except Exception as e:
+            self._logger.warning('Failed to delete {} from ipset {} / {}'.format(connection, connection.ipset, e))
+
+    def _do_flush(self, ipaddr):
+        # Flush connections based on IP address
+        if ipaddr == '0.0.0.0':
+            connections = self.connectiontable.getall()
+        elif self.connectiontable.has(ipaddr):
+            connections = self.connectiontable.get(ipaddr)
+        else:
+            # Nothing to do here
+            self._logger.debug('[flush] No connection(s) found for ipaddr={}'.format(ipaddr))
+            return False
+
+        # We need a new iterable not to modify on the fly the set/list of connections
+        _connections = list(connections)
+        batch_rules = []
+        for connection in _connections:
+            self._logger.info('Flush connection: {}'.format(connection))
+            self.connectiontable.remove(connection, callback=False)
+            if connection.ipt_rule is not None:
+                batch_rules.append(('synproxy_chain', connection.ipt_rule))
+            elif ipaddr != '0.0.0.0':
+                self._ipset_delete(connection)
+
+        if ipaddr == '0.0.0.0':
+            # Flush all profile ipsets at once
+            for name in self._profiles.values():
+                iproute2_helper3.ipset_flush(name)
+        if batch_rules:
+            iptc_helper3.batch_begin(table='filter', ipv6=False)
+            iptc_helper3.batch_delete_rules('filter', batch_rules, ipv6=False, silent=True)
+            iptc_helper3.batch_end(table='filter', ipv6=False)
+        return True
+
+    def _do_add(self, ipaddr, port, proto, tcpmss, tcpsack, tcpwscale):
+        # Default connection remains an iptables rule
+        if ipaddr == '0.0.0.0':
+            return super()._do_add(ipaddr, port, proto, tcpmss, tcpsack, tcpwscale)
+
+        if self.connectiontable.has((ipaddr, port, proto)):
+            connection = self.connectiontable.get((ipaddr, port, proto))
+            self._logger.debug('[add] Conflict exists for {} / {}'.format((ipaddr, port, proto, tcpmss, tcpsack, tcpwscale), connection))
+            return False
+
+        connection = SYNProxyConnectionTCP(ipaddr, port, proto, tcpmss, tcpsack, tcpwscale, None)
+        self._logger.info('Add connection: {}'.format(connection))
+        self._ipset_add(connection)
+        self.connectiontable.add(connection)
+        return True
+
+    def _do_mod(self, ipaddr, port, proto, tcpmss, tcpsack, tcpwscale):
+        # Default connection remains an iptables rule
+        if ipaddr == '0.0.0.0':
+            return super()._do_mod(ipaddr, port, proto, tcpmss, tcpsack, tcpwscale)
+
+        if not self.connectiontable.has((ipaddr, port, proto)):
+            return self._do_add(ipaddr, port, proto, tcpmss, tcpsack, tcpwscale)
+
+        connection = self.connectiontable.get((ipaddr, port, proto))
+        # Check if the existing parameters are the same
+        if connection.tcpmss == tcpmss and connection.tcpsack == tcpsack and connection.tcpwscale == tcpwscale:
+            self._logger.debug('[mod] Modify not required : {} / {}'.format(connection, (tcpmss, tcpsack, tcpwscale)))
+            return True
+        # Move the connection to the ipset of the new profile
+        self._logger.info('Modify connection: {} / {}'.format(connection, (tcpmss, tcpsack, tcpwscale)))
+        self._ipset_delete(connection)
+        connection.tcpmss, connection.tcpsack, connection.tcpwscale = tcpmss, tcpsack, tcpwscale
+        self._ipset_add(connection)
+        return True
+
+    def _do_del(self, ipaddr, port, proto):
+        # Default connection remains an iptables rule
+        if ipaddr == '0.0.0.0':
+            return super()._do_del(ipaddr, port, proto)
+
+        if not self.connectiontable.has((ipaddr, port, proto)):
+            # Nothing to do here
+            self._logger.debug('[del] No connection found for key={}'.format((ipaddr, port, proto)))
+            return False
+
+        connection = self.connectiontable.get((ipaddr, port, proto))
+        self._logger.info('Delete connection: {}'.format(connection))
+        self.connectiontable.remove(connection, callback=False)
+        self._ipset_delete(connection)
+        return True
+
+
 class SYNProxyDataplaneEndpoint(asyncio.Protocol):
+    """
+    Endpoint of the SYNPROXY control protocol.
+
+    Version 1 messages are 12 bytes long and answered with b'1\n' or b'0\n'.
+    Version 2 frames start with 0xFF, which is not a valid IPv4 address in a v1 message,
+    followed by version, count and seq of the first message, and are answered with the same
+    header followed by one status byte per message. A frame with count 0 is a 12-byte hello.
+    """
     # start -> connection_made() [-> data_received() *] [-> eof_received() ?] -> connection_lost() -> end
-    def __init__(self, cb):
+    def __init__(self, cb, cb_batch = None):
         self._logger = logging.getLogger('SYNProxyDataplaneEndpoint')
         self.cb = cb
-        self._buffer = b''
+        self.cb_batch = cb_batch
+        self._buffer = bytearray()
 
     def connection_made(self, transport):
         self._transport = transport
@@ -526,24 +726,47 @@ class SYNProxyDataplaneEndpoint(asyncio.Protocol):
         self._logger.info('Connection lost @{0}:{1} {2}'.format(self.raddr[0], self.raddr[1], exc))
         self._transport = None
 
-    def _read_from_buffer(self, data, n=12):
-        # Add data to buffer and read n bytes if possible
-        self._buffer += data
-        if len(self._buffer) >= 12:
-            _data = self._buffer[:12]
-            self._buffer = self._buffer[12:]
-            return _data
-        else:
-            return ''
+    def _read_from_buffer(self):
+        # Extract one v1 message or v2 frame if available, return tuple (version, seq, messages)
+        buf = self._buffer
+        if not buf:
+            return None
+        if buf[0] != SYNPROXY_V2_MAGIC or self.cb_batch is None:
+            if len(buf) < SYNPROXY_V1_MSGLEN:
+                return None
+            _data = bytes(buf[:SYNPROXY_V1_MSGLEN])
+            del buf[:SYNPROXY_V1_MSGLEN]
+            return (1, None, [_data])
+        if len(buf) < SYNPROXY_V2_HEADER.size:
+            return None
+        _, version, count, seq = SYNPROXY_V2_HEADER.unpack_from(buf, 0)
+        # Hello frame has the size of a v1 message
+        _end = SYNPROXY_V2_HEADER.size + SYNPROXY_V1_MSGLEN * count if count else SYNPROXY_V1_MSGLEN
+        if len(buf) < _end:
+            return None
+        messages = [bytes(buf[i:i + SYNPROXY_V1_MSGLEN]) for i in range(SYNPROXY_V2_HEADER.size, _end, SYNPROXY_V1_MSGLEN)] if count else []
+        del buf[:_end]
+        return (version, seq, messages)
 
     def data_received(self, data):
-        # Add data to buffer and extract up to one message
-        _data = self._read_from_buffer(data)
-        # Process messages in a loop while there is data in the buffer
+        # Add data to buffer and process all available messages in a loop
+        self._buffer += data
+        responses = []
+        _data = self._read_from_buffer()
         while _data:
-            response = self.cb(_data, self.raddr)
-            self._transport.write(response)
-            _data = self._read_from_buffer(b'')
+            version, seq, messages = _data
+            if version == 1:
+                responses.append(self.cb(messages[0], self.raddr))
+            elif not messages:
+                self._logger.info('Negotiated v{} with endpoint @{}:{}'.format(version, self.raddr[0], self.raddr[1]))
+                responses.append(SYNPROXY_V2_HEADER.pack(SYNPROXY_V2_MAGIC, SYNPROXY_V2_VERSION, 0, seq))
+            else:
+                results = self.cb_batch(messages, self.raddr)
+                responses.append(SYNPROXY_V2_HEADER.pack(SYNPROXY_V2_MAGIC, SYNPROXY_V2_VERSION, len(results), seq) + bytes(results))
+            _data = self._read_from_buffer()
+        # Send all responses at once
+        if responses and self._transport is not None:
+            self._transport.write(b''.join(responses))
 
 
 def validate_arguments(args):
@@ -614,6 +837,11 @@ def parse_arguments():
     parser.add_argument('--ratelimit', type=int, nargs=2, default=(100, 100),
                         metavar=('ABOVELIMIT', 'BURST'),
                         help='Rate limit via iptables hashtable with srcip/24 and htable-size 2097152')
+    # Dataplane mode
+    parser.add_argument('--ipset', action='store_true',
+                        help='Store connections in ipsets grouped by TCP options profile')
+    parser.add_argument('--ipset-maxelem', type=int, default=262144,
+                        help='Maximum number of connections per TCP options profile ipset')
 
     args = parser.parse_args()
     validate_arguments(args)
@@ -630,18 +858,21 @@ if __name__ == '__main__':
     # Parse arguments
     args = parse_arguments()
     logger.info('Starting server @{}:{}'.format(args.ipaddr, args.port))
-    synproxy_obj = SYNProxyDataplane(nic_wan = args.nic_wan,
-                                     nic_wanp = args.nic_wanp,
-                                     standalone = args.standalone,
-                                     tcpmss = args.default_tcpmss,
-                                     tcpsack = args.default_tcpsack,
-                                     tcpwscale = args.default_tcpwscale,
-                                     secure_net = args.secure_net,
-                                     default_gw = args.default_gw,
-                                     ratelimit = args.ratelimit
-                                     )
+    synproxy_cls = SYNProxyDataplaneIPSet if args.ipset else SYNProxyDataplane
+    synproxy_obj = synproxy_cls(nic_wan = args.nic_wan,
+                                nic_wanp = args.nic_wanp,
+                                standalone = args.standalone,
+                                tcpmss = args.default_tcpmss,
+                                tcpsack = args.default_tcpsack,
+                                tcpwscale = args.default_tcpwscale,
+                                secure_net = args.secure_net,
+                                default_gw = args.default_gw,
+                                ratelimit = args.ratelimit,
+                                ipset_maxelem = args.ipset_maxelem
+                                )
     cb = synproxy_obj.process_message
-    coro = loop.create_server(lambda: SYNProxyDataplaneEndpoint(cb = cb),
+    cb_batch = synproxy_obj.process_batch
+    coro = loop.create_server(lambda: SYNProxyDataplaneEndpoint(cb = cb, cb_batch = cb_batch),
                               host=args.ipaddr,
                               port=args.port,
                               reuse_address=True)
@@ -31,19 +31,20 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import asyncio
+import collections
 import logging
-import random
 import pprint
 from functools import partial
 from operator import getitem
 
 from helpers_n_wrappers import utils3
-from helpers_n_wrappers import network_helper3
 
 import customdns
 from customdns import dnsutils
 from customdns import edns0
-from customdns.dnsresolver import DNSResolver, uDNSResolver
+from customdns.dnsresolver import DNSResolver, uDNSResolver, uDNSResolverPool, uDNSUpstreamSet
+from customdns.dnscache import DNSCache, question_key, adapt_wire, wire_fits
+from customdns.dnswire import WireResponseBuilder
 
 import dns
 import dns.message
@@ -57,6 +58,7 @@ from host import HostEntry
 
 import connection
 from connection import ConnectionLegacy
+from packetparser import parse_packet
 
 import pbra
 
@@ -64,23 +66,50 @@ DNSRR_TTL_CIRCULARPOOL = 0
 DNSRR_TTL_SERVICEPOOL = 10
 DNSRR_TTL_DEFAULT = 30
 
+class _uInflightQuery(object):
+    """ Upstream resolution shared by concurrent LAN queries of the same question """
+    __slots__ = ('transaction', 'future', 'nofwaiters', 'rcode')
+
+    def __init__(self, transaction, future):
+        self.transaction = transaction
+        self.future = future
+        self.nofwaiters = 0
+        # Failure rcode of the shared resolution
+        self.rcode = dns.rcode.SERVFAIL
+
 class DNSCallbacks(object):
     def __init__(self, **kwargs):
         self._logger = logging.getLogger('DNSCallbacks')
         self._dns_timeout = {None:[0]} # Default single blocking query
-        utils3.set_attributes(self, **kwargs)
+        self.dns_tcp_wait = 0.50 # Maximum hold time of TCP queries waiting for a Circular Pool address
+        self.dns_cache_memory = 8 * 1024 * 1024 # Memory budget of the LAN DNS response cache
+        self.dns_hedging = True # Duplicate slow LAN resolutions to a second upstream resolver
+        utils3.set_attributes(self, override=True, **kwargs)
         self.loop = asyncio.get_event_loop()
         self.state = {}
         self.soa_list = []
         self.resolver_list = []
+        # Latency and failure tracking of the upstream resolvers
+        self.upstreams = uDNSUpstreamSet()
         self.registry = {}
         self.activequeries = {}
+        # Concurrent identical LAN questions share one upstream resolution
+        self.inflightqueries = {}
+        self.nofcoalesced = 0
+        self.nofuncoalesced = 0
+        # Multiplex upstream resolutions over a pool of long-lived sockets
+        self.resolver_pool = uDNSResolverPool()
+        # Answer repeated LAN queries from the cache of upstream responses
+        self.lan_cache = DNSCache(memory=self.dns_cache_memory, name='LANDNSCache')
+        # Build Circular Pool answers from pre-encoded wire templates
+        self.wire_builder = WireResponseBuilder()
 
     def shutdown(self):
         self._logger.warning('Shutdown')
         # Close registered sockets
         for obj in self.get_object(None):
             obj.connection_lost(None)
+        self.resolver_pool.close()
 
     def get_object(self, name=None):
         if name is None:
@@ -106,12 +135,13 @@ class DNSCallbacks(object):
     def dns_register_resolver(self, addr):
         if addr not in self.resolver_list:
             self.resolver_list.append(addr)
+            self.upstreams.register(addr)
 
     def dns_get_resolver(self, any=True):
-        n = 0
         if any:
-            n = random.randrange(len(self.resolver_list))
-        return self.resolver_list[n]
+            # Select the upstream with the lowest expected latency
+            return self.upstreams.select()
+        return self.resolver_list[0]
 
     def dns_get_timeout(self, record_type = None):
         try:
@@ -160,6 +190,38 @@ class DNSCallbacks(object):
             self.network.ipt_add_user_carriergrade(hostname, carriergrade_ipt)
 
 
+    @asyncio.coroutine
+    def ddns_register_users_bulk(self, subscribers, flushed = False):
+        """
+        Register a list of (fqdn, ipaddr) creating the network resources of all users in bulk.
+        Return an ordered dictionary with the timings of each stage.
+        """
+        self._logger.info('Register {} users in bulk'.format(len(subscribers)))
+        _t = self.loop.time()
+        # Download user data once for all users
+        policy_d = self.datarepository.get_policy_host_all({})
+        users = []
+        for fqdn, ipaddr in subscribers:
+            user_data = policy_d.get(fqdn)
+            if user_data is None:
+                self._logger.info('Generating default subscriber data for {}'.format(fqdn))
+                user_data = yield from self.datarepository.get_policy_host_default(fqdn, ipaddr)
+
+            host_obj = HostEntry(name=fqdn, fqdn=fqdn, ipv4=ipaddr, services=user_data)
+            self.hosttable.add(host_obj)
+
+            fw_d = host_obj.get_service('FIREWALL', {})
+            users.append({'hostname':     ipaddr,
+                          'ipaddr':       ipaddr,
+                          'groups':       host_obj.get_service('GROUP', []),
+                          'admin_fw':     fw_d.setdefault('FIREWALL_ADMIN', []),
+                          'user_fw':      fw_d.setdefault('FIREWALL_USER', []),
+                          'carriergrade': host_obj.get_service('CARRIERGRADE', []) if host_obj.has_service('CARRIERGRADE') else []})
+        timings = collections.OrderedDict(hosttable = self.loop.time() - _t)
+        # Create network resources
+        timings.update(self.network.ipt_add_users_bulk(users, flushed = flushed))
+        return timings
+
     @asyncio.coroutine
     def ddns_deregister_user(self, fqdn, rdtype, ipaddr):
         self._logger.info('Deregister user {} @ {}'.format(fqdn, ipaddr))
@@ -215,8 +277,7 @@ class DNSCallbacks(object):
         # Initiate DNS resolution
         response = None
         try:
-            resolver = uDNSResolver()
-            response = yield from resolver.do_resolve(query, (host_addr, 53), timeouts=timeouts)
+            response = yield from self.resolver_pool.do_resolve(query, (host_addr, 53), timeouts=timeouts)
         except ConnectionRefusedError:
             # Socket error / DNS Server unavailable
             self._logger.debug('ConnectionRefusedError: Resolve CarrierGrade domain: [{}] {} via {}'.format(dns.rdatatype.to_text(rdtype), fqdn, host_addr))
@@ -370,30 +431,90 @@ class DNSCallbacks(object):
 
         self._logger.info('LAN !SOA: {} ({}) from {}/{}'.format(fqdn, dns.rdatatype.to_text(rdtype), addr[0], query.transport))
 
+        response = self.lan_cache.get(query)
+        if response is not None:
+            # Send cached response in wire format
+            cback(query, addr, response)
+            return
+
         if key in self.activequeries:
             # Continue ongoing resolution
-            resolver = self.activequeries[key]
-            resolver.do_continue(query)
+            transaction = self.activequeries[key]
+            transaction.retransmit()
             return
 
-        # Create factory for new resolution
-        raddr = self.dns_get_resolver()
-        resolver = uDNSResolver()
-        self.activequeries[key] = resolver
+        ckey = question_key(query)
+        if ckey in self.inflightqueries:
+            # Coalesce with the ongoing resolution of the same question from another query
+            inflight = self.inflightqueries[ckey]
+            inflight.nofwaiters += 1
+            self.nofcoalesced += 1
+            # Forward host retransmissions via the shared transaction
+            self.activequeries[key] = inflight.transaction
+            try:
+                wire = yield from asyncio.shield(inflight.future)
+            finally:
+                del self.activequeries[key]
+            if wire is None:
+                # Answer with the same failure as the leading query
+                cback(query, addr, self._dns_lan_failure(query, inflight.rcode))
+                return
+            if wire_fits(query, wire):
+                # Send shared response with the query ID of this query
+                cback(query, addr, bytes(adapt_wire(query, wire)))
+                return
+            # The shared response exceeds the UDP payload or is truncated for TCP, resolve on its own
+            self._logger.debug('Shared response of {} bytes does not fit {}/{}, resolving again'.format(len(wire), addr[0], query.transport))
+
+        # Create transaction for new resolution via the best upstreams
+        transaction = self.resolver_pool.hedged_transaction(query, self.upstreams, hedging=self.dns_hedging)
+        raddr = transaction.addr
+        inflight = _uInflightQuery(transaction, self.loop.create_future())
+        self.activequeries[key] = transaction
+        # Another leader may have started while this query waited for an unfit shared response
+        self.inflightqueries.setdefault(ckey, inflight)
+        self.nofuncoalesced += 1
+        response = None
         try:
-            response = yield from resolver.do_resolve(query, raddr, timeouts=self.dns_get_timeout(rdtype))
+            response = yield from transaction.resolve(timeouts=self.dns_get_timeout(rdtype))
         except ConnectionRefusedError:
-            # Failed to resolve DNS query - Drop DNS Query
-            self._logger.warning('ConnectionRefusedError: Resolving {} via {}:{}'.format(fqdn, raddr[0], raddr[1]))
-            response = dnsutils.make_response_rcode(query, dns.rcode.REFUSED)
-        if not response:
-            # Failed to resolve DNS query - Drop DNS Query
+            # ICMP port unreachable from the upstream resolver
+            self._logger.warning('ConnectionRefusedError: Failed to resolve address for {} via {}:{}'.format(fqdn, raddr[0], raddr[1]))
+            inflight.rcode = dns.rcode.REFUSED
+        finally:
+            # Resolution ended
+            del self.activequeries[key]
+            if self.inflightqueries.get(ckey) is inflight:
+                del self.inflightqueries[ckey]
+            # Wake up the coalesced queries, the response is serialized only once for all of them
+            wire = None
+            if response and inflight.nofwaiters:
+                try:
+                    wire = response.to_wire()
+                except Exception as e:
+                    self._logger.warning('Failed to serialize shared response for {}: {}'.format(fqdn, e))
+            inflight.future.set_result(wire)
+        if response:
+            self.lan_cache.put(query, response)
+        else:
             self._logger.warning('ResolutionFailure: Failed to resolve address for {} via {}:{}'.format(fqdn, raddr[0], raddr[1]))
-            response = dnsutils.make_response_rcode(query, dns.rcode.SERVFAIL)
-        # Resolution ended, send generated response
-        del self.activequeries[key]
+            response = self._dns_lan_failure(query, inflight.rcode)
+        # Send generated response
         cback(query, addr, response)
 
+    def _dns_lan_failure(self, query, rcode = dns.rcode.SERVFAIL):
+        """ Return the response to a failed LAN resolution, serving stale data if available """
+        response = self.lan_cache.get_stale(query)
+        if response is None:
+            response = dnsutils.make_response_rcode(query, rcode)
+        return response
+
+    def stats_coalescing(self):
+        """ Return the metrics of the coalesced LAN resolutions """
+        total = self.nofcoalesced + self.nofuncoalesced
+        return {'upstream': self.nofuncoalesced, 'coalesced': self.nofcoalesced,
+                'ratio': self.nofcoalesced / total if total else 0.0}
+
 
     @asyncio.coroutine
     def dns_process_rgw_wan_soa(self, query, addr, cback):
@@ -404,6 +525,7 @@ class DNSCallbacks(object):
         # Initialize to None to prevent AttributeError
         query.reputation_resolver = None
         query.reputation_requestor = None
+        query.requestor_prefix = None
 
         self._logger.debug('WAN SOA: {} ({}) from {}/{}'.format(fqdn, dns.rdatatype.to_text(rdtype), addr[0], query.transport))
 
@@ -468,11 +590,18 @@ class DNSCallbacks(object):
         allocated_ipv4 = yield from self.pbra.pbra_dns_process_rgw_wan_soa(query, addr, host_obj, _service_data, _ipv4)
 
         if not allocated_ipv4 and query.transport == 'tcp':
-            # Failed to allocate an address - hold and reattempt after T ms to bridge the gap with UDP queries
-            rtx_t = 0.50
-            self._logger.debug('Failed to allocate an address for {} via TCP, reattempting in {} msec'.format(fqdn, rtx_t*1000))
-            yield from asyncio.sleep(rtx_t)
-            allocated_ipv4 = yield from self.pbra.pbra_dns_process_rgw_wan_soa(query, addr, host_obj, _service_data, _ipv4)
+            # Failed to allocate an address - hold until an address is released to bridge the gap with UDP queries
+            self._logger.debug('Failed to allocate an address for {} via TCP, waiting up to {} msec'.format(fqdn, self.dns_tcp_wait*1000))
+            deadline = self.loop.time() + self.dns_tcp_wait
+            while not allocated_ipv4:
+                timeout = deadline - self.loop.time()
+                released = False
+                if timeout > 0:
+                    released = yield from self.pbra.pbra_dns_wait_release(query, timeout)
+                # Reattempt on release notification or once more upon reaching the deadline
+                allocated_ipv4 = yield from self.pbra.pbra_dns_process_rgw_wan_soa(query, addr, host_obj, _service_data, _ipv4)
+                if not released:
+                    break
 
         if not allocated_ipv4 and query.transport == 'tcp':
             # Failed to allocate an address - Answer with empty records to avoid stalling the TCP transaction
@@ -488,7 +617,7 @@ class DNSCallbacks(object):
         # Create DNS response based on received query type
         if rdtype == dns.rdatatype.A:
             # Create DNS Response type A
-            response = dnsutils.make_response_answer_rr(query, fqdn, dns.rdatatype.A, allocated_ipv4, rdclass=1, ttl=DNSRR_TTL_CIRCULARPOOL)
+            response = self.wire_builder.make_response_a(query, fqdn, allocated_ipv4, ttl=DNSRR_TTL_CIRCULARPOOL)
             self._logger.debug('Send DNS response to {}:{}'.format(addr[0],addr[1]))
             cback(query, addr, response)
 
@@ -498,10 +627,7 @@ class DNSCallbacks(object):
             sfqdn = '_{}._{}.{}'.format(_service_data['port'], _service_data['protocol'], fqdn)
             # Build SRV data response - SRV answer with encoded SFQDN and additional with A record for encoded SFQDN
             priority, weight, port, target = 10, 100, _service_data['port'], sfqdn
-            srv_rrset = '{} {} {} {}'.format(priority, weight, port, target)
-            response = dnsutils.make_response_answer_rr(query, fqdn, dns.rdatatype.SRV, srv_rrset, rdclass=1, ttl=DNSRR_TTL_CIRCULARPOOL)
-            _foo = dnsutils.make_response_answer_rr(query, sfqdn, dns.rdatatype.A, allocated_ipv4, rdclass=1, ttl=DNSRR_TTL_CIRCULARPOOL)
-            response.additional = _foo.answer
+            response = self.wire_builder.make_response_srv(query, fqdn, priority, weight, port, target, allocated_ipv4, ttl=DNSRR_TTL_CIRCULARPOOL)
             self._logger.debug('Send DNS response to {}:{}'.format(addr[0],addr[1]))
             cback(query, addr, response)
 
@@ -509,9 +635,7 @@ class DNSCallbacks(object):
             # Create DNS Response type TXT
             # Build TXT data response - TXT answer with encoded data service and additional with A record for IP address
             txt_rrset = 'proxy_{}.port_{}.protocol_{}.{}'.format(_service_data['proxy_required'], _service_data['port'], _service_data['protocol'], fqdn)
-            response = dnsutils.make_response_answer_rr(query, fqdn, dns.rdatatype.TXT, txt_rrset, rdclass=1, ttl=DNSRR_TTL_CIRCULARPOOL)
-            _foo = dnsutils.make_response_answer_rr(query, fqdn, dns.rdatatype.A, allocated_ipv4, rdclass=1, ttl=DNSRR_TTL_CIRCULARPOOL)
-            response.additional = _foo.answer
+            response = self.wire_builder.make_response_txt(query, fqdn, txt_rrset, allocated_ipv4, ttl=DNSRR_TTL_CIRCULARPOOL)
             self._logger.debug('Send DNS response to {}:{}'.format(addr[0],addr[1]))
             cback(query, addr, response)
 
@@ -608,81 +732,65 @@ class PacketCallbacks(object):
         self._logger = logging.getLogger('PacketCallbacks')
         utils3.set_attributes(self, **kwargs)
 
-    def _format_5tuple(self, packet_fields):
-        if packet_fields['proto'] == 6:
-            return '{}:{} {}:{} [{}] (TTL {}) flags/{:08b} seq/{} ack{}'.format(packet_fields['src'], packet_fields['sport'],
-                                                                                packet_fields['dst'], packet_fields['dport'],
-                                                                                packet_fields['proto'], packet_fields['ttl'],
-                                                                                packet_fields['tcp_flags'],packet_fields['tcp_seq'],
-                                                                                packet_fields['tcp_ack'])
-        elif packet_fields['proto'] == 132:
-            return '{}:{} {}:{} [{}] (TTL {}) tag/{:x}'.format(packet_fields['src'], packet_fields['sport'],
-                                                                packet_fields['dst'], packet_fields['dport'],
-                                                                packet_fields['proto'], packet_fields['ttl'],
-                                                                packet_fields['sctp_tag'])
+    def packet_in_circularpool_fastpath(self, packet):
+        """
+        Return True if the packet was rejected in the worker thread.
+        Runs in the NFQUEUE worker threads with read-only table lookups, the PBRA tracking of rejected
+        packets is scheduled in the event loop via packet.defer.
+        """
+        data = self.network.ipt_nfpacket_payload(packet)
+        packet_fields = parse_packet(data)
+
+        # Expired connections are left for the event loop to remove
+        conn, reason = self.connectiontable.match_flow(packet_fields.dst_int, packet_fields.dport, packet_fields.proto, check_expire=False)
+        if reason is not None:
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug('Reject / {} for IP {}: [{}]'.format(reason, packet_fields.dst, packet_fields))
+        elif self.pbra.pbra_data_preaccept_circularpool(data, packet_fields) is False:
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug('Reject / CircularPool pre-emptive check failed for IP {}: [{}]'.format(packet_fields.dst, packet_fields))
         else:
-            return '{}:{} {}:{} [{}] (TTL {})'.format(packet_fields['src'], packet_fields['sport'],
-                                                      packet_fields['dst'], packet_fields['dport'],
-                                                      packet_fields['proto'], packet_fields['ttl'])
+            # Connection lookup and post processing modify the connection table
+            return False
+
+        self.network.ipt_nfpacket_reject(packet)
+        packet.defer(self.pbra.pbra_data_track_circularpool, data, packet_fields)
+        return True
 
     def packet_in_circularpool(self, packet):
         # Get IP data
         data = self.network.ipt_nfpacket_payload(packet)
-        # Parse packet
-        packet_fields = network_helper3.parse_packet_custom(data)
-        # Select appropriate values for building the keys
-        src, dst = packet_fields['src'], packet_fields['dst']
-        proto, ttl = packet_fields['proto'], packet_fields['ttl']
-        sport = packet_fields.setdefault('sport', 0)
-        dport = packet_fields.setdefault('dport', 0)
-        sender = '{}:{}'.format(src, sport)
-        self._logger.debug('Received PacketIn: {}'.format(packet_fields))
-
-        # Pre-emptive check with PBRA if the packet is blacklister
-        response = self.pbra.pbra_data_preaccept_circularpool(data, packet_fields)
-        if response is False:
-            self._logger.info('Reject / CircularPool pre-emptive check failed for IP {}: [{}]'.format(dst,self._format_5tuple(packet_fields)))
+        # Parse packet, the addresses are converted to strings only when used
+        packet_fields = parse_packet(data)
+        _debug = self._logger.isEnabledFor(logging.DEBUG)
+        if _debug:
+            self._logger.debug('Received PacketIn: {}'.format(packet_fields))
+
+        # Lookup connection in table with wildcard precedence (SFQDN+, SFQDN-, FQDN)
+        conn, reason = self.connectiontable.match_flow(packet_fields.dst_int, packet_fields.dport, packet_fields.proto)
+        if reason == connection.MATCH_NO_RESERVATION:
+            if _debug:
+                self._logger.debug('Reject / No connection reserved for IP {}: [{}]'.format(packet_fields.dst, packet_fields))
             self.network.ipt_nfpacket_reject(packet)
             self.pbra.pbra_data_track_circularpool(data, packet_fields)
             return
-
-        # Build connection lookup keys
-        # key1: Basic IP destination for early drop
-        key1 = (connection.KEY_RGW_PUBLIC_IP, dst)
-        # key2: Full fledged 5-tuple (not in use by the system)
-        #key2 = (connection.KEY_RGW_5TUPLE, dst, dport, src, sport, proto)
-        # key3: Semi-full fledged 3-tuple  (SFQDN+)
-        key3 = (connection.KEY_RGW_3TUPLE, dst, dport, proto)
-        # key4: Basic 3-tuple with wildcards (SFQDN-)
-        key4 = (connection.KEY_RGW_3TUPLE, dst, dport, 0)
-        # key5: Basic 3-tuple with wildcards (SFQDN-)
-        key5 = (connection.KEY_RGW_3TUPLE, dst, 0, proto)
-        # key6: Basic 3-tuple with wildcards (FQDN)
-        key6 = (connection.KEY_RGW_3TUPLE, dst, 0, 0)
-
-        # Lookup connection in table with basic key for for early drop
-        if not self.connectiontable.has(key1):
-            self._logger.debug('Reject / No connection reserved for IP {}: [{}]'.format(dst,self._format_5tuple(packet_fields)))
+        elif reason == connection.MATCH_NO_FLOW:
+            self._logger.warning('Reject / No connection found for packet: [{}]'.format(packet_fields))
             self.network.ipt_nfpacket_reject(packet)
             self.pbra.pbra_data_track_circularpool(data, packet_fields)
             return
 
-        # Lookup connection in table with rest of the keys
-        conn = None
-        for key in [key3, key4, key5, key6]:
-            if self.connectiontable.has(key):
-                self._logger.debug('Connection found for n-tuple* {}: [{}]'.format(key,self._format_5tuple(packet_fields)))
-                conn = self.connectiontable.get(key)
-                break
-
-        if conn is None:
-            self._logger.warning('Reject / No connection found for packet: [{}]'.format(self._format_5tuple(packet_fields)))
+        # Pre-emptive check with PBRA if the packet is blacklister
+        response = self.pbra.pbra_data_preaccept_circularpool(data, packet_fields)
+        if response is False:
+            self._logger.info('Reject / CircularPool pre-emptive check failed for IP {}: [{}]'.format(packet_fields.dst, packet_fields))
             self.network.ipt_nfpacket_reject(packet)
             self.pbra.pbra_data_track_circularpool(data, packet_fields)
             return
 
         # The connection belongs to an SLA marked DNS server
-        if conn.dns_bind and conn.dns_host.contains(src):
+        src = packet_fields.src
+        if conn.dns_bind and conn.dns_host.contains(packet_fields.src_int):
             self._logger.info('Connection reserved found for remote host {}: {}'.format(src, conn.dns_host))
         elif conn.dns_bind:
             self._logger.info('Reject / Connection not reserved for remote host {}: {}'.format(src, conn.dns_host))
@@ -691,9 +799,9 @@ class PacketCallbacks(object):
             return
 
         # DNAT to private host
-        self._logger.info('DNAT of [{}] to {} via {}'.format(self._format_5tuple(packet_fields), conn.private_ip, conn.fqdn))
+        self._logger.info('DNAT of [{}] to {} via {}'.format(packet_fields, conn.private_ip, conn.fqdn))
         self.network.ipt_nfpacket_dnat(packet, conn.private_ip)
 
-        if conn.post_processing(self.connectiontable, src, sport):
+        if conn.post_processing(self.connectiontable, src, packet_fields.sport):
             # Delete connection and trigger IP address release
             self.connectiontable.remove(conn)
@@ -37,6 +37,9 @@ import pprint
 from helpers_n_wrappers import container3
 from helpers_n_wrappers import utils3
 
+from expiry import ExpiryContainer
+from packetparser import ipaddr_to_int
+
 KEY_RGW            = 'KEY_RGW'
 KEY_RGW_FQDN       = 'KEY_RGW_FQDN'
 KEY_RGW_PRIVATE_IP = 'KEY_RGW_PRIVATE_IP'
@@ -44,29 +47,201 @@ KEY_RGW_PUBLIC_IP  = 'KEY_RGW_PUBLIC_IP'
 KEY_RGW_3TUPLE     = 'KEY_RGW_3TUPLE'
 KEY_RGW_5TUPLE     = 'KEY_RGW_5TUPLE'
 
-class ConnectionTable(container3.Container):
+# Reason codes of ConnectionTable.match_flow()
+MATCH_NO_RESERVATION = 'MATCH_NO_RESERVATION'
+MATCH_NO_FLOW        = 'MATCH_NO_FLOW'
+
+class _PortOccupancy(object):
+    """ Counters of the (port, protocol) tuples in use by the connections of an outbound IP address """
+    __slots__ = ('tuples', 'ports', 'protocols', 'total')
+
+    def __init__(self):
+        self.tuples = {}
+        self.ports = {}
+        self.protocols = {}
+        self.total = 0
+
+    def _inc(self, d, key, value):
+        n = d.get(key, 0) + value
+        if n:
+            d[key] = n
+        else:
+            del d[key]
+
+    def update(self, port, protocol, value):
+        self._inc(self.tuples, (port, protocol), value)
+        self._inc(self.ports, port, value)
+        self._inc(self.protocols, protocol, value)
+        self.total += value
+
+    def blocks(self, port, protocol):
+        """ Return True if the (port, protocol) service cannot overload the address """
+        # Same conditions as comparing against every connection, using 0 as wildcard
+        if (port, protocol) == (0, 0) or (0, 0) in self.tuples or (port, protocol) in self.tuples:
+            return True
+        if (protocol == 0 and port in self.ports) or (port, 0) in self.tuples:
+            return True
+        if (port == 0 and protocol in self.protocols) or (0, protocol) in self.tuples:
+            return True
+        return False
+
+
+def _ipaddr_key(ipaddr):
+    """ Return the integer value of an IPv4 address string, or the value unchanged if unset """
+    return ipaddr_to_int(ipaddr) if isinstance(ipaddr, str) else ipaddr
+
+
+class _FlowMatch(object):
+    """ Resolve (port, protocol) to the 3-tuple connection of an outbound IP address using 0 as wildcard """
+    __slots__ = ('flows', 'reserved', 'wildcards')
+
+    # Wildcard classes in order of precedence: (port, protocol), (port, 0), (0, protocol), (0, 0)
+    EXACT, PORT, PROTOCOL, ANY = 1, 2, 4, 8
+
+    def __init__(self):
+        self.flows = {}
+        # Number of connections with the outbound IP address, 3-tuple bound or not
+        self.reserved = 0
+        # Number of flows per wildcard class
+        self.wildcards = {self.EXACT: 0, self.PORT: 0, self.PROTOCOL: 0, self.ANY: 0}
+
+    def _wildcard(self, port, protocol):
+        if port:
+            return self.EXACT if protocol else self.PORT
+        return self.PROTOCOL if protocol else self.ANY
+
+    def add(self, port, protocol, node):
+        self.flows[(port, protocol)] = node
+        self.wildcards[self._wildcard(port, protocol)] += 1
+
+    def remove(self, port, protocol):
+        del self.flows[(port, protocol)]
+        self.wildcards[self._wildcard(port, protocol)] -= 1
+
+    def match(self, port, protocol):
+        """ Return the connection with the highest precedence or None """
+        flows, wildcards = self.flows, self.wildcards
+        # Only probe the wildcard classes in use, without repeating keys when the packet has no port or protocol
+        if wildcards[self._wildcard(port, protocol)]:
+            node = flows.get((port, protocol))
+            if node is not None:
+                return node
+        if port and protocol and wildcards[self.PORT]:
+            node = flows.get((port, 0))
+            if node is not None:
+                return node
+        if port and protocol and wildcards[self.PROTOCOL]:
+            node = flows.get((0, protocol))
+            if node is not None:
+                return node
+        if (port or protocol) and wildcards[self.ANY]:
+            return flows.get((0, 0))
+        return None
+
+
+class ConnectionTable(ExpiryContainer):
     def __init__(self, name='ConnectionTable'):
-        """ Initialize as a Container """
+        """ Initialize as an ExpiryContainer """
         super().__init__(name)
+        # Index outbound IP addresses to their port occupancy
+        self._occupancy = {}
+        self._occupancy_nodes = {}
+        # Index outbound IP addresses (as integers) to their 3-tuple flow match table
+        self._flowmatch = {}
+
+    def add(self, node):
+        super().add(node)
+        if not isinstance(node, ConnectionLegacy):
+            return
+        ipaddr, port, protocol = node.outbound_ip, node.outbound_port, node.protocol
+        self._occupancy_nodes[id(node)] = (ipaddr, port, protocol)
+        self._occupancy.setdefault(ipaddr, _PortOccupancy()).update(port, protocol, 1)
+
+    def remove(self, node, callback=True):
+        # Update the index before the delete callback releases the address
+        data = self._occupancy_nodes.pop(id(node), None)
+        if data is not None:
+            ipaddr, port, protocol = data
+            occupancy = self._occupancy[ipaddr]
+            occupancy.update(port, protocol, -1)
+            if occupancy.total == 0:
+                del self._occupancy[ipaddr]
+        super().remove(node, callback)
+
+    def removeall(self, callback=True):
+        super().removeall(callback)
+        self._occupancy.clear()
+        self._occupancy_nodes.clear()
+        self._flowmatch.clear()
+
+    def _add_lookupkeys(self, node, keys):
+        super()._add_lookupkeys(node, keys)
+        # Mirror the registered keys so that updatekeys() is also tracked
+        for key, isunique in keys:
+            if not isinstance(key, tuple):
+                continue
+            if key[0] == KEY_RGW_PUBLIC_IP:
+                self._flowmatch.setdefault(_ipaddr_key(key[1]), _FlowMatch()).reserved += 1
+            elif key[0] == KEY_RGW_3TUPLE:
+                _, ipaddr, port, protocol = key
+                self._flowmatch.setdefault(_ipaddr_key(ipaddr), _FlowMatch()).add(port, protocol, node)
+
+    def _remove_lookupkeys(self, node, keys):
+        super()._remove_lookupkeys(node, keys)
+        for key, isunique in keys:
+            if not isinstance(key, tuple):
+                continue
+            if key[0] == KEY_RGW_PUBLIC_IP:
+                ipaddr = _ipaddr_key(key[1])
+                flowmatch = self._flowmatch[ipaddr]
+                flowmatch.reserved -= 1
+            elif key[0] == KEY_RGW_3TUPLE:
+                _, ipaddr, port, protocol = key
+                ipaddr = _ipaddr_key(ipaddr)
+                flowmatch = self._flowmatch[ipaddr]
+                flowmatch.remove(port, protocol)
+            else:
+                continue
+            if flowmatch.reserved == 0 and not flowmatch.flows:
+                del self._flowmatch[ipaddr]
+
+    def match_flow(self, ipaddr, port, protocol, check_expire=True):
+        """
+        Find the connection of an incoming packet with wildcard precedence.
 
-    def _update_set(self, s):
-        myset = set(s)
-        for node in myset:
-            if node.hasexpired():
-                self.remove(node)
+        @param ipaddr: Outbound IPv4 address (packet destination) as integer or string.
+        @param port: Outbound port number (packet destination port), 0 if not available.
+        @param protocol: Protocol number.
+        @param check_expire: If activated, remove expired connections and retry with lower precedence.
+        @return: A tuple of (connection, None) or (None, reason code).
+        """
+        flowmatch = self._flowmatch.get(_ipaddr_key(ipaddr))
+        if flowmatch is None or flowmatch.reserved == 0:
+            return (None, MATCH_NO_RESERVATION)
+        node = flowmatch.match(port, protocol)
+        while node is not None and check_expire and node.hasexpired():
+            self.remove(node)
+            node = flowmatch.match(port, protocol)
+        if node is None:
+            return (None, MATCH_NO_FLOW)
+        return (node, None)
+
+    def get_overloadable(self, port, protocol):
+        """ Return a list of outbound IP addresses in use that can be overloaded with the given port and protocol """
+        if (port, protocol) == (0, 0):
+            return []
+        return [ipaddr for ipaddr, occupancy in self._occupancy.items() if not occupancy.blocks(port, protocol)]
 
     def update_all_rgw(self):
-        conn_set = self.lookup(KEY_RGW, update=False, check_expire=False)
-        if conn_set is None:
-            return
-        self._update_set(conn_set)
+        """ Remove expired connections and return them as a list """
+        return self.pop_expired(time.time())
 
     def get_all_rgw(self, update=True):
+        if update:
+            self.pop_expired(time.time())
         conn_set = self.lookup(KEY_RGW, update=False, check_expire=False)
         if conn_set is None:
             return []
-        if update:
-            self._update_set(conn_set)
         return conn_set
 
     def stats(self, key):
@@ -244,4 +419,5 @@ if __name__ == "__main__":
     print('Connection c1 has expired?')
     print(c1.hasexpired())
 
+    print('Overloadable addresses for 80/6: {}'.format(table.get_overloadable(80, 6)))
     table.update_all_rgw()
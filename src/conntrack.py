@@ -0,0 +1,243 @@
+"""
+BSD 3-Clause License
+
+Copyright (c) 2018, Jesus Llorente Santos, Aalto University, Finland
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import errno
+import logging
+import socket
+import struct
+
+from netlink import *
+
+
+# ctnetlink constants
+NFNL_SUBSYS_CTNETLINK = 1
+IPCTNL_MSG_CT_NEW     = 0
+IPCTNL_MSG_CT_GET     = 1
+IPCTNL_MSG_CT_DELETE  = 2
+CTA_TUPLE_ORIG        = 1
+CTA_TUPLE_REPLY       = 2
+CTA_TUPLE_IP          = 1
+CTA_TUPLE_PROTO       = 2
+CTA_IP_V4_SRC         = 1
+CTA_IP_V4_DST         = 2
+CTA_PROTO_NUM         = 1
+CTA_PROTO_SRC_PORT    = 2
+CTA_PROTO_DST_PORT    = 3
+
+# Maximum number of requests sent before reading their acknowledgements
+BATCH_SIZE = 256
+
+PROTOCOLS = {'ICMP': 1, 'TCP': 6, 'UDP': 17, 'SCTP': 132}
+
+
+class ConntrackTuple(object):
+    """ 5-tuple of a conntrack direction, keeps the raw attribute for deletion """
+    __slots__ = ('src', 'dst', 'proto', 'sport', 'dport', 'raw')
+
+    def __init__(self, src, dst, proto, sport = 0, dport = 0, raw = None):
+        self.src = src
+        self.dst = dst
+        self.proto = proto
+        self.sport = sport
+        self.dport = dport
+        self.raw = raw
+
+    def __repr__(self):
+        return '[{}] {}:{} > {}:{}'.format(self.proto, self.src, self.sport, self.dst, self.dport)
+
+
+class ConntrackEntry(object):
+    __slots__ = ('orig', 'reply')
+
+    def __init__(self, orig, reply):
+        self.orig = orig
+        self.reply = reply
+
+    def __repr__(self):
+        return 'orig {} / reply {}'.format(self.orig, self.reply)
+
+
+class Conntrack(object):
+    """
+    Connection tracking operations via NFNETLINK.
+
+    Requests are sent in batches over a single netlink socket and acknowledged
+    at the end of each batch, so N deletions cost a few system calls instead of
+    forking N conntrack processes.
+    """
+    def __init__(self, name = 'Conntrack', rcvbuf = 4*1024*1024):
+        self._logger = logging.getLogger(name)
+        self._rcvbuf = rcvbuf
+        self._sock = None
+        self._seq = 0
+
+    def _socket(self):
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_NETFILTER)
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._rcvbuf)
+            self._sock.bind((0, 0))
+        return self._sock
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _build_request(self, msg_type, flags, payload = b'', family = socket.AF_INET):
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        return self._seq, nlmsg_build((NFNL_SUBSYS_CTNETLINK << 8) | msg_type, flags, self._seq, family, 0, payload)
+
+    def _recv_messages(self):
+        """ Generator of (type, flags, seq, message) of the received netlink messages """
+        return nlmsg_iter(self._socket().recv(1024*1024))
+
+    def _transact(self, requests):
+        """ Send requests in batches and return a dictionary of seq -> errno of the acknowledgements """
+        results = {}
+        sock = self._socket()
+        for i in range(0, len(requests), BATCH_SIZE):
+            batch = requests[i:i + BATCH_SIZE]
+            pending = set(seq for seq, _ in batch)
+            sock.send(b''.join(msg for _, msg in batch))
+            while pending:
+                for nlmsg_type, _, nlmsg_seq, msg in self._recv_messages():
+                    if nlmsg_type != NLMSG_ERROR or nlmsg_seq not in pending:
+                        continue
+                    results[nlmsg_seq] = nlmsg_error(msg)
+                    pending.discard(nlmsg_seq)
+        return results
+
+    def flush(self, family = socket.AF_INET):
+        """ Delete all the entries of the connection tracking table """
+        seq, msg = self._build_request(IPCTNL_MSG_CT_DELETE, NLM_F_REQUEST | NLM_F_ACK, family = family)
+        error = self._transact([(seq, msg)])[seq]
+        if error:
+            raise OSError(error, 'Failed to flush conntrack: {}'.format(errno.errorcode.get(error, error)))
+        return True
+
+    def dump(self, family = socket.AF_INET):
+        """ Return a list of ConntrackEntry of the connection tracking table """
+        entries = []
+        seq, msg = self._build_request(IPCTNL_MSG_CT_GET, NLM_F_REQUEST | NLM_F_DUMP, family = family)
+        self._socket().send(msg)
+        while True:
+            for nlmsg_type, _, nlmsg_seq, msg in self._recv_messages():
+                if nlmsg_seq != seq:
+                    continue
+                if nlmsg_type == NLMSG_DONE:
+                    return entries
+                if nlmsg_type == NLMSG_ERROR:
+                    raise OSError(nlmsg_error(msg), 'Failed to dump conntrack')
+                entry = self._parse_entry(msg)
+                if entry is not None:
+                    entries.append(entry)
+
+    def _parse_entry(self, msg):
+        attrs = nla_parse(msg, NLMSGHDR.size + NFGENMSG.size)
+        if CTA_TUPLE_ORIG not in attrs or CTA_TUPLE_REPLY not in attrs:
+            return None
+        return ConntrackEntry(self._parse_tuple(msg, *attrs[CTA_TUPLE_ORIG]),
+                              self._parse_tuple(msg, *attrs[CTA_TUPLE_REPLY]))
+
+    def _parse_tuple(self, msg, start, end):
+        src = dst = None
+        proto = sport = dport = 0
+        attrs = nla_parse(msg, start, end)
+        if CTA_TUPLE_IP in attrs:
+            ip_attrs = nla_parse(msg, *attrs[CTA_TUPLE_IP])
+            if CTA_IP_V4_SRC in ip_attrs:
+                src = socket.inet_ntop(socket.AF_INET, msg[slice(*ip_attrs[CTA_IP_V4_SRC])])
+            if CTA_IP_V4_DST in ip_attrs:
+                dst = socket.inet_ntop(socket.AF_INET, msg[slice(*ip_attrs[CTA_IP_V4_DST])])
+        if CTA_TUPLE_PROTO in attrs:
+            proto_attrs = nla_parse(msg, *attrs[CTA_TUPLE_PROTO])
+            if CTA_PROTO_NUM in proto_attrs:
+                proto = msg[proto_attrs[CTA_PROTO_NUM][0]]
+            if CTA_PROTO_SRC_PORT in proto_attrs:
+                sport, = struct.unpack_from('!H', msg, proto_attrs[CTA_PROTO_SRC_PORT][0])
+            if CTA_PROTO_DST_PORT in proto_attrs:
+                dport, = struct.unpack_from('!H', msg, proto_attrs[CTA_PROTO_DST_PORT][0])
+        # Keep the raw nested attribute to identify the entry in deletions
+        return ConntrackTuple(src, dst, proto, sport, dport, raw = msg[start:end])
+
+    @staticmethod
+    def _build_tuple(src, dst, proto, sport, dport):
+        """ Return the payload of a nested tuple attribute """
+        if isinstance(proto, str):
+            proto = PROTOCOLS[proto.upper()]
+        ip_attrs = nla(CTA_IP_V4_SRC, socket.inet_pton(socket.AF_INET, src)) + nla(CTA_IP_V4_DST, socket.inet_pton(socket.AF_INET, dst))
+        proto_attrs = nla(CTA_PROTO_NUM, struct.pack('B', proto)) + nla(CTA_PROTO_SRC_PORT, struct.pack('!H', sport)) + nla(CTA_PROTO_DST_PORT, struct.pack('!H', dport))
+        return nla(CTA_TUPLE_IP | NLA_F_NESTED, ip_attrs) + nla(CTA_TUPLE_PROTO | NLA_F_NESTED, proto_attrs)
+
+    def _delete_requests(self, items):
+        """ Return the number of entries deleted from a list of (CTA_TUPLE_ORIG|CTA_TUPLE_REPLY, tuple payload) """
+        requests = [self._build_request(IPCTNL_MSG_CT_DELETE, NLM_F_REQUEST | NLM_F_ACK, nla(direction | NLA_F_NESTED, payload))
+                    for direction, payload in items]
+        results = self._transact(requests)
+        return sum(1 for error in results.values() if error == 0)
+
+    def delete(self, entries):
+        """ Delete a list of ConntrackEntry and return the number of deleted entries """
+        return self._delete_requests([(CTA_TUPLE_ORIG, entry.orig.raw) for entry in entries])
+
+    def delete_tuples(self, tuples):
+        """
+        Delete entries matching exact tuples and return the number of deleted entries.
+        Tuples are (direction, src, dst, proto, sport, dport) with direction 'orig' or 'reply'.
+        """
+        items = []
+        for direction, src, dst, proto, sport, dport in tuples:
+            _direction = CTA_TUPLE_ORIG if direction == 'orig' else CTA_TUPLE_REPLY
+            items.append((_direction, self._build_tuple(src, dst, proto, sport, dport)))
+        return self._delete_requests(items)
+
+    def delete_by_filter(self, src = (), reply_src = (), family = socket.AF_INET):
+        """
+        Delete entries whose original source is in src or whose reply source is in reply_src,
+        as in conntrack -D --src / --reply-src, with a single table dump for all the addresses.
+        Return the number of deleted entries.
+        """
+        src, reply_src = set(src), set(reply_src)
+        if not src and not reply_src:
+            return 0
+        entries = [entry for entry in self.dump(family)
+                   if entry.orig.src in src or entry.reply.src in reply_src]
+        return self.delete(entries)
+
+
+if __name__ == '__main__':
+    # Requires CAP_NET_ADMIN
+    ct = Conntrack()
+    entries = ct.dump()
+    print('Found {} conntrack entries'.format(len(entries)))
+    for entry in entries[:10]:
+        print(entry)
@@ -0,0 +1,213 @@
+"""
+BSD 3-Clause License
+
+Copyright (c) 2018, Jesus Llorente Santos, Aalto University, Finland
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import collections
+import logging
+import struct
+import time
+
+import dns
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+
+
+def _skip_name(wire, offset):
+    """ Return the offset after a domain name in wire format """
+    while True:
+        length = wire[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            # Compression pointer ends the name
+            return offset + 2
+        offset += length + 1
+
+def _ttl_offsets(wire):
+    """ Return the list of (offset, ttl) of the resource records in wire format, except OPT """
+    qdcount, ancount, nscount, arcount = struct.unpack_from('!4H', wire, 4)
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_name(wire, offset) + 4
+    ttls = []
+    for _ in range(ancount + nscount + arcount):
+        offset = _skip_name(wire, offset)
+        rdtype, _, ttl, rdlength = struct.unpack_from('!HHIH', wire, offset)
+        if rdtype != dns.rdatatype.OPT:
+            ttls.append((offset + 4, ttl))
+        offset += 10 + rdlength
+    return ttls
+
+def question_key(query):
+    """ Return the key of the question of a query as (qname, qtype, qclass, EDNS, DO bit, CD and AD bits) """
+    q = query.question[0]
+    # Responses carry an OPT record and DNSSEC semantics that depend on the query, keep them apart
+    return (q.name.to_text().lower(), q.rdtype, q.rdclass, query.edns >= 0,
+            bool(query.ednsflags & dns.flags.DO), query.flags & (dns.flags.CD | dns.flags.AD))
+
+def adapt_wire(query, wire):
+    """ Return a copy of a response in wire format with the query ID and question name of the query """
+    wire = bytearray(wire)
+    struct.pack_into('!H', wire, 0, query.id)
+    # Preserve the letter case of the question name
+    qname = query.question[0].name.to_wire()
+    wire[12:12 + len(qname)] = qname
+    return wire
+
+def wire_fits(query, wire):
+    """ Return True if a response in wire format can be sent to the query over its transport """
+    if query.transport != 'udp':
+        # Truncated responses are only valid for UDP
+        return not wire[2] & dns.flags.TC >> 8
+    payload = query.payload if query.edns >= 0 else 512
+    return len(wire) <= max(512, payload)
+
+
+class _CacheEntry(object):
+    __slots__ = ('wire', 'ttls', 'timestamp', 'expires', 'size')
+
+    def __init__(self, wire, ttls, timestamp, ttl):
+        self.wire = wire
+        self.ttls = ttls
+        self.timestamp = timestamp
+        self.expires = timestamp + ttl
+        self.size = len(wire) + DNSCache.ENTRY_SIZE
+
+
+class DNSCache(object):
+    """
+    Answer cache of upstream DNS responses stored in wire format.
+
+    Entries are keyed by (qname, qtype, qclass, DO bit) and live for the lowest TTL of the answer,
+    or for the SOA minimum of negative answers (RFC 2308). Hits are served by rewriting the query ID,
+    the question name and the decremented TTLs in a copy of the wire data without re-serialization.
+    Expired entries are kept for serve-stale (RFC 8767) until evicted by the LRU memory bound.
+    """
+    # Estimated memory per entry besides the wire data (key, entry object and OrderedDict link)
+    ENTRY_SIZE = 256
+    # TTL of the records served stale
+    STALE_TTL = 30
+
+    def __init__(self, memory = 8 * 1024 * 1024, max_ttl = 86400, max_stale = 86400, name = 'DNSCache'):
+        """
+        @param memory: Memory budget in bytes.
+        @param max_ttl: Maximum time an entry is fresh in seconds.
+        @param max_stale: Maximum time an expired entry can be served stale in seconds.
+        """
+        self._logger = logging.getLogger(name)
+        self.memory = memory
+        self.max_ttl = max_ttl
+        self.max_stale = max_stale
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self.nofhits = 0
+        self.nofmisses = 0
+        self.nofstale = 0
+        self.nofevictions = 0
+
+    def _ttl(self, response):
+        """ Return the caching time of a response or None if it is not cacheable """
+        if response.flags & dns.flags.TC:
+            return None
+        rcode = response.rcode()
+        if rcode == dns.rcode.NOERROR and response.answer:
+            return min(rrset.ttl for rrset in response.answer)
+        if rcode in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+            # Negative answer, cache only with SOA in the authority section
+            for rrset in response.authority:
+                if rrset.rdtype == dns.rdatatype.SOA:
+                    return min(rrset.ttl, rrset[0].minimum)
+        return None
+
+    def put(self, query, response, now = None):
+        """ Cache the upstream response of a query """
+        ttl = self._ttl(response)
+        if not ttl:
+            return
+        now = time.time() if now is None else now
+        try:
+            wire = response.to_wire()
+            ttls = _ttl_offsets(wire)
+        except Exception as e:
+            self._logger.warning('Failed to cache DNS response: {}'.format(e))
+            return
+        key = question_key(query)
+        self._discard(key)
+        entry = _CacheEntry(wire, ttls, now, min(ttl, self.max_ttl))
+        self._entries[key] = entry
+        self._size += entry.size
+        while self._size > self.memory and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.size
+            self.nofevictions += 1
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry.size
+
+    def _render(self, query, entry, age, stale_ttl = None):
+        """ Return a copy of the wire data for the query with decremented TTLs """
+        wire = adapt_wire(query, entry.wire)
+        for offset, ttl in entry.ttls:
+            struct.pack_into('!I', wire, offset, stale_ttl if stale_ttl is not None else max(0, ttl - age))
+        return bytes(wire)
+
+    def get(self, query, now = None):
+        """ Return the wire response to a query from a fresh entry or None """
+        key = question_key(query)
+        entry = self._entries.get(key)
+        now = time.time() if now is None else now
+        if entry is None or now >= entry.expires or not wire_fits(query, entry.wire):
+            self.nofmisses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.nofhits += 1
+        return self._render(query, entry, int(now - entry.timestamp))
+
+    def get_stale(self, query, now = None):
+        """ Return the wire response to a query from an expired entry or None """
+        key = question_key(query)
+        entry = self._entries.get(key)
+        now = time.time() if now is None else now
+        if entry is None or now >= entry.expires + self.max_stale or not wire_fits(query, entry.wire):
+            return None
+        self.nofstale += 1
+        return self._render(query, entry, int(now - entry.timestamp), DNSCache.STALE_TTL)
+
+    def stats(self):
+        return {'entries': len(self._entries), 'memory': self._size,
+                'hits': self.nofhits, 'misses': self.nofmisses, 'stale': self.nofstale, 'evictions': self.nofevictions}
+
+    def __len__(self):
+        return len(self._entries)
@@ -86,7 +86,10 @@ class DNSProxy(asyncio.DatagramProtocol):
         return False
 
     def _send_msg(self, dnsmsg, addr):
-        self._transport.sendto(dnsmsg.to_wire(), addr)
+        # Cached responses are already in wire format
+        if not isinstance(dnsmsg, bytes):
+            dnsmsg = dnsmsg.to_wire()
+        self._transport.sendto(dnsmsg, addr)
 
     def _send_error(self, query, addr, rcode):
         response = dns.message.make_response(query, recursion_available=True)
@@ -151,7 +154,8 @@ class DNSTCPProxy(asyncio.Protocol):
         return False
 
     def _send_msg(self, dnsmsg, addr):
-        dnsmsg_b = dnsmsg.to_wire()
+        # Cached responses are already in wire format
+        dnsmsg_b = dnsmsg if isinstance(dnsmsg, bytes) else dnsmsg.to_wire()
         self._transport.write(struct.pack('!H', len(dnsmsg_b)) + dnsmsg_b)
 
     def _send_error(self, query, addr, rcode):
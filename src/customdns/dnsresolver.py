@@ -31,9 +31,13 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import asyncio
+import collections
+import errno
 import logging
 import time
 import socket
+import random
+import struct
 
 from customdns.dnsutils import *
 from helpers_n_wrappers.asyncio_helper3 import AsyncSocketQueue
@@ -206,19 +210,462 @@ class uDNSResolver():
         fqdn = format(query.question[0].name).lower()
         response = None
         i = 0
-        for tout in timeouts:
-            i += 1
-            try:
-                yield from self.asock.sendall(query.to_wire())
-                dataresponse = yield from asyncio.wait_for(self.asock.recv(), timeout=tout)
-                self.asock.close()
-                return dns.message.from_wire(dataresponse)
-            except asyncio.TimeoutError:
-                logger.debug('#{} timeout expired: {:.4f} sec ({})'.format(i, tout, fqdn))
-                continue
-        return None
+        try:
+            for tout in timeouts:
+                i += 1
+                try:
+                    yield from self.asock.sendall(query.to_wire())
+                    dataresponse = yield from asyncio.wait_for(self.asock.recv(), timeout=tout)
+                    return dns.message.from_wire(dataresponse)
+                except asyncio.TimeoutError:
+                    logger.debug('#{} timeout expired: {:.4f} sec ({})'.format(i, tout, fqdn))
+                    continue
+            return None
+        finally:
+            self.asock.close()
 
     @asyncio.coroutine
     def do_continue(self, query):
         loop = asyncio.get_event_loop()
         yield from self.asock.sendall(query.to_wire())
+
+
+# Linux socket options to receive ICMP errors on unconnected UDP sockets
+_IP_RECVERR = getattr(socket, 'IP_RECVERR', 11)
+_MSG_ERRQUEUE = getattr(socket, 'MSG_ERRQUEUE', 0x2000)
+_SOCK_EXTENDED_ERR = struct.Struct('=IBBBBII')
+
+class _uDNSSocket(object):
+    """ Long-lived unconnected UDP socket shared by the transactions of a uDNSResolverPool """
+    def __init__(self, pool, loop):
+        self._pool = pool
+        self._loop = loop
+        self.sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        # Queue ICMP errors such as port unreachable, unconnected sockets ignore them otherwise
+        try:
+            self.sock.setsockopt(socket.IPPROTO_IP, _IP_RECVERR, 1)
+        except OSError as e:
+            self._pool._logger.debug('Failed to enable IP_RECVERR: {}'.format(e))
+        # Bind to a random ephemeral port
+        self.sock.bind(('0.0.0.0', 0))
+        self.sockname = self.sock.getsockname()
+        # Indexes (upstream addr, upstream query id) to the pending transactions
+        self.pending = {}
+        self.uses = 0
+        self.draining = False
+        self._loop.add_reader(self.sock.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        # Drain all the queued datagrams
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self._pool._logger.debug('Socket {}:{} error: {}'.format(self.sockname[0], self.sockname[1], e))
+                self._on_error()
+                continue
+            if len(data) < 2:
+                continue
+            txn = self.pending.get((addr[:2], (data[0] << 8) | data[1]))
+            if txn is None:
+                # Late or unsolicited response
+                self._pool.nofunexpected += 1
+                continue
+            txn._response_received(data)
+
+    def _on_error(self):
+        # Fail the transactions whose upstream answered with ICMP port unreachable
+        while True:
+            try:
+                data, ancdata, _, addr = self.sock.recvmsg(512, 512, _MSG_ERRQUEUE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            ee_errno = None
+            for cmsg_level, cmsg_type, cmsg_data in ancdata:
+                if cmsg_level == socket.IPPROTO_IP and cmsg_type == _IP_RECVERR and len(cmsg_data) >= _SOCK_EXTENDED_ERR.size:
+                    ee_errno = _SOCK_EXTENDED_ERR.unpack_from(cmsg_data)[0]
+            # The error queue returns the payload of the datagram sent and its destination address
+            if ee_errno != errno.ECONNREFUSED or addr is None or len(data) < 2:
+                continue
+            txn = self.pending.get((addr[:2], (data[0] << 8) | data[1]))
+            if txn is not None:
+                txn._error_received(ConnectionRefusedError(errno.ECONNREFUSED, 'Connection refused by {}:{}'.format(addr[0], addr[1])))
+
+    def sendto(self, data, addr):
+        try:
+            self.sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            # Socket buffer is full, the retransmission schedule will send it again
+            self._pool._logger.debug('Socket {}:{} buffer full'.format(self.sockname[0], self.sockname[1]))
+
+    def close(self):
+        self._loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+
+class uDNSTransaction(object):
+    """ DNS query multiplexed over a uDNSResolverPool socket with a randomized query ID """
+    def __init__(self, pool, usock, qid, query, addr):
+        self._pool = pool
+        self._usock = usock
+        self.qid = qid
+        self.query = query
+        self.addr = addr
+        # Rewrite the query ID in the wire format
+        wire = bytearray(query.to_wire())
+        wire[0:2] = qid.to_bytes(2, 'big')
+        self._wire = bytes(wire)
+        self._future = pool._loop.create_future()
+        self._tref = time.time()
+
+    def _response_received(self, data):
+        if self._future.done():
+            return
+        try:
+            response = dns.message.from_wire(data)
+        except Exception as e:
+            self._pool._logger.warning('Failed to parse DNS response from {}:{}: {}'.format(self.addr[0], self.addr[1], e))
+            return
+        # Restore the query ID of the original query
+        response.id = self.query.id
+        if not self.query.is_response(response):
+            self._pool._logger.warning('Not a valid response for query {} from {}:{}'.format(self.query.id, self.addr[0], self.addr[1]))
+            return
+        self._future.set_result(response)
+
+    def _error_received(self, exc):
+        if self._future.done():
+            return
+        self._pool.nofrefused += 1
+        self._future.set_exception(exc)
+
+    def retransmit(self):
+        """ Forward a host retransmission of the query """
+        if not self._future.done():
+            self._usock.sendto(self._wire, self.addr)
+
+    @asyncio.coroutine
+    def resolve(self, timeouts=[0]):
+        """ Send the query following the retransmission schedule, return the response or None """
+        fqdn = format(self.query.question[0].name).lower()
+        try:
+            for i, tout in enumerate(timeouts, 1):
+                self._usock.sendto(self._wire, self.addr)
+                try:
+                    # A timeout of 0 waits for the response in blocking mode
+                    response = yield from asyncio.wait_for(asyncio.shield(self._future), timeout=tout or None)
+                    self._pool._logger.debug('Resolution succeeded {} via {}:{} in {:.3f} msec'.format(fqdn, self.addr[0], self.addr[1], (time.time() - self._tref) * 1000))
+                    return response
+                except asyncio.TimeoutError:
+                    self._pool._logger.debug('#{} timeout expired: {:.4f} sec ({})'.format(i, tout, fqdn))
+            self._pool.noftimeouts += 1
+            return None
+        finally:
+            self._pool._release(self)
+
+
+class uDNSResolverPool(object):
+    '''
+    # Multiplexes upstream queries over a small pool of long-lived sockets
+    pool = uDNSResolverPool(size=4)
+    response = yield from pool.do_resolve(query, raddr, timeouts=[1, 1, 1])
+    # Or keep the transaction for forwarding host retransmissions
+    txn = pool.transaction(query, raddr)
+    response = yield from txn.resolve(timeouts=[1, 1, 1])
+    '''
+    def __init__(self, size=4, max_uses=4096, loop=None):
+        """
+        @param size: Number of sockets.
+        @param max_uses: Number of transactions after which a socket is replaced by one on a new random port.
+        """
+        self._logger = logging.getLogger('uDNSResolverPool')
+        self._loop = loop or asyncio.get_event_loop()
+        self._random = random.SystemRandom()
+        self.size = size
+        self.max_uses = max_uses
+        self._sockets = []
+        self.noftransactions = 0
+        self.noftimeouts = 0
+        self.nofunexpected = 0
+        self.nofrefused = 0
+        # Replaced sockets waiting for their pending transactions to end
+        self._draining = set()
+
+    def _get_socket(self):
+        if len(self._sockets) < self.size:
+            usock = _uDNSSocket(self, self._loop)
+            self._sockets.append(usock)
+            return usock
+        return self._random.choice(self._sockets)
+
+    def transaction(self, query, addr):
+        """ Return a new uDNSTransaction for the query to the upstream addr """
+        usock = self._get_socket()
+        # Select a random query ID not in use towards the same upstream addr
+        addr = (addr[0], int(addr[1]))
+        qid = self._random.getrandbits(16)
+        while (addr, qid) in usock.pending:
+            qid = self._random.getrandbits(16)
+        txn = uDNSTransaction(self, usock, qid, query, addr)
+        usock.pending[(addr, qid)] = txn
+        usock.uses += 1
+        self.noftransactions += 1
+        if usock.uses >= self.max_uses and not usock.draining:
+            # Replace the socket, it is closed when its pending transactions end
+            usock.draining = True
+            self._sockets.remove(usock)
+            self._draining.add(usock)
+        return txn
+
+    def _release(self, txn):
+        usock = txn._usock
+        usock.pending.pop((txn.addr, txn.qid), None)
+        if usock.draining and not usock.pending and usock in self._draining:
+            self._draining.discard(usock)
+            usock.close()
+
+    def hedged_transaction(self, query, upstreams, hedging=True):
+        """ Return a new uDNSHedgedTransaction for the query to the best upstreams """
+        return uDNSHedgedTransaction(self, upstreams, query, hedging)
+
+    @asyncio.coroutine
+    def do_resolve(self, query, addr, timeouts=[0]):
+        txn = self.transaction(query, addr)
+        response = yield from txn.resolve(timeouts)
+        return response
+
+    def stats(self):
+        return {'sockets': len(self._sockets),
+                'pending': sum(len(usock.pending) for usock in self._sockets),
+                'transactions': self.noftransactions,
+                'timeouts': self.noftimeouts,
+                'unexpected': self.nofunexpected,
+                'refused': self.nofrefused}
+
+    def close(self):
+        for usock in self._sockets + list(self._draining):
+            for txn in list(usock.pending.values()):
+                txn._future.cancel()
+            usock.close()
+        self._sockets = []
+        self._draining.clear()
+
+
+class _uUpstreamStats(object):
+    __slots__ = ('addr', 'srtt', 'rttvar', 'failrate', 'samples', 'nofqueries', 'noffailures', 'nofhedged', 'noflost')
+
+    def __init__(self, addr, nofsamples):
+        self.addr = addr
+        self.srtt = None
+        self.rttvar = 0.0
+        self.failrate = 0.0
+        self.samples = collections.deque(maxlen=nofsamples)
+        self.nofqueries = 0
+        self.noffailures = 0
+        self.nofhedged = 0
+        self.noflost = 0
+
+
+class uDNSUpstreamSet(object):
+    '''
+    # Tracks the latency and failures of the upstream resolvers
+    upstreams = uDNSUpstreamSet()
+    upstreams.register(('8.8.8.8', 53))
+    addr = upstreams.select()
+    upstreams.report(addr, rtt) or upstreams.report_failure(addr, elapsed)
+    '''
+    # Smoothing factors of the RTT estimators (RFC 6298)
+    ALPHA = 0.125
+    BETA = 0.25
+    # Smoothing factor and score penalty of the failure rate
+    FAILURE_ALPHA = 0.1
+    FAILURE_PENALTY = 10
+
+    def __init__(self, percentile=0.95, nofsamples=128, hedge_delay=0.100, min_hedge_delay=0.005):
+        """
+        @param percentile: Percentile of the RTT samples of the upstream after which the query is hedged.
+        @param nofsamples: Number of recent RTT samples kept per upstream.
+        @param hedge_delay: Hedge delay of upstreams with no RTT estimation (sec).
+        @param min_hedge_delay: Minimum hedge delay (sec).
+        """
+        self._logger = logging.getLogger('uDNSUpstreamSet')
+        self._random = random.Random()
+        self._upstreams = collections.OrderedDict()
+        self.percentile = percentile
+        self.nofsamples = nofsamples
+        self.default_hedge_delay = hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+
+    def register(self, addr):
+        addr = (addr[0], int(addr[1]))
+        if addr not in self._upstreams:
+            self._upstreams[addr] = _uUpstreamStats(addr, self.nofsamples)
+
+    def _score(self, upstream):
+        if upstream.srtt is None:
+            # Probe upstreams with no RTT estimation first
+            return 0.0
+        return upstream.srtt * (1 + self.FAILURE_PENALTY * upstream.failrate)
+
+    def select(self, exclude=()):
+        """ Return the best of two random upstreams (power of two choices) or None """
+        candidates = [upstream for addr, upstream in self._upstreams.items() if addr not in exclude]
+        if not candidates:
+            return None
+        if len(candidates) == 1:
+            return candidates[0].addr
+        return min(self._random.sample(candidates, 2), key=self._score).addr
+
+    def _update_rtt(self, upstream, rtt):
+        if upstream.srtt is None:
+            upstream.srtt = rtt
+            upstream.rttvar = rtt / 2
+        else:
+            upstream.rttvar += self.BETA * (abs(upstream.srtt - rtt) - upstream.rttvar)
+            upstream.srtt += self.ALPHA * (rtt - upstream.srtt)
+        upstream.samples.append(rtt)
+
+    def _raise_rtt(self, upstream, elapsed):
+        # Update the RTT estimation with a lower bound sample, it never decreases
+        if elapsed > upstream.srtt:
+            upstream.rttvar += self.BETA * (elapsed - upstream.srtt - upstream.rttvar)
+            upstream.srtt += self.ALPHA * (elapsed - upstream.srtt)
+
+    def report(self, addr, rtt):
+        """ Account a successful resolution via addr """
+        upstream = self._upstreams.get(addr)
+        if upstream is None:
+            return
+        upstream.nofqueries += 1
+        upstream.failrate -= self.FAILURE_ALPHA * upstream.failrate
+        self._update_rtt(upstream, rtt)
+
+    def report_failure(self, addr, elapsed):
+        """ Account a failed resolution via addr, the elapsed time is a lower bound of its latency """
+        upstream = self._upstreams.get(addr)
+        if upstream is None:
+            return
+        upstream.nofqueries += 1
+        upstream.noffailures += 1
+        upstream.failrate += self.FAILURE_ALPHA * (1 - upstream.failrate)
+        if upstream.srtt is None:
+            # A fast failure such as a refused query must not make the upstream look fast
+            upstream.srtt = max(elapsed, self.default_hedge_delay)
+            upstream.rttvar = upstream.srtt / 2
+        else:
+            self._raise_rtt(upstream, elapsed)
+
+    def report_lost(self, addr, elapsed):
+        """ Account a resolution via addr cancelled after another upstream answered first.
+        The elapsed time is a lower bound of its latency, it can only raise the RTT estimation. """
+        upstream = self._upstreams.get(addr)
+        if upstream is None:
+            return
+        upstream.noflost += 1
+        if upstream.srtt is not None:
+            self._raise_rtt(upstream, elapsed)
+
+    def report_hedged(self, addr):
+        upstream = self._upstreams.get(addr)
+        if upstream is not None:
+            upstream.nofhedged += 1
+
+    def hedge_delay(self, addr):
+        """ Return the time after which a query to addr is duplicated to another upstream """
+        upstream = self._upstreams.get(addr)
+        if upstream is None or upstream.srtt is None:
+            return self.default_hedge_delay
+        if len(upstream.samples) < 16:
+            # Too few samples for the percentile, use the retransmission timeout estimation
+            delay = upstream.srtt + 4 * upstream.rttvar
+        else:
+            samples = sorted(upstream.samples)
+            delay = samples[int(self.percentile * (len(samples) - 1))]
+        return max(delay, self.min_hedge_delay)
+
+    def stats(self):
+        return {'{}:{}'.format(*addr): {'srtt': upstream.srtt, 'failrate': upstream.failrate,
+                                         'queries': upstream.nofqueries, 'failures': upstream.noffailures,
+                                         'hedged': upstream.nofhedged, 'lost': upstream.noflost}
+                for addr, upstream in self._upstreams.items()}
+
+    def __len__(self):
+        return len(self._upstreams)
+
+
+class uDNSHedgedTransaction(object):
+    """ DNS query to the best upstream duplicated to a second upstream when the first one is slow """
+    def __init__(self, pool, upstreams, query, hedging=True):
+        self._pool = pool
+        self._upstreams = upstreams
+        self.query = query
+        self.hedging = hedging
+        self.addr = upstreams.select()
+        self._transactions = []
+        self._settled = False
+        self._nofrefused = 0
+
+    def retransmit(self):
+        """ Forward a host retransmission of the query to all the upstreams queried """
+        for txn in self._transactions:
+            txn.retransmit()
+
+    @asyncio.coroutine
+    def _attempt(self, addr, timeouts):
+        txn = self._pool.transaction(self.query, addr)
+        self._transactions.append(txn)
+        tref = time.time()
+        try:
+            response = yield from txn.resolve(timeouts)
+        except asyncio.CancelledError:
+            if self._settled:
+                # Lost the race, this is not a successful resolution
+                self._upstreams.report_lost(txn.addr, time.time() - tref)
+            raise
+        except ConnectionRefusedError:
+            self._nofrefused += 1
+            self._upstreams.report_failure(txn.addr, time.time() - tref)
+            return None
+        if response:
+            self._settled = True
+            self._upstreams.report(txn.addr, time.time() - tref)
+        else:
+            self._upstreams.report_failure(txn.addr, time.time() - tref)
+        return response
+
+    @asyncio.coroutine
+    def resolve(self, timeouts=[0]):
+        """ Resolve the query via the selected upstream and hedge after its expected latency, return the response or None """
+        loop = self._pool._loop
+        primary = loop.create_task(self._attempt(self.addr, timeouts))
+        pending = {primary}
+        try:
+            secondary = self._upstreams.select(exclude=(self.addr,)) if self.hedging else None
+            if secondary is not None:
+                delay = self._upstreams.hedge_delay(self.addr)
+                if timeouts[0]:
+                    # Do not hedge later than the first retransmission
+                    delay = min(delay, timeouts[0])
+                yield from asyncio.wait(pending, timeout=delay)
+                if not primary.done() or primary.result() is None:
+                    self._pool._logger.debug('Hedging query {} via {}:{} after {:.3f} msec'.format(self.query.id, secondary[0], secondary[1], delay * 1000))
+                    self._upstreams.report_hedged(self.addr)
+                    pending.add(loop.create_task(self._attempt(secondary, timeouts)))
+            while pending:
+                done, pending = yield from asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    response = task.result()
+                    if response:
+                        return response
+            if self._nofrefused == len(self._transactions):
+                # Every upstream queried answered with ICMP port unreachable
+                raise ConnectionRefusedError(errno.ECONNREFUSED, 'Connection refused by {}:{}'.format(self.addr[0], self.addr[1]))
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
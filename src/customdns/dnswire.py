@@ -0,0 +1,214 @@
+"""
+BSD 3-Clause License
+
+Copyright (c) 2018, Jesus Llorente Santos, Aalto University, Finland
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import collections
+import socket
+import struct
+
+import dns
+import dns.flags
+import dns.name
+import dns.rdatatype
+
+from customdns import dnsutils
+
+# Compression pointer to the question name at the end of the 12-byte header
+_QNAME_POINTER = b'\xc0\x0c'
+# EDNS0 Padding option (RFC 7830) triggers padded responses in dnspython
+_EDNS_PADDING = 12
+# Opcode bits of the header flags
+_OPCODE_MASK = 0x7800
+
+
+def _encode_rr(name, rdtype, ttl, rdata):
+    """ Return the wire format of a class IN resource record with an encoded name """
+    return name + struct.pack('!HHIH', rdtype, 1, ttl, len(rdata)) + rdata
+
+def _encode_a_header(name, ttl):
+    """ Return the wire format of a class IN A record without the 4-byte address """
+    return name + struct.pack('!HHIH', dns.rdatatype.A, 1, ttl, 4)
+
+
+class WireResponseBuilder(object):
+    '''
+    # Builds single-answer DNS responses from pre-encoded templates
+    builder = WireResponseBuilder()
+    response = builder.make_response_a(query, 'host.domain.', '1.2.3.4', ttl=0)
+    response = builder.make_response_srv(query, 'host.domain.', 10, 100, 80, '_80._6.host.domain.', '1.2.3.4', ttl=0)
+    response = builder.make_response_txt(query, 'host.domain.', 'some.text', '1.2.3.4', ttl=0)
+
+    The answer names compress to the question name and the records after the answer are
+    encoded once per template, so building a response only writes the header, echoes the
+    question and appends the IPv4 address. The wire data matches dnsutils.make_response_answer_rr,
+    which remains the fallback for queries that need dnspython (TSIG, EDNS padding, other names).
+    '''
+    # Payload advertised in the OPT record as in dns.message.make_response
+    OUR_PAYLOAD = 8192
+
+    def __init__(self, maxsize = 4096):
+        """
+        @param maxsize: Maximum number of templates kept in LRU order.
+        """
+        self.maxsize = maxsize
+        self._templates = collections.OrderedDict()
+        # Root name, type OPT, class is the payload, TTL holds the extended flags, no options
+        self._opt = struct.pack('!BHHIH', 0, dns.rdatatype.OPT, self.OUR_PAYLOAD, 0, 0)
+        self.nofwire = 0
+        self.noffallback = 0
+
+    def _supported(self, query, name):
+        """ Return True if the query can be answered from a template """
+        if query.had_tsig or len(query.question) != 1:
+            return False
+        if query.edns >= 0 and any(option.otype == _EDNS_PADDING for option in query.options):
+            return False
+        # The answer name must be the question name for the compression pointer
+        fqdn = getattr(query, 'fqdn', None) or format(query.question[0].name).lower()
+        return fqdn == name.lower()
+
+    def _template(self, key, factory, *args):
+        template = self._templates.get(key)
+        if template is None:
+            template = factory(*args)
+            self._templates[key] = template
+            if len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+        else:
+            self._templates.move_to_end(key)
+        return template
+
+    def _build(self, query, template, ipv4):
+        """ Return the wire response of the query with the template and the IPv4 address """
+        body, ancount, arcount = template
+        q = query.question[0]
+        flags = dns.flags.QR | (query.flags & (dns.flags.RD | _OPCODE_MASK))
+        if query.edns >= 0:
+            arcount += 1
+            opt = self._opt
+        else:
+            opt = b''
+        self.nofwire += 1
+        return b''.join((struct.pack('!6H', query.id, flags, 1, ancount, 0, arcount),
+                         q.name.to_wire(), struct.pack('!HH', q.rdtype, q.rdclass),
+                         body, socket.inet_aton(ipv4), opt))
+
+    def _new_template_a(self, ttl):
+        return (_encode_a_header(_QNAME_POINTER, ttl), 1, 0)
+
+    def _new_template_srv(self, name, priority, weight, port, target, ttl):
+        target = dns.name.from_text(target)
+        # SRV target is not compressed (RFC 2782)
+        rdata = struct.pack('!HHH', int(priority), int(weight), int(port)) + target.to_wire()
+        # Additional A record of the target, compressed to the question name
+        prefix = b''.join(struct.pack('!B', len(label)) + label for label in target.relativize(dns.name.from_text(name)).labels)
+        return (_encode_rr(_QNAME_POINTER, dns.rdatatype.SRV, ttl, rdata) + _encode_a_header(prefix + _QNAME_POINTER, ttl), 1, 1)
+
+    def _new_template_txt(self, text, ttl):
+        data = text.encode()
+        rdata = struct.pack('!B', len(data)) + data
+        # Additional A record of the question name
+        return (_encode_rr(_QNAME_POINTER, dns.rdatatype.TXT, ttl, rdata) + _encode_a_header(_QNAME_POINTER, ttl), 1, 1)
+
+    def make_response_a(self, query, name, ipv4, ttl = 60):
+        """ Return the response with an A record for the question name """
+        if not self._supported(query, name):
+            self.noffallback += 1
+            return dnsutils.make_response_answer_rr(query, name, dns.rdatatype.A, ipv4, rdclass=1, ttl=ttl)
+        template = self._template((dns.rdatatype.A, ttl), self._new_template_a, ttl)
+        return self._build(query, template, ipv4)
+
+    def make_response_srv(self, query, name, priority, weight, port, target, ipv4, ttl = 60):
+        """ Return the response with an SRV record for the question name and an additional A record for the target """
+        if not self._supported(query, name) or not target.lower().endswith('.' + name.lower()):
+            self.noffallback += 1
+            srv_rrset = '{} {} {} {}'.format(priority, weight, port, target)
+            response = dnsutils.make_response_answer_rr(query, name, dns.rdatatype.SRV, srv_rrset, rdclass=1, ttl=ttl)
+            response.additional = dnsutils.make_response_answer_rr(query, target, dns.rdatatype.A, ipv4, rdclass=1, ttl=ttl).answer
+            return response
+        key = (dns.rdatatype.SRV, name, priority, weight, port, target, ttl)
+        template = self._template(key, self._new_template_srv, name, priority, weight, port, target, ttl)
+        return self._build(query, template, ipv4)
+
+    def make_response_txt(self, query, name, text, ipv4, ttl = 60):
+        """ Return the response with a TXT record for the question name and an additional A record for the question name """
+        # Text is a single character-string without quotes, escapes or whitespace
+        if not self._supported(query, name) or len(text) > 255 or not text.isprintable() or any(c in text for c in ' "\\;()'):
+            self.noffallback += 1
+            response = dnsutils.make_response_answer_rr(query, name, dns.rdatatype.TXT, text, rdclass=1, ttl=ttl)
+            response.additional = dnsutils.make_response_answer_rr(query, name, dns.rdatatype.A, ipv4, rdclass=1, ttl=ttl).answer
+            return response
+        template = self._template((dns.rdatatype.TXT, text, ttl), self._new_template_txt, text, ttl)
+        return self._build(query, template, ipv4)
+
+    def stats(self):
+        return {'templates': len(self._templates), 'wire': self.nofwire, 'fallback': self.noffallback}
+
+
+if __name__ == "__main__":
+    import time
+    import dns.message
+
+    builder = WireResponseBuilder()
+    fqdn = 'test103.nest0.gwa.cesproto.re2ee.org.'
+    sfqdn = '_80._6.{}'.format(fqdn)
+    txt = 'proxy_False.port_80.protocol_6.{}'.format(fqdn)
+    query = dns.message.make_query(fqdn.upper(), dns.rdatatype.A, use_edns=0)
+    query.fqdn = fqdn
+
+    def reference_a():
+        return dnsutils.make_response_answer_rr(query, fqdn, dns.rdatatype.A, '100.64.1.130', rdclass=1, ttl=0).to_wire()
+
+    def reference_srv():
+        response = dnsutils.make_response_answer_rr(query, fqdn, dns.rdatatype.SRV, '10 100 80 {}'.format(sfqdn), rdclass=1, ttl=0)
+        response.additional = dnsutils.make_response_answer_rr(query, sfqdn, dns.rdatatype.A, '100.64.1.130', rdclass=1, ttl=0).answer
+        return response.to_wire()
+
+    def reference_txt():
+        response = dnsutils.make_response_answer_rr(query, fqdn, dns.rdatatype.TXT, txt, rdclass=1, ttl=0)
+        response.additional = dnsutils.make_response_answer_rr(query, fqdn, dns.rdatatype.A, '100.64.1.130', rdclass=1, ttl=0).answer
+        return response.to_wire()
+
+    tests = [('A', lambda: builder.make_response_a(query, fqdn, '100.64.1.130', ttl=0), reference_a),
+             ('SRV', lambda: builder.make_response_srv(query, fqdn, 10, 100, 80, sfqdn, '100.64.1.130', ttl=0), reference_srv),
+             ('TXT', lambda: builder.make_response_txt(query, fqdn, txt, '100.64.1.130', ttl=0), reference_txt)]
+
+    N = 20000
+    for rdtype, f_wire, f_reference in tests:
+        assert f_wire() == f_reference(), 'Template mismatch for {}'.format(rdtype)
+        results = []
+        for f in (f_reference, f_wire):
+            t0 = time.perf_counter()
+            for _ in range(N):
+                f()
+            results.append(N / (time.perf_counter() - t0))
+        print('{:<4} dnspython: {:>9.0f} answers/s\ttemplate: {:>9.0f} answers/s\tspeedup: {:.1f}x'.format(rdtype, results[0], results[1], results[1] / results[0]))
+    print(builder.stats())
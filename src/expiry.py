@@ -0,0 +1,128 @@
+"""
+BSD 3-Clause License
+
+Copyright (c) 2018, Jesus Llorente Santos, Aalto University, Finland
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import heapq
+import itertools
+import logging
+import time
+
+from helpers_n_wrappers import container3
+
+
+class ExpiryContainer(container3.Container):
+    """
+    Container that keeps an expiry-ordered index of its nodes.
+
+    Nodes exposing a timestamp_eol attribute are pushed into a min-heap on add().
+    Removed nodes are invalidated lazily and discarded when they reach the top
+    of the heap, so pop_expired() costs O(k log n) for k expired nodes instead
+    of a full scan calling hasexpired() on every node.
+    """
+    def __init__(self, name='ExpiryContainer', **kwargs):
+        """ Initialize as a Container """
+        super().__init__(name, **kwargs)
+        self._expiry_heap = []          # Stores [timestamp_eol, seq, node] entries
+        self._expiry_entries = {}       # Indexes node ids to heap entries
+        self._expiry_seq = itertools.count()
+
+    def add(self, node):
+        super().add(node)
+        timestamp_eol = getattr(node, 'timestamp_eol', None)
+        if timestamp_eol is None:
+            return
+        entry = [timestamp_eol, next(self._expiry_seq), node]
+        self._expiry_entries[id(node)] = entry
+        heapq.heappush(self._expiry_heap, entry)
+
+    def remove(self, node, callback=True):
+        # Invalidate the heap entry before the delete callback is evaluated
+        entry = self._expiry_entries.pop(id(node), None)
+        if entry is not None:
+            entry[-1] = None
+        super().remove(node, callback)
+
+    def removeall(self, callback=True):
+        super().removeall(callback)
+        self._expiry_heap.clear()
+        self._expiry_entries.clear()
+
+    def peek_expiry(self):
+        """ Return the earliest timestamp_eol of the indexed nodes or None """
+        heap = self._expiry_heap
+        while heap and heap[0][-1] is None:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return heap[0][0]
+
+    def pop_expired(self, now=None, callback=True):
+        """
+        Remove and return the list of nodes whose timestamp_eol is older than now.
+
+        @param now: Reference timestamp, defaults to time.time().
+        @param callback: If activated, evaluate the delete callback of the nodes.
+        @return: A list of the removed nodes.
+        """
+        if now is None:
+            now = time.time()
+        heap = self._expiry_heap
+        expired = []
+        while heap and (heap[0][-1] is None or heap[0][0] < now):
+            timestamp_eol, _, node = heapq.heappop(heap)
+            if node is None:
+                # Node was already removed from the container
+                continue
+            self.remove(node, callback)
+            expired.append(node)
+        return expired
+
+    def stats_expiry(self):
+        """ Return a tuple of (indexed nodes / heap entries) """
+        return (len(self._expiry_entries), len(self._expiry_heap))
+
+
+if __name__ == "__main__":
+    class _Node(container3.ContainerNode):
+        def __init__(self, name, timeout):
+            super().__init__(name)
+            self.timestamp_eol = time.time() + timeout
+        def hasexpired(self):
+            return time.time() > self.timestamp_eol
+
+    ct = ExpiryContainer()
+    nodes = [_Node('n{}'.format(i), i * 0.1) for i in range(10)]
+    for n in nodes:
+        ct.add(n)
+    ct.remove(nodes[3])
+    time.sleep(0.45)
+    print(ct.pop_expired())
+    print(ct, ct.stats_expiry(), ct.peek_expiry())
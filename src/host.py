@@ -45,10 +45,84 @@ KEY_SERVICE_CIRCULARPOOL = 'CIRCULARPOOL'
 KEY_SERVICE_FIREWALL = 'FIREWALL'
 KEY_SERVICE_CARRIERGRADE = 'CARRIERGRADE'
 
+class _SuffixTrie(object):
+    """ Trie of reversed FQDN labels that maps SFQDN services to their (host, service_data) """
+    def __init__(self):
+        # Each trie node is a list of [children, value]
+        self._root = [{}, None]
+
+    def _labels(self, fqdn):
+        return reversed(fqdn.split('.'))
+
+    def add(self, fqdn, value):
+        node = self._root
+        for label in self._labels(fqdn):
+            node = node[0].setdefault(label, [{}, None])
+        node[1] = value
+
+    def remove(self, fqdn):
+        # Walk the trie and prune the branch of empty nodes
+        path = []
+        node = self._root
+        for label in self._labels(fqdn):
+            if label not in node[0]:
+                return
+            path.append((node, label))
+            node = node[0][label]
+        node[1] = None
+        for parent, label in reversed(path):
+            child = parent[0][label]
+            if child[0] or child[1] is not None:
+                break
+            del parent[0][label]
+
+    def longest_parent(self, fqdn):
+        """ Return the value of the longest entry that the FQDN is a subdomain of """
+        labels = fqdn.split('.')
+        value = None
+        node = self._root
+        # Exclude the first label as the FQDN must be nested under the entry
+        for i in range(len(labels) - 1, 0, -1):
+            node = node[0].get(labels[i])
+            if node is None:
+                break
+            if node[1] is not None:
+                value = node[1]
+        return value
+
+
 class HostTable(container3.Container):
     def __init__(self, name='HostTable'):
         """ Initialize as a Container """
         super().__init__(name)
+        # Index SFQDN services in a suffix trie for delegated-FQDN lookups
+        self._sfqdn_trie = _SuffixTrie()
+        self._sfqdn_indexed = {}
+
+    def _index_services(self, node):
+        fqdns = []
+        for service_data in node.services[KEY_SERVICE_SFQDN]:
+            self._sfqdn_trie.add(service_data['fqdn'], (node, service_data))
+            fqdns.append(service_data['fqdn'])
+        self._sfqdn_indexed[id(node)] = fqdns
+
+    def _unindex_services(self, node):
+        for fqdn in self._sfqdn_indexed.pop(id(node), []):
+            self._sfqdn_trie.remove(fqdn)
+
+    def add(self, node):
+        super().add(node)
+        self._index_services(node)
+
+    def remove(self, node, callback=True):
+        self._unindex_services(node)
+        super().remove(node, callback)
+
+    def updatekeys(self, node):
+        super().updatekeys(node)
+        # Services may have been added or removed
+        self._unindex_services(node)
+        self._index_services(node)
 
     def has_carriergrade(self, fqdn):
         """ Return True if the FQDN exists for a host defined as carrier grade """
@@ -60,16 +134,14 @@ class HostTable(container3.Container):
                 self._logger.debug('Host has KEY_SERVICE_CARRIERGRADE for FQDN {}'.format(fqdn))
             return service_data['carriergrade']
 
-        # 2. Check host list and check if FQDN is a subdomain of one of our hosts' services
-        for host in self.getall():
-            for service_data in host.services[KEY_SERVICE_SFQDN]:
-                nstoken = '.{}'.format(service_data['fqdn'])
-                if not fqdn.endswith(nstoken):
-                    continue
-                # The given FQDN is nested under the current service_data
-                if service_data['carriergrade']:
-                    self._logger.debug('Host has KEY_SERVICE_CARRIERGRADE for delegated-FQDN {}'.format(fqdn))
-                return service_data['carriergrade']
+        # 2. Check if FQDN is a subdomain of one of our hosts' services (longest match)
+        data = self._sfqdn_trie.longest_parent(fqdn)
+        if data is not None:
+            host, service_data = data
+            # The given FQDN is nested under the current service_data
+            if service_data['carriergrade']:
+                self._logger.debug('Host has KEY_SERVICE_CARRIERGRADE for delegated-FQDN {}'.format(fqdn))
+            return service_data['carriergrade']
         return False
 
     def get_carriergrade(self, fqdn):
@@ -82,16 +154,14 @@ class HostTable(container3.Container):
                 self._logger.debug('Host has KEY_SERVICE_CARRIERGRADE for FQDN {}'.format(fqdn))
             return (host,service_data)
 
-        # 2. Check host list and check if FQDN is a subdomain of one of our hosts' services
-        for host in self.getall():
-            for service_data in host.services[KEY_SERVICE_SFQDN]:
-                nstoken = '.{}'.format(service_data['fqdn'])
-                if not fqdn.endswith(nstoken):
-                    continue
-                # The given FQDN is nested under the current service_data
-                if service_data['carriergrade']:
-                    self._logger.debug('Host has KEY_SERVICE_CARRIERGRADE for delegated-FQDN {}'.format(fqdn))
-                return (host,service_data)
+        # 2. Check if FQDN is a subdomain of one of our hosts' services (longest match)
+        data = self._sfqdn_trie.longest_parent(fqdn)
+        if data is not None:
+            host, service_data = data
+            # The given FQDN is nested under the current service_data
+            if service_data['carriergrade']:
+                self._logger.debug('Host has KEY_SERVICE_CARRIERGRADE for delegated-FQDN {}'.format(fqdn))
+            return (host,service_data)
         return None
 
     def show(self):
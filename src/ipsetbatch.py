@@ -0,0 +1,144 @@
+"""
+BSD 3-Clause License
+
+Copyright (c) 2018, Jesus Llorente Santos, Aalto University, Finland
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import contextlib
+import logging
+import re
+import subprocess
+
+from helpers_n_wrappers import iproute2_helper3
+
+
+class IPSetBatch(object):
+    """
+    Batching ipset client.
+
+    Operations issued within batch() are accumulated and committed at the end of the
+    outermost batch through a single 'ipset -exist restore' stream. Operations issued
+    outside a batch are executed immediately via netlink. In both cases adding an existing
+    entry or deleting a missing one is not an error, so no prior test is required.
+    """
+    def __init__(self, name = 'IPSetBatch', command = 'ipset', max_pending = 65536):
+        self._logger = logging.getLogger(name)
+        self.command = command
+        self.max_pending = max_pending
+        self._pending = []
+        self._depth = 0
+        self._sets = None
+        # Counters
+        self.nofcommits = 0
+        self.nofops = 0
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ Accumulate operations until the outermost batch is closed """
+        self._depth += 1
+        try:
+            yield self
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                self.commit()
+
+    def exists(self, name):
+        """ Return True if the ipset exists, the names are cached after the first query """
+        if self._sets is None:
+            self._sets = set(x.get_attr('IPSET_ATTR_SETNAME') for x in iproute2_helper3.ipset_list())
+        return name in self._sets
+
+    def create(self, name, stype = 'hash:ip'):
+        self._enqueue('create', name, stype)
+        if self._sets is not None:
+            self._sets.add(name)
+
+    def flush(self, name):
+        self._enqueue('flush', name)
+
+    def add(self, name, entry, etype = 'ip'):
+        self._enqueue('add', name, self._format_entry(entry, etype), etype)
+
+    def delete(self, name, entry, etype = 'ip'):
+        self._enqueue('del', name, self._format_entry(entry, etype), etype)
+
+    @staticmethod
+    def _format_entry(entry, etype):
+        if etype == 'ip':
+            entry = entry.split('/')[0]
+        return entry
+
+    def _enqueue(self, cmd, name, arg = None, etype = None):
+        self.nofops += 1
+        if self._depth == 0:
+            self._execute(cmd, name, arg, etype)
+            return
+        self._pending.append(' '.join(x for x in (cmd, name, arg) if x is not None))
+        if len(self._pending) >= self.max_pending:
+            self.commit()
+
+    def _execute(self, cmd, name, arg, etype):
+        # Execute a single operation via netlink
+        try:
+            if cmd == 'create':
+                if not iproute2_helper3.ipset_exists(name):
+                    iproute2_helper3.ipset_create(name, arg)
+            elif cmd == 'flush':
+                iproute2_helper3.ipset_flush(name)
+            elif cmd == 'add' and not iproute2_helper3.ipset_test(name, arg, etype = etype):
+                iproute2_helper3.ipset_add(name, arg, etype = etype)
+            elif cmd == 'del' and iproute2_helper3.ipset_test(name, arg, etype = etype):
+                iproute2_helper3.ipset_delete(name, arg, etype = etype)
+        except Exception as e:
+            self._logger.error('Failed to {} {} {} / {}'.format(cmd, name, arg, e))
+
+    def commit(self):
+        """ Commit pending operations and return the number of failed operations """
+        lines, self._pending = self._pending, []
+        failed = 0
+        while lines:
+            self.nofcommits += 1
+            p = subprocess.run([self.command, '-exist', 'restore'], input = '\n'.join(lines) + '\n',
+                               stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True)
+            if p.returncode == 0:
+                break
+            # ipset restore stops at the first failed line, skip it and resume with the rest
+            m = re.search(r'line (\d+)', p.stderr)
+            if m is None:
+                self._logger.error('Failed to commit {} operations / {}'.format(len(lines), p.stderr.strip()))
+                return failed + len(lines)
+            n = int(m.group(1))
+            self._logger.error('Failed to commit <{}> / {}'.format(lines[n - 1], p.stderr.strip()))
+            failed += 1
+            lines = lines[n:]
+        return failed
+
+    def stats(self):
+        return 'nofops {} / nofcommits {} / pending {}'.format(self.nofops, self.nofcommits, len(self._pending))
@@ -0,0 +1,87 @@
+"""
+BSD 3-Clause License
+
+Copyright (c) 2018, Jesus Llorente Santos, Aalto University, Finland
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import struct
+
+
+# Netlink constants
+NETLINK_NETFILTER = 12
+NLMSG_ERROR       = 0x2
+NLMSG_DONE        = 0x3
+NLM_F_REQUEST     = 0x001
+NLM_F_MULTI       = 0x002
+NLM_F_ACK         = 0x004
+NLM_F_DUMP        = 0x300
+NLA_F_NESTED      = 0x8000
+NLA_TYPE_MASK     = 0x3FFF
+
+NLMSGHDR = struct.Struct('=IHHII')
+NFGENMSG = struct.Struct('!BBH')
+NLATTR   = struct.Struct('=HH')
+
+
+def nla(nla_type, payload):
+    """ Return a netlink attribute with padding """
+    data = NLATTR.pack(NLATTR.size + len(payload), nla_type) + payload
+    return data + b'\x00' * (-len(data) % 4)
+
+def nla_parse(data, offset = 0, end = None):
+    """ Return a dictionary of netlink attributes type -> (start, end) of the payload """
+    attrs = {}
+    end = len(data) if end is None else end
+    while offset + NLATTR.size <= end:
+        nla_len, nla_type = NLATTR.unpack_from(data, offset)
+        if nla_len < NLATTR.size:
+            break
+        attrs[nla_type & NLA_TYPE_MASK] = (offset + NLATTR.size, offset + nla_len)
+        offset += (nla_len + 3) & ~3
+    return attrs
+
+def nlmsg_build(nlmsg_type, flags, seq, family, res_id, payload = b''):
+    """ Return a netfilter netlink message """
+    body = NFGENMSG.pack(family, 0, res_id) + payload
+    return NLMSGHDR.pack(NLMSGHDR.size + len(body), nlmsg_type, flags, seq, 0) + body
+
+def nlmsg_iter(data):
+    """ Generator of (type, flags, seq, message) of the netlink messages in a buffer """
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        nlmsg_len, nlmsg_type, nlmsg_flags, nlmsg_seq, _ = NLMSGHDR.unpack_from(data, offset)
+        if nlmsg_len < NLMSGHDR.size:
+            break
+        yield (nlmsg_type, nlmsg_flags, nlmsg_seq, data[offset:offset + nlmsg_len])
+        offset += (nlmsg_len + 3) & ~3
+
+def nlmsg_error(msg):
+    """ Return the positive errno of an NLMSG_ERROR message, 0 for an acknowledgement """
+    error, = struct.unpack_from('=i', msg, NLMSGHDR.size)
+    return -error
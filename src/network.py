@@ -32,6 +32,7 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import asyncio
 import aiohttp
+import collections
 import json
 import logging
 import functools
@@ -48,6 +49,9 @@ from helpers_n_wrappers import aiohttp_client
 from helpers_n_wrappers import nfqueue3
 
 from global_variables import RUNNING_TASKS
+from conntrack import Conntrack
+from ipsetbatch import IPSetBatch
+from nfqworker import NFQueueWorker
 
 # Definition of PACKET MARKS
 ## Definition of specific packet MARK for traffic
@@ -109,6 +113,12 @@ class Network(object):
         self.loop = asyncio.get_event_loop()
         # Initialize nfqueues list
         self._nfqueues = []
+        # Create conntrack client and set of addresses pending deletion
+        self.conntrack = Conntrack()
+        self._conntrack_pending = set()
+        self._conntrack_handle = None
+        # Create batching ipset client
+        self.ipset = IPSetBatch()
         # Configure MARKDNAT
         self._setup_MARKDNAT()
         # Flushing
@@ -135,28 +145,28 @@ class Network(object):
         self.rest_api_close()
         # Close SYNPROXY socket
         self.synproxy_close()
+        # Close conntrack netlink socket
+        self.conntrack.close()
 
     def ips_init(self):
         data_d = self.datarepository.get_policy_ces('IPSET', {})
         requires = data_d.setdefault('requires', [])
         rules = data_d.setdefault('rules', [])
         self._logger.info('Installing local ipset policy: {} requirements and {} rules'.format(len(requires), len(rules)))
-        # Install requirements
-        for i, entry in enumerate(requires):
-            self._logger.debug('#{} requires {} {}'.format(i+1, entry['name'], entry['type']))
-            if entry.setdefault('create',False) and not iproute2_helper3.ipset_exists(entry['name']):
-                iproute2_helper3.ipset_create(entry['name'], entry['type'])
-            if entry.setdefault('flush',False):
-                iproute2_helper3.ipset_flush(entry['name'])
-        # Populate ipsets
-        for entry in rules:
-            self._logger.debug('Adding {} items to {} type {}'.format(len(entry['items']), entry['name'], entry['type']))
-            for i, e in enumerate(entry['items']):
-                try:
-                    self._logger.debug('#{} Adding {}'.format(i+1, e))
-                    iproute2_helper3.ipset_add(entry['name'], e, etype=entry['type'])
-                except:
-                    self._logger.error('#{} Failed to add {}'.format(i+1, e))
+        # Install requirements and populate ipsets in a single batch
+        with self.ipset.batch():
+            for i, entry in enumerate(requires):
+                self._logger.debug('#{} requires {} {}'.format(i+1, entry['name'], entry['type']))
+                if entry.setdefault('create',False):
+                    self.ipset.create(entry['name'], entry['type'])
+                if entry.setdefault('flush',False):
+                    self.ipset.flush(entry['name'])
+            # Populate ipsets
+            for entry in rules:
+                self._logger.debug('Adding {} items to {} type {}'.format(len(entry['items']), entry['name'], entry['type']))
+                for e in entry['items']:
+                    self.ipset.add(entry['name'], e, etype=entry['type'])
+        self._logger.info('Installed local ipset policy / {}'.format(self.ipset.stats()))
 
     def ipt_init(self):
         data_d = self.datarepository.get_policy_ces('IPTABLES', {})
@@ -185,10 +195,11 @@ class Network(object):
 
     def _do_flushing(self):
         # Flush conntrack
-        if self._do_subprocess_call('conntrack -F', False, False):
+        try:
+            self.conntrack.flush()
             self._logger.info('Successfully flushed connection tracking information')
-        else:
-            self._logger.warning('Failed to flush connection tracking information')
+        except Exception as e:
+            self._logger.warning('Failed to flush connection tracking information / {}'.format(e))
 
         # Flush iptables & ipset
         if self.ipt_flush:
@@ -212,9 +223,8 @@ class Network(object):
         # Add user's firewall rules and register in global host policy chain
         self._add_basic_hostpolicy(hostname, ipaddr)
         # Add user's IP address to ipset for registered hosts
-        if not iproute2_helper3.ipset_test(self.ips_hosts, ipaddr):
-            self._logger.debug('Adding host {} to ipset {}'.format(ipaddr, self.ips_hosts))
-            iproute2_helper3.ipset_add(self.ips_hosts, ipaddr)
+        self._logger.debug('Adding host {} to ipset {}'.format(ipaddr, self.ips_hosts))
+        self.ipset.add(self.ips_hosts, ipaddr)
 
     def ipt_remove_user(self, hostname, ipaddr):
         self._logger.debug('Remove user {}/{}'.format(hostname, ipaddr))
@@ -223,16 +233,26 @@ class Network(object):
         # Remove user's firewall rules and deregister in global host policy chain
         self._remove_basic_hostpolicy(hostname, ipaddr)
         # Remove user's IP address from ipset of registered hosts
-        if iproute2_helper3.ipset_test(self.ips_hosts, ipaddr):
-            self._logger.debug('Removing host {} from ipset {}'.format(ipaddr, self.ips_hosts))
-            iproute2_helper3.ipset_delete(self.ips_hosts, ipaddr)
-        # Delete conntrack entries
-        ## Delete connection matching source IP address
-        if self._do_subprocess_call('conntrack -D --src {}'.format(ipaddr), False, True):
-            self._logger.debug('Successfully deleted connections: conntrack -D --src {}'.format(ipaddr))
-        ## Delete connection matching destination IP address
-        if self._do_subprocess_call('conntrack -D --reply-src {}'.format(ipaddr), False, True):
-            self._logger.debug('Successfully deleted connections: conntrack -D --reply-src {}'.format(ipaddr))
+        self._logger.debug('Removing host {} from ipset {}'.format(ipaddr, self.ips_hosts))
+        self.ipset.delete(self.ips_hosts, ipaddr)
+        # Delete conntrack entries matching source or reply source IP address
+        self._conntrack_delete_address(ipaddr)
+
+    def _conntrack_delete_address(self, ipaddr):
+        # Coalesce the deletions requested in the same loop iteration in a single conntrack dump
+        self._conntrack_pending.add(ipaddr)
+        if self._conntrack_handle is None:
+            self._conntrack_handle = self.loop.call_soon(self._conntrack_delete_pending)
+
+    def _conntrack_delete_pending(self):
+        ipaddrs = self._conntrack_pending
+        self._conntrack_pending = set()
+        self._conntrack_handle = None
+        try:
+            n = self.conntrack.delete_by_filter(src = ipaddrs, reply_src = ipaddrs)
+            self._logger.debug('Successfully deleted {} connections of {} hosts'.format(n, len(ipaddrs)))
+        except Exception as e:
+            self._logger.warning('Failed to delete connections of {} hosts / {}'.format(len(ipaddrs), e))
 
     def ipt_add_user_carriergrade(self, hostname, cgaddrs):
         self._logger.debug('Add carrier grade user {}/{}'.format(hostname, cgaddrs))
@@ -243,15 +263,9 @@ class Network(object):
             self._add_circularpool(hostname, ipaddr)
             # Add user's firewall rules and register in global host policy chain
             self._add_basic_hostpolicy_carriergrade(hostname, ipaddr)
-            # HACK: There seem to be some issues when running the code in Network Namespaces
-            try:
-                # Add user's IP address to ipset for registered hosts
-                if not iproute2_helper3.ipset_test(self.ips_hosts, ipaddr):
-                    self._logger.debug('Adding host {} to ipset {}'.format(ipaddr, self.ips_hosts))
-                    iproute2_helper3.ipset_add(self.ips_hosts, ipaddr)
-            except Exception as e:
-                self._logger.error('Failed to add {} to {} / {}'.format(ipaddr, self.ips_hosts, e))
-                continue
+            # Add user's IP address to ipset for registered hosts
+            self._logger.debug('Adding host {} to ipset {}'.format(ipaddr, self.ips_hosts))
+            self.ipset.add(self.ips_hosts, ipaddr)
 
 
     def ipt_remove_user_carriergrade(self, hostname, cgaddrs):
@@ -264,41 +278,107 @@ class Network(object):
             # Remove user's firewall rules and register in global host policy chain
             self._remove_basic_hostpolicy_carriergrade(hostname, ipaddr)
             # Remove user's IP address from ipset of registered hosts
-            if iproute2_helper3.ipset_test(self.ips_hosts, ipaddr):
-                self._logger.debug('Removing host {} from ipset {}'.format(ipaddr, self.ips_hosts))
-                iproute2_helper3.ipset_delete(self.ips_hosts, ipaddr)
+            self._logger.debug('Removing host {} from ipset {}'.format(ipaddr, self.ips_hosts))
+            self.ipset.delete(self.ips_hosts, ipaddr)
 
     def ipt_add_user_fwrules(self, hostname, ipaddr, chain, fwrules):
         host_chain = 'HOST_{}_{}'.format(hostname, chain.upper())
         self._logger.debug('Add fwrules for user {}/{} to chain <{}> ({})'.format(hostname, ipaddr, host_chain, len(fwrules)))
+        rules_batch = self._build_user_fwrules(host_chain, fwrules)
+        # Use new batch function
+        iptc_helper3.batch_add_rules('filter', rules_batch, ipv6=False)
+
+    def _build_user_fwrules(self, host_chain, fwrules):
         rules_batch = []
         # Sort list by priority of the rules
         for rule in sorted(fwrules, key=lambda rule: rule['priority']):
             xlat_rule = self._ipt_xlat_rule(host_chain, rule)
             rules_batch.append((host_chain, xlat_rule, 0))
-        # Use new batch function
-        iptc_helper3.batch_add_rules('filter', rules_batch, ipv6=False)
+        return rules_batch
+
+    def ipt_add_users_bulk(self, users, flushed = False):
+        """
+        Create the network resources of multiple users in one iptables batch per table and one ipset batch.
+        Users are dictionaries with keys hostname, ipaddr, groups, admin_fw, user_fw and carriergrade.
+        The removal of previous user data is skipped if the tables were flushed.
+        Return an ordered dictionary with the timings of each stage.
+        """
+        timings = collections.OrderedDict()
+        _t = self.loop.time()
+        def _lap(stage):
+            nonlocal _t
+            _now = self.loop.time()
+            timings[stage] = _now - _t
+            _t = _now
+
+        with self.ipset.batch():
+            # Remove previous user data
+            if not flushed:
+                for user in users:
+                    self.ipt_remove_user(user['hostname'], user['ipaddr'])
+            _lap('remove')
+
+            # Build rules and chains of all users
+            nat_rules = []
+            chains = []
+            filter_rules = []
+            for user in users:
+                hostname, ipaddr = user['hostname'], user['ipaddr']
+                cgaddrs = [item['ipv4'] for item in user['carriergrade']]
+                if not self._enabled_MARKDNAT:
+                    nat_rules += [(self.ipt_cpool_chain, self._build_circularpool_rule(_ipaddr), 0) for _ipaddr in [ipaddr] + cgaddrs]
+                _chains, _rules = self._build_basic_hostpolicy(hostname, ipaddr)
+                chains += _chains
+                filter_rules += _rules
+                filter_rules += self._build_user_fwrules('HOST_{}_ADMIN'.format(hostname), user['admin_fw'])
+                filter_rules += self._build_user_fwrules('HOST_{}_USER'.format(hostname), user['user_fw'])
+                for _ipaddr in cgaddrs:
+                    filter_rules += self._build_basic_hostpolicy_carriergrade(hostname, _ipaddr)
+                # Register ipset memberships
+                for _ipaddr in [ipaddr] + cgaddrs:
+                    self.ipset.add(self.ips_hosts, _ipaddr)
+                for group in user['groups']:
+                    if not self.ipset.exists(group):
+                        self._logger.error('Subscriber group {} does not exist!'.format(group))
+                        continue
+                    self.ipset.add(group, ipaddr)
+            _lap('build')
+
+            # Commit iptables batches
+            if nat_rules:
+                iptc_helper3.batch_add_rules('nat', nat_rules, ipv6=False)
+            iptc_helper3.batch_add_chains('filter', chains, ipv6=False, flush=True)
+            iptc_helper3.batch_add_rules('filter', filter_rules, ipv6=False)
+            _lap('iptables')
+        _lap('ipset')
+        self._logger.info('Added {} users in bulk with {} nat rules, {} chains and {} filter rules / {}'.format(len(users), len(nat_rules), len(chains), len(filter_rules), self.ipset.stats()))
+        return timings
 
     def ipt_add_user_groups(self, hostname, ipaddr, groups):
         self._logger.debug('Registering groups for user {}/{} <{}>'.format(hostname, ipaddr, groups))
         for group in groups:
-            if not iproute2_helper3.ipset_exists(group):
+            if not self.ipset.exists(group):
                 self._logger.error('Subscriber group {} does not exist!'.format(group))
                 continue
-            iproute2_helper3.ipset_add(group, ipaddr)
+            self.ipset.add(group, ipaddr)
 
     def ipt_remove_user_groups(self, hostname, ipaddr, groups):
         self._logger.debug('Removing groups for user {}/{} <{}>'.format(hostname, ipaddr, groups))
         for group in groups:
-            if not iproute2_helper3.ipset_exists(group):
+            if not self.ipset.exists(group):
                 self._logger.error('Subscriber group {} does not exist!'.format(group))
                 continue
-            iproute2_helper3.ipset_delete(group, ipaddr)
+            self.ipset.delete(group, ipaddr)
 
     def ipt_register_nfqueues(self, cb, *cb_args, **cb_kwargs):
         for queue in self.ipt_cpool_queue:
             self._nfqueues.append(nfqueue3.NFQueue3(queue, cb, *cb_args, **cb_kwargs))
 
+    def ipt_register_nfqueue_workers(self, cb, fastpath_cb, fail_open = True, maxlen = 4096):
+        # Serve each NFQUEUE from a dedicated thread, e.g. queues fanned out with --queue-balance
+        for queue in self.ipt_cpool_queue:
+            self._nfqueues.append(NFQueueWorker(queue, cb, self.loop, fastpath_cb = fastpath_cb, fail_open = fail_open, maxlen = maxlen))
+
     def ipt_deregister_nfqueues(self):
         for nfqueueObj in self._nfqueues:
             nfqueueObj.terminate()
@@ -362,6 +442,11 @@ class Network(object):
             iptc_helper3.delete_chain(table, chain, ipv6=False)
             return ret
 
+    def _build_circularpool_rule(self, ipaddr):
+        # Return the nat rule of the Circular Pool for a host
+        mark = self._gen_pktmark_cpool(ipaddr)
+        return {'mark':{'mark':hex(mark)}, 'target':{'DNAT':{'to-destination':ipaddr}}}
+
     def _add_circularpool(self, hostname, ipaddr):
         # Do not add specific rule if MARKDNAT is enabled
         if self._enabled_MARKDNAT:
@@ -369,8 +454,7 @@ class Network(object):
         # Add rule to iptables
         table = 'nat'
         chain = self.ipt_cpool_chain
-        mark = self._gen_pktmark_cpool(ipaddr)
-        rule = {'mark':{'mark':hex(mark)}, 'target':{'DNAT':{'to-destination':ipaddr}}}
+        rule = self._build_circularpool_rule(ipaddr)
         iptc_helper3.add_rule(table, chain, rule, ipv6=False)
 
     def _remove_circularpool(self, hostname, ipaddr):
@@ -385,16 +469,21 @@ class Network(object):
         iptc_helper3.delete_rule(table, chain, rule, ipv6=False, silent=True)
 
     def _add_basic_hostpolicy(self, hostname, ipaddr):
+        chains, rules_batch = self._build_basic_hostpolicy(hostname, ipaddr)
+        # Create & flush basic chains for host policy
+        # Use new batch function
+        iptc_helper3.batch_add_chains('filter', chains, ipv6=False, flush=True)
+        # Use new batch function
+        iptc_helper3.batch_add_rules('filter', rules_batch, ipv6=False)
+
+    def _build_basic_hostpolicy(self, hostname, ipaddr):
+        # Return the chains and the rules of the basic host policy
         # Define host tables
         host_chain          = 'HOST_{}'.format(hostname)
         host_chain_admin    = 'HOST_{}_ADMIN'.format(hostname)
         host_chain_user     = 'HOST_{}_USER'.format(hostname)
         host_chain_ces      = 'HOST_{}_CES'.format(hostname)
 
-        # Create & flush basic chains for host policy
-        # Use new batch function
-        iptc_helper3.batch_add_chains('filter', (host_chain, host_chain_admin, host_chain_user, host_chain_ces), ipv6=False, flush=True)
-
         rules_batch = []
         # 1. Register triggers in global host policy chain
         ## Add rules to iptables
@@ -408,8 +497,7 @@ class Network(object):
         rules_batch.append((host_chain, {'target':host_chain_ces, 'mark':{'mark':MASK_HOST_CES}}, 0))
         # Add a variable for default host policy
         rules_batch.append((host_chain, {'target':self.ipt_host_unknown}, 0))
-        # Use new batch function
-        iptc_helper3.batch_add_rules('filter', rules_batch, ipv6=False)
+        return (host_chain, host_chain_admin, host_chain_user, host_chain_ces), rules_batch
 
     def _remove_basic_hostpolicy(self, hostname, ipaddr):
         # Define host tables
@@ -432,6 +520,11 @@ class Network(object):
 
 
     def _add_basic_hostpolicy_carriergrade(self, hostname, ipaddr):
+        rules_batch = self._build_basic_hostpolicy_carriergrade(hostname, ipaddr)
+        # Use new batch function
+        iptc_helper3.batch_add_rules('filter', rules_batch, ipv6=False)
+
+    def _build_basic_hostpolicy_carriergrade(self, hostname, ipaddr):
         # Define host tables
         host_chain          = 'HOST_{}'.format(hostname)
 
@@ -440,8 +533,7 @@ class Network(object):
         ## Add rules to iptables
         rules_batch.append((self.ipt_host_chain, {'mark':{'mark':MASK_HOST_INGRESS}, 'dst':ipaddr, 'target':host_chain}, 0))
         rules_batch.append((self.ipt_host_chain, {'mark':{'mark':MASK_HOST_EGRESS},  'src':ipaddr, 'target':host_chain}, 0))
-        # Use new batch function
-        iptc_helper3.batch_add_rules('filter', rules_batch, ipv6=False)
+        return rules_batch
 
     def _remove_basic_hostpolicy_carriergrade(self, hostname, ipaddr):
         # Define host tables
@@ -745,13 +837,20 @@ class Network(object):
     def synproxy_create(self):
         self.synproxy_obj = None
         self._synproxy_worker_task = None
+        self._synproxy_queue = None
         if self.synproxy is None:
             self._logger.warning('No SYNPROXY defined!')
             return
+        # Create write-behind queue for connection synchronization
+        self._synproxy_queue = SynproxySyncQueue(self.loop, self.synproxy_sync_connection)
+        _t = asyncio.ensure_future(self._synproxy_queue.worker())
+        RUNNING_TASKS.append((_t, 'network.synproxy_queue'))
         asyncio.ensure_future(self._synproxy_respawn(self.synproxy))
 
     @asyncio.coroutine
     def _synproxy_respawn(self, addr):
+        # Hold the write-behind queue until the flows are initialized
+        self._synproxy_queue.suspend()
         # Create SYNPROXY object and connect socket
         self.synproxy_obj = SynproxyClient(self.loop)
         while True:
@@ -766,17 +865,20 @@ class Network(object):
         self._logger.warning('Successfully connected to SYNPROXY server @ {}:{}'.format(addr[0],addr[1]))
         # Start monitor
         asyncio.ensure_future(self._synproxy_monitor())
-        # Install initial flows
-        ## Flush all connections from SYNPROXY
-        yield from self.synproxy_sync_connection('flush', '0.0.0.0', 0, 0, 0, 0, 0, 2)
-        # Set default connection
-        yield from self.synproxy_sync_connection('mod', '0.0.0.0', 0, 0, 536, 0, 1, 2)
-        # Initialize IP address of the CircularPool and ServicePool pool with default TCP options
+        # Install initial flows in a single batch
         ap_cpool = self.pooltable.get('circularpool')
         ap_spool = self.pooltable.get('servicepool')
         ap_pool  = ap_cpool.get_pool() + ap_spool.get_pool()
-        for ipaddr in ap_pool:
-            yield from self.synproxy_sync_connection('mod', ipaddr, 0, 0, 1460, 1, 7, 2)
+        ## Flush all connections from SYNPROXY
+        operations = [('flush', '0.0.0.0', 0, 0, 0, 0, 0)]
+        ## Set default connection
+        operations.append(('mod', '0.0.0.0', 0, 0, 536, 0, 1))
+        ## Initialize IP address of the CircularPool and ServicePool pool with default TCP options
+        operations += [('mod', ipaddr, 0, 0, 1460, 1, 7) for ipaddr in ap_pool]
+        _tflush = self.loop.time()
+        yield from self.synproxy_sync_batch(operations, timeout = 2 + len(operations) * 0.001)
+        # Reset the known state of the write-behind queue after the flush, operations enqueued meanwhile are kept
+        self._synproxy_queue.reset([('0.0.0.0', 0, 0)] + [(ipaddr, 0, 0) for ipaddr in ap_pool], before = _tflush)
         self._logger.warning('Successfully initialized SYNPROXY flows')
 
     @asyncio.coroutine
@@ -817,29 +919,212 @@ class Network(object):
             self._logger.debug('Succeded to <{}> connection to SYNPROXY {}'.format(mode, msg))
         else:
             self._logger.warning('Failed to <{}> connection to SYNPROXY {}'.format(mode, msg))
+        return ret
+
+    @asyncio.coroutine
+    def synproxy_sync_batch(self, operations, timeout = 2):
+        # Send a list of (mode, ipaddr, port, proto, tcpmss, tcpsack, tcpwscale) in a single batch
+        if self.synproxy_obj is None:
+            return
+
+        _t = self.loop.time()
+        try:
+            ret = yield from asyncio.wait_for(self.synproxy_obj.sendrecv_batch(operations), timeout = timeout)
+        except asyncio.TimeoutError:
+            self._logger.warning('Timeout expired while sending a batch of {} operations to SYNPROXY'.format(len(operations)))
+            ret = [False] * len(operations)
+
+        _tdelay = (self.loop.time() - _t) * 1000
+        nof_failed = ret.count(False)
+        msg = '{} operations in {:.3} ms / {}'.format(len(operations), _tdelay, self.synproxy_obj.stats())
+        if nof_failed == 0:
+            self._logger.debug('Succeded to sync batch of {}'.format(msg))
+        else:
+            self._logger.warning('Failed {} to sync batch of {}'.format(nof_failed, msg))
+        return ret
 
     @asyncio.coroutine
     def synproxy_add_connection(self, ipaddr, port, proto, tcpmss, tcpsack, tcpwscale, timeout = 1):
-        _ret = yield from self.synproxy_sync_connection('mod', ipaddr, port, proto, tcpmss, tcpsack, tcpwscale, timeout)
-        return _ret
+        # Enqueue the operation in the write-behind queue and return immediately
+        if self._synproxy_queue is None:
+            return
+        return self._synproxy_queue.enqueue('mod', ipaddr, port, proto, tcpmss, tcpsack, tcpwscale, timeout)
 
     @asyncio.coroutine
     def synproxy_del_connection(self, ipaddr, port, proto, timeout = 1):
-        _ret = yield from self.synproxy_sync_connection('del', ipaddr, port, proto, 0, 0, 0, timeout)
-        return _ret
+        # Enqueue the operation in the write-behind queue and return immediately
+        if self._synproxy_queue is None:
+            return
+        return self._synproxy_queue.enqueue('del', ipaddr, port, proto, 0, 0, 0, timeout)
+
+    def synproxy_stats(self):
+        """ Return a dictionary with the counters of the write-behind queue """
+        if self._synproxy_queue is None:
+            return {}
+        return self._synproxy_queue.stats()
+
+
+class SynproxySyncQueue(object):
+    """
+    Write-behind queue for SYNPROXY connection synchronization.
+
+    Operations are indexed by (ipaddr, port, proto) and only the latest one is kept while
+    pending, preserving the order per key. A 'del' that follows a pending 'mod' of a
+    connection not yet present in SYNPROXY cancels both operations.
+    """
+    def __init__(self, loop, sync_cb, batch_size = 256):
+        self._logger = logging.getLogger('SynproxySyncQueue')
+        self.loop = loop
+        self._sync_cb = sync_cb
+        self._batch_size = batch_size
+        # Pending operations (ipaddr, port, proto) -> (mode, tcpmss, tcpsack, tcpwscale, timeout, last update, timestamp)
+        self._pending = collections.OrderedDict()
+        # Connections known to be present in SYNPROXY and connections being synchronized
+        self._present = set()
+        self._inflight = set()
+        self._event = asyncio.Event()
+        # Cleared while SYNPROXY is being (re)initialized
+        self._ready = asyncio.Event()
+        self._ready.set()
+        # Counters
+        self.enqueued = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self.synced = 0
+        self.failed = 0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+
+    def enqueue(self, mode, ipaddr, port, proto, tcpmss, tcpsack, tcpwscale, timeout = 1):
+        key = (ipaddr, port, proto)
+        self.enqueued += 1
+        if key in self._pending:
+            self.coalesced += 1
+            pending_mode = self._pending[key][0]
+            if mode == 'del' and pending_mode == 'mod' and key not in self._present and key not in self._inflight:
+                # The connection never reached SYNPROXY
+                del self._pending[key]
+                self.cancelled += 1
+                return True
+            # Keep the latest operation in the original queue position and timestamp
+            _ts = self._pending[key][-1]
+            self._pending[key] = (mode, tcpmss, tcpsack, tcpwscale, timeout, self.loop.time(), _ts)
+            return True
+
+        _now = self.loop.time()
+        self._pending[key] = (mode, tcpmss, tcpsack, tcpwscale, timeout, _now, _now)
+        self._event.set()
+        return True
+
+    def suspend(self):
+        """ Stop dequeuing operations until the next reset """
+        self._ready.clear()
+
+    def reset(self, present = (), before = None):
+        """ Set the connections present after a SYNPROXY flush and resume the worker.
+        Pending operations last updated before the flush are discarded, later ones are kept. """
+        if before is None:
+            self._pending.clear()
+        else:
+            for key in [key for key, value in self._pending.items() if value[-2] < before]:
+                del self._pending[key]
+        self._present = set(present)
+        self._ready.set()
+        self._event.set()
+
+    def depth(self):
+        return len(self._pending)
+
+    def lag(self):
+        """ Return the age of the oldest pending operation (sec) """
+        if not self._pending:
+            return 0.0
+        _ts = next(iter(self._pending.values()))[-1]
+        return self.loop.time() - _ts
+
+    def stats(self):
+        return {'depth': self.depth(), 'lag': self.lag(), 'lag_last': self.lag_last, 'lag_max': self.lag_max,
+                'enqueued': self.enqueued, 'coalesced': self.coalesced, 'cancelled': self.cancelled,
+                'synced': self.synced, 'failed': self.failed}
+
+    @asyncio.coroutine
+    def worker(self):
+        self._logger.info('Starting SYNPROXY write-behind worker')
+        while True:
+            if not self._pending:
+                self._event.clear()
+                yield from self._event.wait()
+                continue
+            if not self._ready.is_set():
+                yield from self._ready.wait()
+                continue
+            # Dequeue the oldest operations, these are pipelined in a single SYNPROXY batch
+            batch = []
+            while self._pending and len(batch) < self._batch_size:
+                batch.append(self._pending.popitem(last=False))
+            self._inflight.update(key for key, _ in batch)
+            try:
+                results = yield from asyncio.gather(*[self._sync_cb(mode, *key, tcpmss, tcpsack, tcpwscale, timeout)
+                                                      for key, (mode, tcpmss, tcpsack, tcpwscale, timeout, _tupdate, _ts) in batch],
+                                                    return_exceptions = True)
+            except asyncio.CancelledError:
+                self._logger.debug('Terminating SYNPROXY write-behind worker')
+                break
+            finally:
+                self._inflight.clear()
+            # Update counters
+            _now = self.loop.time()
+            for (key, (mode, tcpmss, tcpsack, tcpwscale, timeout, _tupdate, _ts)), ret in zip(batch, results):
+                self.lag_last = _now - _ts
+                self.lag_max = max(self.lag_max, self.lag_last)
+                if isinstance(ret, Exception):
+                    self._logger.warning('Failed to synchronize {} / {}'.format(key, ret))
+                    ret = False
+                if not ret:
+                    self.failed += 1
+                    continue
+                self.synced += 1
+                if mode == 'del':
+                    self._present.discard(key)
+                else:
+                    self._present.add(key)
+
 
 
+# SYNPROXY control protocol v2 / header (magic, version, count, seq) followed by count v1 messages
+SYNPROXY_V2_MAGIC   = 0xFF
+SYNPROXY_V2_VERSION = 0x02
+SYNPROXY_V2_HEADER  = struct.Struct('!BBHI')
+SYNPROXY_V2_SEQMASK = 0xFFFFFFFF
+# Hello message is a valid v1 'del' of 255.2.0.0 that fails harmlessly in a v1 server
+SYNPROXY_V2_HELLO   = SYNPROXY_V2_HEADER.pack(SYNPROXY_V2_MAGIC, SYNPROXY_V2_VERSION, 0, 0b0001000) + bytes(4)
+SYNPROXY_MAXBATCH   = 1024
 
 class SynproxyClient(asyncio.Protocol):
+    """
+    SYNPROXY control protocol client.
+
+    Version 1 sends one 12-byte message per operation and receives b'1\n' or b'0\n' in FIFO order.
+    Version 2 sends frames of the form header (8 bytes) + N x 12-byte messages and receives
+    header (8 bytes) + N status bytes, where the sequence number in the header identifies
+    the first message of the frame. The version is negotiated with a hello message on connection.
+    """
     def __init__(self, loop):
         self._logger = logging.getLogger('SynproxyClient')
         self.loop = loop
         self.queue = asyncio.Queue(maxsize=0)
         self.transport = None
-        self.transactions = []
+        # Pending transactions / v1 in FIFO order and v2 indexed by sequence number
+        self.transactions = collections.deque()
+        self.transactions_v2 = {}
+        self.version = None
+        self._seq = 0
+        self._buffer = bytearray()
+        self._negotiated = asyncio.Event()
         # Variables used to calculate avg time per operation
         self.nofops = 0
         self.aggtime = 0
+        self.nofbatches = 0
         # Create SYNPROXY queue worker
         self._worker_task = asyncio.ensure_future(self.worker_queue())
         # Create event to monitor from Network module
@@ -851,26 +1136,69 @@ class SynproxyClient(asyncio.Protocol):
         # Enable TCP_NODELAY
         sock = self.transport.get_extra_info('socket')
         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Negotiate protocol version
+        self.transport.write(SYNPROXY_V2_HELLO)
+
+    def _set_version(self, version):
+        self._logger.info('Negotiated SYNPROXY control protocol v{}'.format(version))
+        self.version = version
+        self._negotiated.set()
 
     def data_received(self, data):
         #self._logger.warning('Data received: <{}>'.format(data))
-        if len(self.transactions) == 0:
-            # Drop unexpected message received from server
-            self._logger.warning('Unexpected message: <{}>'.format(data))
-            return
+        self._buffer += data
+        buf = self._buffer
+        # Process all complete responses, a single read may contain several of them
+        while buf:
+            if buf[0] == SYNPROXY_V2_MAGIC:
+                if len(buf) < SYNPROXY_V2_HEADER.size:
+                    break
+                _, version, count, seq = SYNPROXY_V2_HEADER.unpack_from(buf, 0)
+                _end = SYNPROXY_V2_HEADER.size + count
+                if len(buf) < _end:
+                    break
+                results = bytes(buf[SYNPROXY_V2_HEADER.size:_end])
+                del buf[:_end]
+                if count == 0:
+                    # Response to hello message
+                    self._set_version(SYNPROXY_V2_VERSION)
+                    continue
+                for i, result in enumerate(results):
+                    entry = self.transactions_v2.pop((seq + i) & SYNPROXY_V2_SEQMASK, None)
+                    if entry is None:
+                        self._logger.warning('Unexpected response for seq={}'.format((seq + i) & SYNPROXY_V2_SEQMASK))
+                        continue
+                    self._complete(entry, result == 1)
+                continue
 
-        # Evaluate response
-        if data == b'1\n':
-            success = True
-        elif data == b'0\n':
-            success = False
-        else:
-            # Drop unrecognised message received from server
-            self._logger.warning('Unrecognised message: <{}>'.format(data))
-            return
+            if len(buf) < 2:
+                break
+            msg = bytes(buf[:2])
+            del buf[:2]
+            # Evaluate response
+            if msg == b'1\n':
+                success = True
+            elif msg == b'0\n':
+                success = False
+            else:
+                # Drop unrecognised data received from server
+                self._logger.warning('Unrecognised message: <{}>'.format(msg + bytes(buf)))
+                buf.clear()
+                break
 
-        # Extract oldest transaction
-        ts, waiter = self.transactions.pop(0)
+            if self.version is None:
+                # Hello message rejected by a v1 server
+                self._set_version(1)
+                continue
+            if len(self.transactions) == 0:
+                # Drop unexpected message received from server
+                self._logger.warning('Unexpected message: <{}>'.format(msg))
+                continue
+            # Extract oldest transaction
+            self._complete(self.transactions.popleft(), success)
+
+    def _complete(self, entry, success):
+        ts, waiter = entry
         tdelay = (self.loop.time() - ts) * 1000
         self.nofops += 1
         self.aggtime += tdelay
@@ -883,7 +1211,7 @@ class SynproxyClient(asyncio.Protocol):
     def stats(self):
         if self.nofops == 0:
             return 'avg {:.3} ms / nofops {}'.format(0.0, 0.0)
-        return 'avg {:.3} ms / nofops {}'.format(self.aggtime / self.nofops, self.nofops)
+        return 'avg {:.3} ms / nofops {} / nofbatches {} / v{}'.format(self.aggtime / self.nofops, self.nofops, self.nofbatches, self.version)
 
     def connection_lost(self, exc):
         self._logger.debug('The server closed the connection {}'.format(exc))
@@ -914,32 +1242,66 @@ class SynproxyClient(asyncio.Protocol):
         # Return success of the operation / True or False
         return waiter.data
 
+    @asyncio.coroutine
+    def sendrecv_batch(self, operations):
+        """ Send a list of (mode, ipaddr, port, proto, tcpmss, tcpsack, tcpwscale) and return a list of results """
+        waiters = []
+        for operation in operations:
+            waiter = asyncio.Event()
+            self.queue.put_nowait((waiter,) + tuple(operation))
+            waiters.append(waiter)
+        # Wait until all responses have been received
+        for waiter in waiters:
+            yield from waiter.wait()
+        return [waiter.data for waiter in waiters]
+
     @asyncio.coroutine
     def worker_queue(self):
         self._logger.info('Starting SYNPROXY connection worker')
         while True:
-            # Make sure the connection is always open!
-            if self.transport is None:
-                self._logger.debug('Socket connection not ready yet!')
-                yield from asyncio.sleep(1)
-                continue
             try:
-                # Dequeue a request
+                # Make sure the connection is always open and negotiated!
+                if self.transport is None or self.version is None:
+                    self._logger.debug('Socket connection not ready yet!')
+                    yield from self._negotiated.wait()
+                    continue
+                # Dequeue a request and all the requests readily available
                 data_q = yield from self.queue.get()
-                waiter, mode, ipaddr, port, proto, tcpmss, tcpsack, tcpwscale = data_q
                 self.queue.task_done()
-                #self._logger.debug('Dequeued request! {}({})'.format(mode, (ipaddr, port, proto, tcpmss, tcpsack, tcpwscale)))
-                # Build message
-                msg_b = SynproxyClient.synproxy_build_message(mode, ipaddr, port, proto, tcpmss, tcpsack, tcpwscale)
-                self.transport.write(msg_b)
-                # Append a transaction entry with timestamp and waiter
-                self.transactions.append((self.loop.time(), waiter))
+                batch = [data_q]
+                while data_q is not None and len(batch) < SYNPROXY_MAXBATCH and not self.queue.empty():
+                    data_q = self.queue.get_nowait()
+                    self.queue.task_done()
+                    batch.append(data_q)
+                if batch[-1] is None:
+                    # Termination signal
+                    batch.pop()
+                    if batch:
+                        self._send_batch(batch)
+                    break
+                self._send_batch(batch)
             except asyncio.CancelledError as e:
                 self._logger.debug('Terminating SYNPROXY queue worker')
                 break
             except Exception as e:
                 self._logger.exception(e)
 
+    def _send_batch(self, batch):
+        # Build messages
+        msgs_b = b''.join(SynproxyClient.synproxy_build_message(*data_q[1:]) for data_q in batch)
+        _t = self.loop.time()
+        self.nofbatches += 1
+        if self.version == 1:
+            # Concatenate v1 messages, responses are matched in FIFO order
+            self.transport.write(msgs_b)
+            self.transactions.extend((_t, data_q[0]) for data_q in batch)
+            return
+        # Send a single v2 frame, responses are matched by sequence number
+        seq = self._seq
+        self._seq = (seq + len(batch)) & SYNPROXY_V2_SEQMASK
+        for i, data_q in enumerate(batch):
+            self.transactions_v2[(seq + i) & SYNPROXY_V2_SEQMASK] = (_t, data_q[0])
+        self.transport.write(SYNPROXY_V2_HEADER.pack(SYNPROXY_V2_MAGIC, SYNPROXY_V2_VERSION, len(batch), seq) + msgs_b)
 
     @staticmethod
     def synproxy_build_message(mode, ipaddr, port, proto, tcpmss, tcpsack, tcpwscale):
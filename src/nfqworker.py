@@ -0,0 +1,263 @@
+"""
+BSD 3-Clause License
+
+Copyright (c) 2018, Jesus Llorente Santos, Aalto University, Finland
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import errno
+import logging
+import select
+import socket
+import struct
+import threading
+
+from netlink import *
+
+
+# nfnetlink_queue constants
+NFNL_SUBSYS_QUEUE       = 3
+NFQNL_MSG_PACKET        = 0
+NFQNL_MSG_VERDICT       = 1
+NFQNL_MSG_CONFIG        = 2
+NFQNL_MSG_VERDICT_BATCH = 3
+NFQA_PACKET_HDR         = 1
+NFQA_VERDICT_HDR        = 2
+NFQA_MARK               = 3
+NFQA_PAYLOAD            = 10
+NFQA_CFG_CMD            = 1
+NFQA_CFG_PARAMS         = 2
+NFQA_CFG_QUEUE_MAXLEN   = 3
+NFQA_CFG_MASK           = 4
+NFQA_CFG_FLAGS          = 5
+NFQNL_CFG_CMD_BIND      = 1
+NFQNL_CFG_CMD_UNBIND    = 2
+NFQNL_COPY_PACKET       = 2
+NFQA_CFG_F_FAIL_OPEN    = 0x01
+NF_DROP                 = 0
+NF_ACCEPT               = 1
+
+
+class NFPacket(object):
+    """ Packet received from NFQUEUE with the interface used by the packet callbacks """
+    __slots__ = ('id', 'payload', 'mark', 'verdict', 'worker')
+
+    def __init__(self, worker, packet_id, payload, mark = None):
+        self.worker = worker
+        self.id = packet_id
+        self.payload = payload
+        self.mark = mark
+        self.verdict = None
+
+    def get_payload(self):
+        return self.payload
+
+    def set_mark(self, mark):
+        self.mark = mark
+
+    def accept(self):
+        self.verdict = NF_ACCEPT
+
+    def drop(self):
+        self.verdict = NF_DROP
+
+    def defer(self, cb, *args):
+        """ Run a callback in the event loop, used by fast path callbacks to update shared state """
+        self.worker.defer(cb, *args)
+
+
+class NFQueueWorker(threading.Thread):
+    """
+    NFQUEUE served by a dedicated thread over NFNETLINK.
+
+    The fast path callback runs in the worker thread with read-only access to shared
+    state and returns True if it set a verdict. Otherwise the packet is handed over to
+    the callback in the event loop, which owns all state modifications. Verdicts are sent
+    once per burst of packets, with a single verdict batch message when possible.
+    """
+    def __init__(self, queue, cb, loop, fastpath_cb = None, fail_open = True, maxlen = 4096, burst = 64, rcvbuf = 8*1024*1024):
+        super().__init__(name = 'NFQueueWorker-{}'.format(queue), daemon = True)
+        self._logger = logging.getLogger('NFQueueWorker#{}'.format(queue))
+        self.queue = queue
+        self.cb = cb
+        self.fastpath_cb = fastpath_cb
+        self.loop = loop
+        self.burst = burst
+        self._running = True
+        self._lock = threading.Lock()
+        self._deferred_calls = []
+        self._inflight = 0
+        self._seq = 0
+        # Counters
+        self.nofpackets = 0
+        self.nofpackets_fastpath = 0
+        self.nofverdicts_batch = 0
+        self.nofoverruns = 0
+        # Overruns already accounted for when deciding on verdict batches
+        self._nofoverruns_seen = 0
+        # Create and bind netlink socket
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_NETFILTER)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self._sock.bind((0, 0))
+        self._sock.setblocking(False)
+        self._bind(fail_open, maxlen)
+        self.start()
+
+    def _config(self, payload):
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        msg = nlmsg_build((NFNL_SUBSYS_QUEUE << 8) | NFQNL_MSG_CONFIG, NLM_F_REQUEST | NLM_F_ACK, self._seq, socket.AF_UNSPEC, self.queue, payload)
+        self._sock.send(msg)
+        for nlmsg_type, _, nlmsg_seq, msg in nlmsg_iter(self._recv(1.0)):
+            if nlmsg_type == NLMSG_ERROR and nlmsg_seq == self._seq and nlmsg_error(msg):
+                raise OSError(nlmsg_error(msg), 'Failed to configure NFQUEUE {}'.format(self.queue))
+
+    def _bind(self, fail_open, maxlen):
+        self._config(nla(NFQA_CFG_CMD, struct.pack('!BxH', NFQNL_CFG_CMD_BIND, socket.AF_INET)))
+        self._config(nla(NFQA_CFG_PARAMS, struct.pack('!IB', 0xFFFF, NFQNL_COPY_PACKET)) +
+                     nla(NFQA_CFG_QUEUE_MAXLEN, struct.pack('!I', maxlen)))
+        flags = NFQA_CFG_F_FAIL_OPEN if fail_open else 0
+        self._config(nla(NFQA_CFG_FLAGS, struct.pack('!I', flags)) + nla(NFQA_CFG_MASK, struct.pack('!I', NFQA_CFG_F_FAIL_OPEN)))
+        self._logger.info('Bound NFQUEUE {} / fail_open={} maxlen={}'.format(self.queue, fail_open, maxlen))
+
+    def terminate(self):
+        self._running = False
+
+    def defer(self, cb, *args):
+        self._deferred_calls.append((cb, args))
+
+    def _recv(self, timeout = None):
+        """ Receive a netlink message, waiting up to timeout if given """
+        if timeout is not None and not select.select([self._sock], [], [], timeout)[0]:
+            raise BlockingIOError()
+        return self._sock.recv(65536 + 256)
+
+    def _recv_burst(self):
+        """ Return a list of NFPacket, waiting for the first one up to 0.5 sec """
+        packets = []
+        timeout = 0.5
+        while len(packets) < self.burst:
+            try:
+                data = self._recv(timeout)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # The kernel dropped messages, continue with the next ones
+                self.nofoverruns += 1
+                continue
+            timeout = None
+            # Slice messages and payloads as views of the received buffer
+            for nlmsg_type, _, _, msg in nlmsg_iter(memoryview(data)):
+                if nlmsg_type != (NFNL_SUBSYS_QUEUE << 8) | NFQNL_MSG_PACKET:
+                    continue
+                attrs = nla_parse(msg, NLMSGHDR.size + NFGENMSG.size)
+                if NFQA_PACKET_HDR not in attrs:
+                    continue
+                packet_id, = struct.unpack_from('!I', msg, attrs[NFQA_PACKET_HDR][0])
+                payload = msg[slice(*attrs[NFQA_PAYLOAD])] if NFQA_PAYLOAD in attrs else b''
+                mark = struct.unpack_from('!I', msg, attrs[NFQA_MARK][0])[0] if NFQA_MARK in attrs else None
+                packets.append(NFPacket(self, packet_id, payload, mark))
+        return packets
+
+    def _build_verdict(self, packet, msg_type = NFQNL_MSG_VERDICT):
+        verdict = NF_DROP if packet.verdict is None else packet.verdict
+        payload = nla(NFQA_VERDICT_HDR, struct.pack('!II', verdict, packet.id))
+        if packet.mark is not None:
+            payload += nla(NFQA_MARK, struct.pack('!I', packet.mark))
+        return nlmsg_build((NFNL_SUBSYS_QUEUE << 8) | msg_type, NLM_F_REQUEST, 0, socket.AF_UNSPEC, self.queue, payload)
+
+    def _send_verdicts(self, packets, batch):
+        """ Send the verdicts of a list of packets in a single write """
+        if not packets:
+            return
+        if batch and all(p.verdict == packets[0].verdict and p.mark == packets[0].mark for p in packets):
+            # A verdict batch applies to all the queued packets up to the given id
+            self.nofverdicts_batch += 1
+            self._sock.send(self._build_verdict(max(packets, key = lambda p: p.id), NFQNL_MSG_VERDICT_BATCH))
+            return
+        self._sock.send(b''.join(self._build_verdict(p) for p in packets))
+
+    def _process_deferred(self, packets, calls):
+        # Run in the event loop
+        for cb, args in calls:
+            try:
+                cb(*args)
+            except Exception as e:
+                self._logger.exception(e)
+        for packet in packets:
+            try:
+                self.cb(packet)
+            except Exception as e:
+                self._logger.exception(e)
+        try:
+            self._send_verdicts(packets, batch = False)
+        finally:
+            with self._lock:
+                self._inflight -= len(packets)
+
+    def run(self):
+        self._logger.info('Starting NFQUEUE worker thread')
+        while self._running:
+            try:
+                packets = self._recv_burst()
+                if not packets:
+                    continue
+                self.nofpackets += len(packets)
+                verdicted, deferred = [], []
+                for packet in packets:
+                    handled = False
+                    if self.fastpath_cb is not None:
+                        try:
+                            handled = self.fastpath_cb(packet)
+                        except Exception as e:
+                            self._logger.warning('Fast path failed / {}'.format(e))
+                    (verdicted if handled else deferred).append(packet)
+                self.nofpackets_fastpath += len(verdicted)
+                # Packets lost in an overrun are still queued in the kernel with lower ids, do not verdict them blindly
+                overrun = self.nofoverruns != self._nofoverruns_seen
+                self._nofoverruns_seen = self.nofoverruns
+                with self._lock:
+                    # Verdict batches are only safe if no lower packet id is pending in the event loop
+                    batch = self._inflight == 0 and not deferred and not overrun
+                    self._inflight += len(deferred)
+                self._send_verdicts(verdicted, batch)
+                calls, self._deferred_calls = self._deferred_calls, []
+                if deferred or calls:
+                    self.loop.call_soon_threadsafe(self._process_deferred, deferred, calls)
+            except Exception as e:
+                self._logger.exception(e)
+        # Unbind queue and close socket
+        try:
+            self._config(nla(NFQA_CFG_CMD, struct.pack('!BxH', NFQNL_CFG_CMD_UNBIND, socket.AF_INET)))
+        except Exception as e:
+            self._logger.warning('Failed to unbind NFQUEUE {} / {}'.format(self.queue, e))
+        self._sock.close()
+
+    def stats(self):
+        return 'packets {} / fastpath {} / verdict batches {} / overruns {}'.format(self.nofpackets, self.nofpackets_fastpath, self.nofverdicts_batch, self.nofoverruns)
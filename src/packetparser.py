@@ -0,0 +1,127 @@
+"""
+BSD 3-Clause License
+
+Copyright (c) 2018, Jesus Llorente Santos, Aalto University, Finland
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import socket
+import struct
+import collections
+
+# IPv4 header: version/IHL, TTL, protocol, source and destination addresses
+_IPV4 = struct.Struct('!B7xBB2xII')
+_PORTS = struct.Struct('!HH')
+_TCP = struct.Struct('!HHIIxB')
+_SCTP = struct.Struct('!HHI')
+_ICMP = struct.Struct('!BB')
+_ADDR = struct.Struct('!I')
+
+
+class PacketFields(collections.namedtuple('PacketFields', ['proto', 'ttl', 'src_int', 'dst_int', 'sport', 'dport',
+                                                            'tcp_flags', 'tcp_seq', 'tcp_ack', 'icmp_type', 'icmp_code', 'sctp_tag'])):
+    """ Fields of an IPv4 packet with integer addresses, unset fields are 0 """
+    __slots__ = ()
+
+    @property
+    def src(self):
+        return socket.inet_ntoa(_ADDR.pack(self.src_int))
+
+    @property
+    def dst(self):
+        return socket.inet_ntoa(_ADDR.pack(self.dst_int))
+
+    def __str__(self):
+        # Only formatted when a log line is emitted
+        if self.proto == 6:
+            return '{}:{} {}:{} [{}] (TTL {}) flags/{:08b} seq/{} ack{}'.format(self.src, self.sport, self.dst, self.dport,
+                                                                                self.proto, self.ttl, self.tcp_flags,
+                                                                                self.tcp_seq, self.tcp_ack)
+        elif self.proto == 132:
+            return '{}:{} {}:{} [{}] (TTL {}) tag/{:x}'.format(self.src, self.sport, self.dst, self.dport,
+                                                                self.proto, self.ttl, self.sctp_tag)
+        return '{}:{} {}:{} [{}] (TTL {})'.format(self.src, self.sport, self.dst, self.dport, self.proto, self.ttl)
+
+
+# Bypass the keyword handling of the namedtuple constructor
+_new = tuple.__new__
+
+def parse_packet(data):
+    """
+    Parse the IPv4 and transport headers of a packet without copying it.
+
+    @param data: Packet starting at the IP header (bytes, bytearray or memoryview).
+    @return: A PacketFields record.
+    """
+    ver_ihl, ttl, proto, src, dst = _IPV4.unpack_from(data)
+    ihl = (ver_ihl & 0x0F) << 2  # IHL comes in 32 bit words
+    if proto == 6:
+        sport, dport, seq, ack, flags = _TCP.unpack_from(data, ihl)
+        return _new(PacketFields, (proto, ttl, src, dst, sport, dport, flags, seq, ack, 0, 0, 0))
+    elif proto == 17:
+        sport, dport = _PORTS.unpack_from(data, ihl)
+        return _new(PacketFields, (proto, ttl, src, dst, sport, dport, 0, 0, 0, 0, 0, 0))
+    elif proto == 1:
+        icmp_type, icmp_code = _ICMP.unpack_from(data, ihl)
+        return _new(PacketFields, (proto, ttl, src, dst, 0, 0, 0, 0, 0, icmp_type, icmp_code, 0))
+    elif proto == 132:
+        sport, dport, tag = _SCTP.unpack_from(data, ihl)
+        return _new(PacketFields, (proto, ttl, src, dst, sport, dport, 0, 0, 0, 0, 0, tag))
+    return _new(PacketFields, (proto, ttl, src, dst, 0, 0, 0, 0, 0, 0, 0, 0))
+
+
+def ipaddr_to_int(ipaddr):
+    """ Return the integer value of an IPv4 address string """
+    return _ADDR.unpack(socket.inet_aton(ipaddr))[0]
+
+
+if __name__ == "__main__":
+    # Microbenchmark against the dictionary based parser
+    import timeit
+    from helpers_n_wrappers import network_helper3
+
+    def _build(proto, l4):
+        ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(l4), 0, 0, 64, proto, 0,
+                         socket.inet_aton('198.51.100.7'), socket.inet_aton('192.0.2.10'))
+        return ip + l4
+
+    packets = {'tcp':  _build(6, struct.pack('!HHIIBBHHH', 40000, 80, 1000, 0, 0x50, 0x02, 1024, 0, 0)),
+               'udp':  _build(17, struct.pack('!HHHH', 40000, 53, 8, 0)),
+               'icmp': _build(1, struct.pack('!BBHHH', 8, 0, 0, 1, 1))}
+    n = 200000
+    for name, data in packets.items():
+        view = memoryview(data)
+        fields = parse_packet(view)
+        legacy = network_helper3.parse_packet_custom(data)
+        assert (fields.src, fields.dst, fields.proto, fields.ttl) == (legacy['src'], legacy['dst'], legacy['proto'], legacy['ttl'])
+        assert (fields.sport, fields.dport) == (legacy.get('sport', 0), legacy.get('dport', 0))
+        # Parse and read the fields used for the connection lookup
+        t_dict = timeit.timeit(lambda: (lambda f: (f['dst'], f.setdefault('dport', 0), f['proto']))(network_helper3.parse_packet_custom(data)), number=n)
+        t_view = timeit.timeit(lambda: (lambda f: (f.dst_int, f.dport, f.proto))(parse_packet(view)), number=n)
+        print('{:5} parse_packet_custom {:>10.0f} pkt/s | parse_packet {:>10.0f} pkt/s | x{:.2f} / {}'.format(
+              name, n / t_dict, n / t_view, t_dict / t_view, fields))
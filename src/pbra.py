@@ -34,8 +34,12 @@ import asyncio
 import logging
 import time
 import functools
-import ipaddress
+import heapq
+import itertools
 import random
+import socket
+
+import numpy as np
 
 from helpers_n_wrappers import container3
 from helpers_n_wrappers import utils3
@@ -45,6 +49,9 @@ from host import KEY_SERVICE_SFQDN
 
 import connection
 from connection import ConnectionLegacy
+from expiry import ExpiryContainer
+from sketch import PacketHistory
+from radix import PrefixTree, parse_prefix, format_prefix
 
 import dns
 import dns.message
@@ -72,11 +79,196 @@ KEY_TIMER_FQDN      = 31
 # Keys for uStateDNSHost
 KEY_DNSHOST_IPADDR  = 40
 
+# Keys for uAllocationEntry
+KEY_ALLOCATION      = 70
+KEY_ALLOCATION_CONN = 71
+
 # Common keys for reputation objects
 KEY_DNS_REPUTATION  = 50
 
-# Keys for uStateDataPacket
-KEY_DATA_PACKET     = 60
+# Memory budget of the Circular Pool packet history (bytes) and time a packet is remembered (sec)
+PACKET_HISTORY_MEMORY = 4 * 1024 * 1024
+PACKET_HISTORY_TTL    = 20
+
+
+class uReputationStore(object):
+    """
+    Array-backed storage of reputation counters for the current and previous periods.
+
+    Each reputation holder owns a row of the store and uReputation objects are views
+    into one period of that row. Reputation values and period transitions are computed
+    over all the rows with vectorized operations.
+    """
+    # Indexes of counter columns
+    OK, NOK, NEUTRAL, TOTAL, TRUSTED, UNTRUSTED, INITIAL = range(7)
+    # Indexes of periods
+    CURRENT, PREVIOUS = 0, 1
+    # Number of dummy neutral events of a new period
+    NEUTRAL_EVENTS = 5
+
+    def __init__(self, capacity=1024, ok_factor=0, nok_factor=0.15, neutral_factor=0):
+        self.ok_factor = ok_factor
+        self.nok_factor = nok_factor
+        self.neutral_factor = neutral_factor
+        self._capacity = 0
+        self._counters = np.zeros((2, 7, 0))
+        self._weights = np.zeros((2, 0))
+        self._period_n = np.zeros(0, dtype=np.int64)
+        self._period_ts = np.zeros(0)
+        self._active = np.zeros(0, dtype=bool)
+        self._free = []
+        self._grow(max(capacity, 1))
+
+    def _grow(self, capacity):
+        n = capacity - self._capacity
+        self._counters = np.concatenate((self._counters, np.zeros((2, 7, n))), axis=2)
+        self._weights = np.concatenate((self._weights, np.zeros((2, n))), axis=1)
+        self._period_n = np.concatenate((self._period_n, np.zeros(n, dtype=np.int64)))
+        self._period_ts = np.concatenate((self._period_ts, np.zeros(n)))
+        self._active = np.concatenate((self._active, np.zeros(n, dtype=bool)))
+        self._free.extend(range(capacity - 1, self._capacity - 1, -1))
+        self._capacity = capacity
+
+    def __len__(self):
+        return self._capacity - len(self._free)
+
+    def _reset_period(self, period, rows, initial_reputation):
+        counters = self._counters[period]
+        counters[:, rows] = 0
+        counters[self.NEUTRAL, rows] = self.NEUTRAL_EVENTS
+        counters[self.TOTAL, rows] = self.NEUTRAL_EVENTS
+        counters[self.INITIAL, rows] = initial_reputation
+
+    def allocate(self, initial_reputation=PBRA_REPUTATION_MIDDLE, weight_previous=0.25, weight_current=0.75):
+        """ Return a new row initialized with the given reputation values """
+        if not self._free:
+            self._grow(self._capacity * 2)
+        row = self._free.pop()
+        self._reset_period(self.CURRENT, row, initial_reputation)
+        self._reset_period(self.PREVIOUS, row, initial_reputation)
+        self._weights[self.PREVIOUS, row] = weight_previous
+        self._weights[self.CURRENT, row] = weight_current
+        self._period_n[row] = 0
+        self._period_ts[row] = time.time()
+        self._active[row] = True
+        return row
+
+    def release(self, row):
+        """ Release the row for reuse """
+        self._active[row] = False
+        self._free.append(row)
+
+    def move(self, row, other):
+        """ Move the row to another store and return the new row """
+        new_row = other.allocate()
+        other._counters[:, :, new_row] = self._counters[:, :, row]
+        other._weights[:, new_row] = self._weights[:, row]
+        other._period_n[new_row] = self._period_n[row]
+        other._period_ts[new_row] = self._period_ts[row]
+        self.release(row)
+        return new_row
+
+    def get(self, period, column, row):
+        return self._counters[period, column, row].item()
+
+    def add(self, period, column, row, value=1):
+        self._counters[period, column, row] += value
+
+    def get_period(self, row):
+        """ Return a tuple of (period_n, period_ts) """
+        return (self._period_n[row].item(), self._period_ts[row].item())
+
+    def reputation(self, period, row):
+        """ Calculate reputation value of a row based only on locally recorded events """
+        ok, nok, neutral, total, _, _, initial = self._counters[period, :, row].tolist()
+        if total == 0:
+            rep = initial
+        else:
+            rep = 0.5 * total ** self.ok_factor * (ok / total) - \
+                  0.5 * total ** self.nok_factor * (nok / total) + \
+                  initial * total ** self.neutral_factor
+
+        # Normalize reputation values between [0,1]
+        if rep <= 0:
+            return 0
+        elif rep >= 1:
+            return 1
+        else:
+            return rep
+
+    def weighted_reputation(self, row):
+        """ Calculate weighted reputation value of a row based on historic data """
+        return self._weights[self.PREVIOUS, row].item() * self.reputation(self.PREVIOUS, row) + \
+               self._weights[self.CURRENT, row].item() * self.reputation(self.CURRENT, row)
+
+    def reputations(self, period, rows):
+        """ Calculate reputation values of an array of rows """
+        ok, nok, neutral, total, _, _, initial = self._counters[period][:, rows]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rep = 0.5 * total ** self.ok_factor * (ok / total) - \
+                  0.5 * total ** self.nok_factor * (nok / total) + \
+                  initial * total ** self.neutral_factor
+        rep = np.where(total == 0, initial, rep)
+        return np.clip(rep, 0, 1)
+
+    def weighted_reputations(self, rows):
+        """ Calculate weighted reputation values of an array of rows """
+        return self._weights[self.PREVIOUS, rows] * self.reputations(self.PREVIOUS, rows) + \
+               self._weights[self.CURRENT, rows] * self.reputations(self.CURRENT, rows)
+
+    def _transition(self, rows):
+        # Use current reputation for computing next period's
+        _reputation = self.weighted_reputations(rows)
+        ## Age reputation towards the "middle point"
+        _reputation += (PBRA_REPUTATION_MIDDLE - _reputation) / 3
+        # Transition current period into previous
+        self._counters[self.PREVIOUS][:, rows] = self._counters[self.CURRENT][:, rows]
+        # Initialize current period
+        self._reset_period(self.CURRENT, rows, _reputation)
+        self._period_n[rows] += 1
+        self._period_ts[rows] = time.time()
+
+    def transition(self, rows, periods=1):
+        """ Transition an array of rows a number of periods """
+        rows = np.atleast_1d(rows)
+        # The first two transitions consume the recorded events
+        for _ in range(min(periods, 2)):
+            self._transition(rows)
+        periods -= 2
+        if periods <= 0:
+            return
+
+        weight_previous = self._weights[self.PREVIOUS, rows]
+        weight_current = self._weights[self.CURRENT, rows]
+        if self.neutral_factor != 0 or np.any(weight_previous + weight_current > 1):
+            # Reputation of event-free periods may be clipped, age one period at a time
+            for _ in range(periods):
+                self._transition(rows)
+            return
+
+        # Both periods are now event-free and their reputation equals their initial value.
+        # Ageing follows the affine recurrence r(n) = 2/3 * (wc * r(n-1) + wp * r(n-2)) + M/3
+        # that is solved in closed form with the matrix power over (r(n-1), r(n-2), 1)
+        m = np.zeros((len(rows), 3, 3))
+        m[:, 0, 0] = 2 * weight_current / 3
+        m[:, 0, 1] = 2 * weight_previous / 3
+        m[:, 0, 2] = PBRA_REPUTATION_MIDDLE / 3
+        m[:, 1, 0] = 1
+        m[:, 2, 2] = 1
+        v = np.stack((self._counters[self.CURRENT, self.INITIAL, rows],
+                      self._counters[self.PREVIOUS, self.INITIAL, rows],
+                      np.ones(len(rows))), axis=1)
+        v = np.matmul(np.linalg.matrix_power(m, periods), v[:, :, np.newaxis])[:, :, 0]
+        self._reset_period(self.CURRENT, rows, v[:, 0])
+        self._reset_period(self.PREVIOUS, rows, v[:, 1])
+        self._period_n[rows] += periods
+        self._period_ts[rows] = time.time()
+
+    def transition_all(self):
+        """ Transition all the allocated rows to the next period and return them """
+        rows = np.flatnonzero(self._active)
+        self.transition(rows)
+        return rows
 
 
 class uReputation(object):
@@ -89,87 +281,139 @@ class uReputation(object):
     ok_factor = 0
     ok_factor = 0.15
     neutral_factor = 0
+
+    The counters are stored in a uReputationStore. A standalone object creates its own store.
     """
 
-    def __init__(self, initial_reputation=0.45, ok_factor=0, nok_factor=0.15, neutral_factor=0):
+    def __init__(self, initial_reputation=0.45, ok_factor=0, nok_factor=0.15, neutral_factor=0, store=None, row=None, period=uReputationStore.CURRENT):
         self.name = id(self)
-        self.initial_reputation = initial_reputation
-        self.ok_factor = ok_factor
-        self.nok_factor = nok_factor
-        self.neutral_factor = neutral_factor
-        # Define counters
-        self.ok = 0
-        self.nok = 0
-        self.neutral = 0
-        self.total = 0
-        self.trusted = 0
-        self.untrusted = 0
-        # Create dummy events upon initialization
-        [self.event_neutral() for _ in range(5)]
+        if store is None:
+            store = uReputationStore(capacity=1, ok_factor=ok_factor, nok_factor=nok_factor, neutral_factor=neutral_factor)
+            row = store.allocate(initial_reputation)
+        self._store = store
+        self._row = row
+        self._period = period
 
-    def event_ok(self):
-        self.ok += 1
-        self.total += 1
+    def _get(self, column):
+        return int(self._store.get(self._period, column, self._row))
 
-    def event_nok(self):
-        self.nok += 1
-        self.total += 1
+    @property
+    def initial_reputation(self):
+        return self._store.get(self._period, uReputationStore.INITIAL, self._row)
 
-    def event_neutral(self):
-        self.neutral += 1
-        self.total += 1
+    @property
+    def ok(self):
+        return self._get(uReputationStore.OK)
 
-    def event_trusted(self):
-        self.trusted += 1
+    @property
+    def nok(self):
+        return self._get(uReputationStore.NOK)
 
-    def event_untrusted(self):
-        self.untrusted += 1
+    @property
+    def neutral(self):
+        return self._get(uReputationStore.NEUTRAL)
 
     @property
-    def _ok_factor(self):
-        # Define a ok_factor that rewards ok event
-        return self.total ** self.ok_factor
+    def total(self):
+        return self._get(uReputationStore.TOTAL)
 
     @property
-    def _nok_factor(self):
-        # Define a nok_factor that penalizes nok events
-        return self.total ** self.nok_factor
+    def trusted(self):
+        return self._get(uReputationStore.TRUSTED)
 
     @property
-    def _neutral_factor(self):
-        # Define a nok_factor that penalizes nok events
-        return self.total ** self.neutral_factor
+    def untrusted(self):
+        return self._get(uReputationStore.UNTRUSTED)
+
+    def event_ok(self):
+        self._store.add(self._period, uReputationStore.OK, self._row)
+        self._store.add(self._period, uReputationStore.TOTAL, self._row)
+
+    def event_nok(self):
+        self._store.add(self._period, uReputationStore.NOK, self._row)
+        self._store.add(self._period, uReputationStore.TOTAL, self._row)
+
+    def event_neutral(self):
+        self._store.add(self._period, uReputationStore.NEUTRAL, self._row)
+        self._store.add(self._period, uReputationStore.TOTAL, self._row)
+
+    def event_trusted(self):
+        self._store.add(self._period, uReputationStore.TRUSTED, self._row)
+
+    def event_untrusted(self):
+        self._store.add(self._period, uReputationStore.UNTRUSTED, self._row)
 
     @property
     def reputation(self):
         """ Calculate reputation value based only on locally recorded events """
-        try:
-            rep = 0.5 * self._ok_factor * (self.ok / self.total) - \
-                  0.5 * self._nok_factor * (self.nok / self.total) + \
-                  self.initial_reputation * self._neutral_factor
-        except ZeroDivisionError as e:
-            rep = self.initial_reputation
-
-        # Normalize reputation values between [0,1]
-        if rep <= 0:
-            return 0
-        elif rep >= 1:
-            return 1
-        else:
-            return rep
+        return self._store.reputation(self._period, self._row)
 
     def merge(self, other):
-        # Merge self reputation values with other
-        [self.event_ok()        for i in range(other.ok)]
-        [self.event_nok()       for i in range(other.nok)]
-        [self.event_neutral()   for i in range(other.neutral)]
-        [self.event_trusted()   for i in range(other.trusted)]
-        [self.event_untrusted() for i in range(other.untrusted)]
+        # Merge self reputation values with other by adding up the counters
+        for column in (uReputationStore.OK, uReputationStore.NOK, uReputationStore.NEUTRAL,
+                       uReputationStore.TRUSTED, uReputationStore.UNTRUSTED):
+            self._store.add(self._period, column, self._row, other._get(column))
+        self._store.add(self._period, uReputationStore.TOTAL, self._row, other.ok + other.nok + other.neutral)
 
     def __repr__(self):
         return '[{}] neutral={} ok={} nok={} reputation={:.3f} / trusted={} untrusted={}'.format(self.name, self.neutral, self.ok, self.nok, self.reputation, self.trusted, self.untrusted)
 
 
+class uReputationTracker(object):
+    """
+    Keep track of the highest reputation among the registered reputation objects.
+
+    Objects are re-inserted in a max-heap whenever their reputation changes and
+    outdated entries are discarded lazily, so max_reputation() is O(1) amortized.
+    """
+    def __init__(self):
+        self._heap = []         # Stores [-reputation, seq, node] entries
+        self._entries = {}      # Indexes node ids to heap entries
+        self._seq = itertools.count()
+
+    def update(self, node):
+        """ Register the current reputation of the node """
+        entry = self._entries.pop(id(node), None)
+        if entry is not None:
+            entry[-1] = None
+        entry = [-node.reputation, next(self._seq), node]
+        self._entries[id(node)] = entry
+        heapq.heappush(self._heap, entry)
+        # Compact heap if outdated entries take over
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [entry for entry in self._heap if entry[-1] is not None]
+            heapq.heapify(self._heap)
+
+    def discard(self, node):
+        """ Unregister the node """
+        entry = self._entries.pop(id(node), None)
+        if entry is not None:
+            entry[-1] = None
+
+    def clear(self):
+        self._heap.clear()
+        self._entries.clear()
+
+    def rebuild(self, nodes, reputations):
+        """ Register all the nodes with their precomputed reputations """
+        self._heap = []
+        self._entries = {}
+        for node, reputation in zip(nodes, reputations):
+            entry = [-reputation, next(self._seq), node]
+            self._entries[id(node)] = entry
+            self._heap.append(entry)
+        heapq.heapify(self._heap)
+
+    def max_reputation(self):
+        """ Return the highest registered reputation or None """
+        heap = self._heap
+        while heap and heap[0][-1] is None:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return -heap[0][0]
+
+
 class uDNSQueryTimer(container3.ContainerNode):
     TIMEOUT = 5.0
 
@@ -206,9 +450,136 @@ class uDNSQueryTimer(container3.ContainerNode):
         return '[{}] resolver={} service={} alias_service={} timeout={} sec'.format(self._name, self.ipaddr, self.service, self.alias_service, self.timeout)
 
 
-class uStateDNSHost(container3.ContainerNode):
+class uAllocationEntry(container3.ContainerNode):
+    """ This class stores the address allocated to a WAN query for answering its retransmissions """
+    def __init__(self, key, ipaddr, conn, timeout):
+        super().__init__('uAllocationEntry')
+        self.key = key
+        self.ipaddr = ipaddr
+        self.conn = conn
+        self.timestamp_eol = time.time() + timeout
+
+    def hasexpired(self):
+        """ Return True if the timeout has expired """
+        return time.time() > self.timestamp_eol
+
+    def lookupkeys(self):
+        """ Return the lookup keys """
+        return [((KEY_ALLOCATION, self.key), True),
+                ((KEY_ALLOCATION_CONN, id(self.conn)), True)]
+
+    def __repr__(self):
+        return '[{}] key={} ipaddr={}'.format(self._name, self.key, self.ipaddr)
+
+
+class uAllocationCache(ExpiryContainer):
+    """
+    Short-lived cache of Circular Pool allocations keyed by (resolver addr, query id, fqdn, rdtype, ECS prefix).
+
+    UDP retransmissions of a WAN query are answered with the address allocated to the original query
+    instead of being evaluated again. Entries live as long as the connection created by the allocation.
+    """
+    def __init__(self, name='uAllocationCache'):
+        super().__init__(name)
+        self.nofhits = 0
+        self.nofmisses = 0
+
+    @staticmethod
+    def build_key(query, addr):
+        return (addr, query.id, query.fqdn, query.question[0].rdtype, query.requestor_prefix)
+
+    def get_allocation(self, key):
+        """ Return the address allocated for the key or None """
+        self.pop_expired(time.time(), callback=False)
+        entry = self.lookup((KEY_ALLOCATION, key), update=False, check_expire=False)
+        if entry is None:
+            self.nofmisses += 1
+            return None
+        self.nofhits += 1
+        return entry.ipaddr
+
+    def set_allocation(self, key, ipaddr, conn):
+        """ Cache the address allocated for the key with the new connection """
+        entry = self.lookup((KEY_ALLOCATION, key), update=False, check_expire=False)
+        if entry is not None:
+            self.remove(entry, callback=False)
+        self.add(uAllocationEntry(key, ipaddr, conn, conn.timeout))
+
+    def discard_connection(self, conn):
+        """ Remove the entry of a deleted connection """
+        entry = self.lookup((KEY_ALLOCATION_CONN, id(conn)), update=False, check_expire=False)
+        if entry is not None and entry.conn is conn:
+            self.remove(entry, callback=False)
+
+    def stats(self):
+        return {'entries': len(self), 'hits': self.nofhits, 'misses': self.nofmisses}
+
+
+class _uStateReputation(container3.ContainerNode):
+    """ Base class of the DNS nodes that hold reputation values in a uReputationStore row """
+    def _init_reputation(self, store):
+        # Create a standalone store if not provided
+        if store is None:
+            store = uReputationStore(capacity=1)
+        self._store = store
+        self._row = store.allocate(self.initial_reputation, self.weight_previous, self.weight_current)
+        # Create reputation views of the current and previous periods
+        self.reputation_current = uReputation(store=store, row=self._row, period=uReputationStore.CURRENT)
+        self.reputation_previous = uReputation(store=store, row=self._row, period=uReputationStore.PREVIOUS)
+        # Tracker of the highest reputation, set when added to PolicyBasedResourceAllocation
+        self._tracker = None
+
+    def _move_reputation(self, store):
+        """ Move reputation values to another store """
+        row = self._store.move(self._row, store)
+        self._store, self._row = store, row
+        for view in (self.reputation_current, self.reputation_previous):
+            view._store, view._row = store, row
+
+    @property
+    def period_n(self):
+        return self._store.get_period(self._row)[0]
+
+    @property
+    def period_ts(self):
+        return self._store.get_period(self._row)[1]
+
+    def transition_period(self, periods=1):
+        # Transition to next period(s) and age reputation towards the "middle point"
+        self._store.transition(self._row, periods)
+        self._reputation_changed()
+
+    @property
+    def reputation(self):
+        return self._store.weighted_reputation(self._row)
+
+    def _reputation_changed(self):
+        # Notify the tracker of the highest reputation
+        if self._tracker is not None:
+            self._tracker.update(self)
+
+    def event_ok(self):
+        self.reputation_current.event_ok()
+        self._reputation_changed()
+
+    def event_nok(self):
+        self.reputation_current.event_nok()
+        self._reputation_changed()
+
+    def event_neutral(self):
+        self.reputation_current.event_neutral()
+        self._reputation_changed()
+
+    def event_trusted(self):
+        self.reputation_current.event_trusted()
+
+    def event_untrusted(self):
+        self.reputation_current.event_untrusted()
+
+
+class uStateDNSHost(_uStateReputation):
     """ This class defines a DNS advertised node via EDNS0 ClientSubnet / Extended Client Information / Name Client Identifier """
-    def __init__(self, **kwargs):
+    def __init__(self, store=None, **kwargs):
         super().__init__('uStateDNSHost')
         ## IP source / EDNS0 ClientSubnet / Extended Client Information
         self.ipaddr      = None
@@ -217,83 +588,44 @@ class uStateDNSHost(container3.ContainerNode):
         self.ncid        = (None, None)
         # Override attributes
         utils3.set_attributes(self, override=True, **kwargs)
-        ## Convert IPaddr/mask to network address
-        self._ipaddr = ipaddress.ip_network('{}/{}'.format(self.ipaddr, self.ipaddr_mask), strict=False)
+        ## Convert IPaddr/mask to integer network address
+        self.family, self.network, self.ipaddr_mask = parse_prefix(self.ipaddr, self.ipaddr_mask)
+        self._hostmask = (1 << ((32 if self.family == socket.AF_INET else 128) - self.ipaddr_mask)) - 1
         # Overwrite ipaddr with network address
-        self.ipaddr = format(self._ipaddr.network_address)
+        self.ipaddr = format_prefix(self.family, self.network)
 
         # Define reputation parameters
         self.initial_reputation = PBRA_REPUTATION_MIDDLE
-        self.period_n = 0
-        self.period_ts = time.time()
         self.weight_previous = 0.25
         self.weight_current = 0.75
         # Create reputation objects
-        self.reputation_current = uReputation(initial_reputation = self.initial_reputation)
-        self.reputation_previous = uReputation(initial_reputation = self.initial_reputation)
+        self._init_reputation(store)
 
     def lookupkeys(self):
         """ Return the lookup keys """
         # Return an iterable (key, isunique)
         keys = []
         # Typical keys of an advertised DNS host and data host
-        keys.append(((KEY_DNSHOST_IPADDR, self.ipaddr), True))
+        keys.append(((KEY_DNSHOST_IPADDR, self.ipaddr, self.ipaddr_mask), True))
         #keys.append(((KEY_DNSHOST_NCID, self.ncid), True))
         # Common key for indexing all reputation objects
         keys.append((KEY_DNS_REPUTATION, False))
         return keys
 
-    def contains(self, ipaddr):
-        """ Return True if ipaddr exists in the defined network """
-        try:
-            return ipaddress.ip_address(ipaddr) in self._ipaddr
-        except:
+    def contains(self, ipaddr, family=socket.AF_INET):
+        """ Return True if ipaddr exists in the defined network, as string or integer of the given family """
+        if not isinstance(ipaddr, int):
+            try:
+                family, ipaddr, _ = parse_prefix(ipaddr)
+            except ValueError:
+                return False
+        if family != self.family:
             return False
+        return ipaddr & ~self._hostmask == self.network
 
     def __repr__(self):
         return '[{}] ipaddr={}/{} ncid={} / reputation previous={:.3f} current={:.3f} weighted_avg={:.3f}'.format(self._name, self.ipaddr, self.ipaddr_mask, self.ncid, self.reputation_previous.reputation, self.reputation_current.reputation, self.reputation)
 
-    def transition_period(self):
-        # Transition to next period
-        self.period_n += 1
-        self.period_ts = time.time()
-        # Use current reputation for computing next period's
-        _reputation = self.reputation
-        # Transition current reputation object into previous
-        del self.reputation_previous
-        self.reputation_previous = self.reputation_current
-
-        # Calculate absolute distance for ageing
-        distance = abs(_reputation - PBRA_REPUTATION_MIDDLE)
-        ## Age reputation towards the "middle point"
-        if _reputation < PBRA_REPUTATION_MIDDLE:
-            _reputation += distance / 3
-        elif _reputation > PBRA_REPUTATION_MIDDLE:
-            _reputation -= distance / 3
-
-        # Create new reputation object for current period
-        self.reputation_current = uReputation(initial_reputation = _reputation)
-
-    @property
-    def reputation(self):
-        return self.weight_previous * self.reputation_previous.reputation + \
-               self.weight_current * self.reputation_current.reputation
-
-    def event_ok(self):
-        self.reputation_current.event_ok()
-
-    def event_nok(self):
-        self.reputation_current.event_nok()
-
-    def event_neutral(self):
-        self.reputation_current.event_neutral()
-
-    def event_trusted(self):
-        self.reputation_current.event_trusted()
-
-    def event_untrusted(self):
-        self.reputation_current.event_untrusted()
-
 
 class uStateDNSResolver(container3.ContainerNode):
     """ This class stores the state information available for any DNS resolver node """
@@ -320,15 +652,11 @@ class uStateDNSResolver(container3.ContainerNode):
         return '[{}] ipaddr={}'.format(self._name, self.ipaddr)
 
 
-class uStateDNSGroup(container3.ContainerNode):
+class uStateDNSGroup(_uStateReputation):
     """ This class stores the state information available for any DNS node (resolver or requestor) """
-    def __init__(self, **kwargs):
+    def __init__(self, store=None, **kwargs):
         super().__init__('uStateDNSGroup')
 
-        # Set default attributes
-        self.period_n = 0
-        self.period_ts = time.time()
-
         # Define weighted values for reputation calculation based on historic data
         self.weight_previous = 0.25
         self.weight_current = 0.75
@@ -349,8 +677,7 @@ class uStateDNSGroup(container3.ContainerNode):
         self.group_id = id(self)
 
         # Create reputation objects
-        self.reputation_current = uReputation(initial_reputation = self.initial_reputation)
-        self.reputation_previous = uReputation(initial_reputation = self.initial_reputation)
+        self._init_reputation(store)
 
     def lookupkeys(self):
         """ Return the lookup keys """
@@ -367,47 +694,6 @@ class uStateDNSGroup(container3.ContainerNode):
         keys.append((KEY_DNS_REPUTATION, False))
         return keys
 
-    def transition_period(self):
-        # Transition to next period
-        self.period_n += 1
-        self.period_ts = time.time()
-        # Use current reputation for computing next period's
-        _reputation = self.reputation
-        # Transition current reputation object into previous
-        del self.reputation_previous
-        self.reputation_previous = self.reputation_current
-
-        # Calculate absolute distance for ageing
-        distance = abs(_reputation - PBRA_REPUTATION_MIDDLE)
-        ## Age reputation towards the "middle point"
-        if _reputation < PBRA_REPUTATION_MIDDLE:
-            _reputation += distance / 3
-        elif _reputation > PBRA_REPUTATION_MIDDLE:
-            _reputation -= distance / 3
-
-        # Create new reputation object for current period
-        self.reputation_current = uReputation(initial_reputation = _reputation)
-
-    @property
-    def reputation(self):
-        return self.weight_previous * self.reputation_previous.reputation + \
-               self.weight_current * self.reputation_current.reputation
-
-    def event_ok(self):
-        self.reputation_current.event_ok()
-
-    def event_nok(self):
-        self.reputation_current.event_nok()
-
-    def event_neutral(self):
-        self.reputation_current.event_neutral()
-
-    def event_trusted(self):
-        self.reputation_current.event_trusted()
-
-    def event_untrusted(self):
-        self.reputation_current.event_untrusted()
-
     def __repr__(self):
         return '[{}] period={} ipaddrs={} sla={} / reputation previous={:.3f} current={:.3f} weighted_avg={:.3f}'.format(self._name, self.period_n, self.nodes, self.sla,
                                                                                                           self.reputation_previous.reputation,
@@ -428,11 +714,11 @@ class uStateDNSGroup(container3.ContainerNode):
         # Calculate last period value and transition reputations to catch up
         last_period_n = max(self.period_n, other.period_n)
         ## Age myself to catch up with last period
-        for i in range(self.period_n, last_period_n):
-            self.transition_period()
+        if self.period_n < last_period_n:
+            self.transition_period(last_period_n - self.period_n)
         ## Age other to catch up with last period
-        for i in range(other.period_n, last_period_n):
-            other.transition_period()
+        if other.period_n < last_period_n:
+            other.transition_period(last_period_n - other.period_n)
 
         # Update self reputation values with other
         ## Previous reputation period
@@ -444,80 +730,22 @@ class uStateDNSGroup(container3.ContainerNode):
         if self.sla or other.sla:
             self.sla = True
 
-class uStateDataPacket(container3.ContainerNode):
-    """ This class stores the packet information available for any data source """
-    def __init__(self, src, dst):
-        # Receive an exploded dict of packet_fields
-        super().__init__('uStateDataPacket')
-        self.src = src
-        self.dst = dst
-        # Use dictionary to record seen packets
-        self.state = {}
-
-    def lookupkeys(self):
-        """ Return the lookup keys """
-        # Return an iterable (key, isunique)
-        keys = []
-        # Create unique key based on IP src and dst
-        keys.append(((KEY_DATA_PACKET, (self.src, self.dst)), True))
-        return keys
-
-    def hasexpired(self):
-        """ Return True if the timeout has expired """
-        ts_now = time.time()
-        delete_keys = []
-        for key, (_n, _t) in self.state.items():
-            if ts_now < _t:
-                continue
-            delete_keys.append(key)
-        for key in delete_keys:
-            del self.state[key]
-
-    def _generate_packet_key(self, **kwargs):
-        _proto = kwargs['proto']
-        if _proto == 1:
-            _type, _code = kwargs['icmp-type'], kwargs['icmp-code']
-            key = (_type, _code)
-        elif _proto == 6:
-            _sport, _dport = kwargs['sport'], kwargs['dport']
-            _seq, _ack, _flags = kwargs['tcp_seq'], kwargs['tcp_ack'], kwargs['tcp_flags']
-            key = (_sport, _dport, _seq, _ack)
-        elif _proto == 17:
-            _sport, _dport = kwargs['sport'], kwargs['dport']
-            key = (_sport, _dport)
-        elif _proto == 132:
-            _sport, _dport = kwargs['sport'], kwargs['dport']
-            _tag = kwargs['sctp_tag']
-            key = (_sport, _dport)
-        else:
-            return _proto
-        return key
-
-    def has_record(self, **kwargs):
-        key = self._generate_packet_key(**kwargs)
-        return (key in self.state)
-
-    def add_record(self, **kwargs):
-        key = self._generate_packet_key(**kwargs)
-        # Use a TTL of 20 seconds per record
-        ttl = 20
-        ts_eol = time.time() + ttl
-        if key in self.state:
-            _n, _t = self.state[key]
-            self.state[key] = (_n+1, ts_eol)
-        else:
-            self.state[key] = (1, ts_eol)
-
-    def get_record(self, **kwargs):
-        key = self._generate_packet_key(**kwargs)
-        assert(key in self.state)
-        return self.state[key]
+        self._reputation_changed()
 
-    def __repr__(self):
-        return '[{}] src={} dst={}\n{}'.format(self._name, self.src, self.dst, self.state)
+def _packet_key(packet_fields):
+    """ Return the key of a packet for the pre-accept tracking of the Circular Pool """
+    _proto = packet_fields.proto
+    if _proto == 1:
+        return (packet_fields.src_int, packet_fields.dst_int, _proto, packet_fields.icmp_type, packet_fields.icmp_code)
+    elif _proto == 6:
+        return (packet_fields.src_int, packet_fields.dst_int, _proto, packet_fields.sport, packet_fields.dport,
+                packet_fields.tcp_seq, packet_fields.tcp_ack)
+    elif _proto == 17 or _proto == 132:
+        return (packet_fields.src_int, packet_fields.dst_int, _proto, packet_fields.sport, packet_fields.dport)
+    return (packet_fields.src_int, packet_fields.dst_int, _proto)
 
 
-class PolicyBasedResourceAllocation(container3.Container):
+class PolicyBasedResourceAllocation(ExpiryContainer):
     """
     Control variable
 
@@ -549,10 +777,22 @@ class PolicyBasedResourceAllocation(container3.Container):
                    ]
 
     def __init__(self, **kwargs):
-        """ Initialize as a Container """
+        """ Initialize as an ExpiryContainer """
         super().__init__('PolicyBasedResourceAllocation')
+        # Store reputation values of uStateDNSHost and uStateDNSGroup nodes
+        self.reputation_store = uReputationStore()
+        # Track the highest reputation of uStateDNSHost and uStateDNSGroup nodes
+        self.reputation_tracker = uReputationTracker()
+        # Answer retransmitted WAN queries with their previous Circular Pool allocation
+        self.allocation_cache = uAllocationCache()
+        # Index the network of uStateDNSHost nodes for longest-prefix match
+        self.requestor_prefixes = {socket.AF_INET: PrefixTree(32), socket.AF_INET6: PrefixTree(128)}
+        # Default memory budget of the packet history
+        self.packet_memory = PACKET_HISTORY_MEMORY
         # Override attributes
         utils3.set_attributes(self, override=True, **kwargs)
+        # Record the packets seen in the Circular Pool within a bounded memory
+        self.packet_history = PacketHistory(memory=self.packet_memory, ttl=PACKET_HISTORY_TTL)
         # Load CircularPool control variables
         self._init_circularpool_control_variables()
         # Load CircularPool pre configured DNS groups
@@ -589,7 +829,7 @@ class PolicyBasedResourceAllocation(container3.Container):
         for dnsgroup_kwargs in cpool_policy['DNS_GROUP_POLICY']:
             # Create new DNS group with single DNS node
             self._logger.debug('Create new DNS group: {}'.format(dnsgroup_kwargs))
-            dnsgroup_obj = uStateDNSGroup(**dnsgroup_kwargs)
+            dnsgroup_obj = uStateDNSGroup(store=self.reputation_store, **dnsgroup_kwargs)
             self.add(dnsgroup_obj)
 
             # Iterate node IP addresses and create new DNS nodes
@@ -600,26 +840,62 @@ class PolicyBasedResourceAllocation(container3.Container):
             # Update keys after nodes changes
             self.updatekeys(dnsgroup_obj)
 
+    def add(self, node):
+        super().add(node)
+        if isinstance(node, uStateDNSHost):
+            self.requestor_prefixes[node.family].insert(node.network, node.ipaddr_mask, node)
+        if isinstance(node, _uStateReputation):
+            if node._store is not self.reputation_store:
+                node._move_reputation(self.reputation_store)
+            node._tracker = self.reputation_tracker
+            self.reputation_tracker.update(node)
+
+    def remove(self, node, callback=True):
+        if isinstance(node, uStateDNSHost):
+            self.requestor_prefixes[node.family].remove(node.network, node.ipaddr_mask)
+        if isinstance(node, _uStateReputation):
+            self.reputation_tracker.discard(node)
+            node._tracker = None
+            # Detach reputation values, the node may still be referenced by pending queries
+            node._move_reputation(uReputationStore(capacity=1))
+        super().remove(node, callback)
+
+    def removeall(self, callback=True):
+        nodes = self.lookup(KEY_DNS_REPUTATION, update=False, check_expire=False)
+        for node in list(nodes or []):
+            node._tracker = None
+            node._move_reputation(uReputationStore(capacity=1))
+        super().removeall(callback)
+        self.reputation_tracker.clear()
+        for tree in self.requestor_prefixes.values():
+            tree.clear()
+
     def cleanup_timers(self):
         """ Perform a cleanup of expired timer objects """
         self._logger.warning('Initiating cleanup of timers')
-        nodes = self.lookup(KEY_TIMER, update=False, check_expire=False)
-        if nodes is None:
-            return
-        for node in list(nodes):
-            if node.hasexpired():
-                self.remove(node)
-        self._logger.warning('Terminated cleanup of timers')
+        # Only uDNSQueryTimer nodes define timestamp_eol in the expiry index
+        nodes = self.pop_expired(time.time())
+        self._logger.warning('Terminated cleanup of timers: {} expired'.format(len(nodes)))
 
     def debug_dnsgroups(self, transition = False):
         # For debugging purposes
         self._logger.warning('Initiating debug_dnsgroups: transition={}'.format(transition))
         nodes = self.lookup(KEY_DNS_REPUTATION, update=False, check_expire=False)
         if nodes and transition:
-            for node in nodes:
-                self._logger.warning('[1] {}\n\t>> {}'.format(node, node.reputation_current))
-                node.transition_period()
-                self._logger.warning('[2] {}\n\t>> {}'.format(node, node.reputation_current))
+            nodes = list(nodes)
+            _debug = self._logger.isEnabledFor(logging.DEBUG)
+            if _debug:
+                for node in nodes:
+                    self._logger.debug('[1] {}\n\t>> {}'.format(node, node.reputation_current))
+            # Transition all reputation objects at once
+            _t0 = time.time()
+            self.reputation_store.transition_all()
+            rows = np.fromiter((node._row for node in nodes), dtype=np.intp, count=len(nodes))
+            self.reputation_tracker.rebuild(nodes, self.reputation_store.weighted_reputations(rows).tolist())
+            self._logger.warning('Transitioned {} reputation objects in {:.3f} msec'.format(len(nodes), (time.time() - _t0) * 1000))
+            if _debug:
+                for node in nodes:
+                    self._logger.debug('[2] {}\n\t>> {}'.format(node, node.reputation_current))
 
         self._logger.warning('Terminated debug_dnsgroups: transition={}'.format(transition))
 
@@ -658,7 +934,7 @@ class PolicyBasedResourceAllocation(container3.Container):
             dnsnode_obj = uStateDNSResolver(ipaddr=addr[0])
             self.add(dnsnode_obj)
             ## Create new DNS group with single DNS node
-            dnsgroup_obj = uStateDNSGroup()
+            dnsgroup_obj = uStateDNSGroup(store=self.reputation_store)
             dnsgroup_obj.nodes.append(dnsnode_obj.ipaddr)
             self.add(dnsgroup_obj)
             # Add reputation to the DNS query
@@ -701,18 +977,28 @@ class PolicyBasedResourceAllocation(container3.Container):
 
         if meta_flag is False:
             query.reputation_requestor = None
+            query.requestor_prefix = None
             return
 
-        ipaddr_lookupkey = format(ipaddress.ip_network('{}/{}'.format(meta_ipaddr, meta_mask), strict=False).network_address)
+        try:
+            family, network, prefixlen = parse_prefix(meta_ipaddr, meta_mask)
+        except ValueError:
+            self._logger.warning('Invalid requestor ipaddr={}/{}'.format(meta_ipaddr, meta_mask))
+            query.reputation_requestor = None
+            query.requestor_prefix = None
+            return
+        query.requestor_prefix = (network, prefixlen)
 
-        if self.has((KEY_DNSHOST_IPADDR, ipaddr_lookupkey)):
+        # Aggregate nested prefixes in the existing requestor covering the advertised network
+        match = self.requestor_prefixes[family].longest_match(network, prefixlen)
+        if match is not None:
             # Get existing object
-            dnshost_obj = self.get((KEY_DNSHOST_IPADDR, ipaddr_lookupkey))
+            dnshost_obj = match[1]
             self._logger.debug('Retrieved existing uStateDNSHost for requestor ipaddr={}/{}'.format(meta_ipaddr, meta_mask))
 
-        elif self.has((KEY_DNSHOST_IPADDR, ipaddr_lookupkey)) is False and create is True:
+        elif create is True:
             self._logger.info('Create uStateDNSHost for requestor ipaddr={}/{}'.format(meta_ipaddr, meta_mask))
-            dnshost_obj = uStateDNSHost(ipaddr = meta_ipaddr, ipaddr_mask = meta_mask)
+            dnshost_obj = uStateDNSHost(ipaddr = meta_ipaddr, ipaddr_mask = meta_mask, store = self.reputation_store)
             self.add(dnshost_obj)
 
         '''
@@ -857,6 +1143,12 @@ class PolicyBasedResourceAllocation(container3.Container):
             self._logger.critical('Using cached result {} ({}) / {}'.format(fqdn, dns.rdatatype.to_text(rdtype), allocated_ipv4))
             return allocated_ipv4
 
+        # Get allocation of a retransmitted query
+        allocated_ipv4 = self.allocation_cache.get_allocation(uAllocationCache.build_key(query, addr))
+        if allocated_ipv4 is not None:
+            self._logger.info('Using allocation of retransmitted query {} ({}) from {}:{} / {}'.format(fqdn, dns.rdatatype.to_text(rdtype), addr[0], addr[1], allocated_ipv4))
+            return allocated_ipv4
+
         # Evaluate host data service and use appropriate address pool
         if service_data['proxy_required'] is True:
             # Resolve via Service Pool
@@ -872,6 +1164,17 @@ class PolicyBasedResourceAllocation(container3.Container):
         self._rgw_cache_set(fqdn, rdtype, allocated_ipv4)
         return allocated_ipv4
 
+    @asyncio.coroutine
+    def pbra_dns_wait_release(self, query, timeout):
+        """ Wait until an address is released to the Circular Pool. Queries with higher reputation are woken up first """
+        priority = 0
+        for reputation_obj in (query.reputation_resolver, query.reputation_requestor):
+            if reputation_obj is not None:
+                priority = max(priority, reputation_obj.reputation)
+        ap_cpool = self.pooltable.get('circularpool')
+        released = yield from ap_cpool.wait_release(priority, timeout)
+        return released
+
     def _rgw_cache_get(self, fqdn, rdtype):
         """ Return an existing cached rdata for an fqdn/rdtype """
         timer_obj = self.lookup((KEY_TIMER_FQDN, fqdn))
@@ -936,11 +1239,10 @@ class PolicyBasedResourceAllocation(container3.Container):
 
         We opt to normalize the reputation in a new interval [0, max_reputation] to unlock resource access to the best reputed nodes.
         """
-        # Get list of nodes
-        nodes = self.lookup(KEY_DNS_REPUTATION, update=False, check_expire=False)
-
         # Obtain the highest reputation of the existing nodes
-        max_reputation = max(nodes, key=lambda node: node.reputation).reputation
+        max_reputation = self.reputation_tracker.max_reputation()
+        if max_reputation is None:
+            max_reputation = 0
 
         ## Scale normalized [0,1] value to new range [x, y]
         normalized_f = lambda value, x, y: (value * (y - x)) + x
@@ -1056,7 +1358,9 @@ class PolicyBasedResourceAllocation(container3.Container):
         elif pool_available > 0:
             # Allocate a new address from the pool
             allocated_ipv4 = ap_cpool.allocate()
-            self._logger.debug('Allocated address from CircularPool: {} / allocated={} available={}'.format(allocated_ipv4, ap_cpool.get_allocated(), ap_cpool.get_available()))
+            # Listing the pool is not free, only do it when debugging
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug('Allocated address from CircularPool: {} / allocated={} available={}'.format(allocated_ipv4, ap_cpool.get_allocated(), ap_cpool.get_available()))
         else:
             _dns_host_ipaddr = dns_host.ipaddr if dns_host else None
             self._logger.warning('Failed to allocate a new address from CircularPool: {} for {} @ {}'.format(fqdn_alias, _dns_host_ipaddr, dns_resolver))
@@ -1083,10 +1387,12 @@ class PolicyBasedResourceAllocation(container3.Container):
                       }
 
         conn = ConnectionLegacy(**conn_param)
-        # Monkey patch delete function as a coroutine for the connection object
-        conn.delete = functools.partial(asyncio.ensure_future, self._cb_connection_deleted(conn))
+        # Monkey patch delete function for the connection object
+        conn.delete = functools.partial(self._connection_deleted, conn)
         # Add connection to table
         self.connectiontable.add(conn)
+        # Cache allocation for retransmissions of the query
+        self.allocation_cache.set_allocation(uAllocationCache.build_key(query, addr), allocated_ipv4, conn)
         # Log
         via_text = '(via {})'.format(fqdn_query) if fqdn_query != fqdn_alias else ''
         self._logger.info('Allocated IP address from Circular Pool: {} @ {} for {:.3f} msec {}'.format(fqdn_alias, allocated_ipv4, conn.timeout*1000, via_text))
@@ -1101,6 +1407,12 @@ class PolicyBasedResourceAllocation(container3.Container):
         # Return the allocated address
         return allocated_ipv4
 
+    def _connection_deleted(self, conn):
+        # Stop answering retransmissions with the address before it can be released and allocated again
+        self.allocation_cache.discard_connection(conn)
+        # Schedule the delete callback as a coroutine
+        asyncio.ensure_future(self._cb_connection_deleted(conn))
+
     @asyncio.coroutine
     def _cb_connection_deleted(self, conn):
         self._logger.debug('Delete callback for node {}'.format(conn))
@@ -1151,7 +1463,8 @@ class PolicyBasedResourceAllocation(container3.Container):
         except ValueError:
             self._logger.debug('Failed to release IP address to Circular Pool: {}'.format(ipaddr))
         finally:
-            self._logger.debug('  >> Current CircularPool: allocated={} available={}'.format(ap_cpool.get_allocated(), ap_cpool.get_available()))
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug('  >> Current CircularPool: allocated={} available={}'.format(ap_cpool.get_allocated(), ap_cpool.get_available()))
 
 
         # Synchronize connection with SYNPROXY module
@@ -1189,48 +1502,8 @@ class PolicyBasedResourceAllocation(container3.Container):
         """ Returns a list of IPv4 address that can be overloaded """
         port, protocol = service_data['port'], service_data['protocol']
         self._logger.debug('Attempt to overload connection for {}:{}'.format(port, protocol))
-
-        # Create lists of addresses for comparison
-        available = []
-        unavailable = []
-
-        if not self.connectiontable.has(connection.KEY_RGW):
-            return available
-
-        # Iterate all RealmGateway connections and try to reuse existing allocated IP addresses
-        rgw_conns = self.connectiontable.get(connection.KEY_RGW)
-        self._logger.debug('>> Existing connections \n{}'.format(utils3.repr_iterable_index(rgw_conns)))
-        for conn in rgw_conns:
-            ipaddr = conn.outbound_ip
-            c_port, c_proto = conn.outbound_port, conn.protocol
-            s_port, s_proto = port, protocol
-
-            # Do not iterate already unavailable addresses
-            if ipaddr in unavailable:
-                continue
-
-            self._logger.debug('Comparing {} vs {} @{}'.format((c_port, c_proto),(s_port, s_proto), ipaddr))
-            # The following statements match when IP overloading cannot be performed
-            if (c_port, c_proto) == (0, 0) or (s_port, s_proto) == (0, 0) or (c_port, c_proto) == (s_port, s_proto):
-                self._logger.debug('0. Port & Protocol blocked')
-                unavailable.append(ipaddr)
-                continue
-            elif (c_port == s_port) and (c_proto == s_proto or c_proto == 0 or s_proto == 0):
-                self._logger.debug('1. Port blocked')
-                unavailable.append(ipaddr)
-                continue
-            elif (c_proto == s_proto) and (c_port == 0 or s_port == 0):
-                self._logger.debug('2. Port blocked')
-                unavailable.append(ipaddr)
-                continue
-
-            # The IP address could be used / Add only once
-            if ipaddr not in available:
-                self._logger.debug('Adding {} to overloading pool {}'.format(ipaddr, available))
-                available.append(ipaddr)
-
-        # Return available IP addresses that are not in the unavailable list
-        return [x for x in available if x not in unavailable]
+        # Resolve via the per-address port occupancy index of the connection table
+        return self.connectiontable.get_overloadable(port, protocol)
 
     def _register_host_alias(self, host_obj, service_data, original_fqdn, alias_fqdn):
         # Add alias as SFQDN host service
@@ -1285,32 +1558,26 @@ class PolicyBasedResourceAllocation(container3.Container):
 
 
     def pbra_data_preaccept_circularpool(self, data, packet_fields):
-        # Check if the endpoints are known
-        key = (KEY_DATA_PACKET, (packet_fields['src'], packet_fields['dst']))
-        if not self.has(key):
+        # Check if the packet has been seen before
+        record = self.packet_history.get(_packet_key(packet_fields))
+        if record is None:
             # We have not seent this packet before
             return True
 
-        node = self.get(key)
-        if not node.has_record(**packet_fields):
-            # We have not seent this packet before
-            return True
-
-        record = node.get_record(**packet_fields)
-        self._logger.debug('Found prior state: {} / {}'.format(packet_fields, record))
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('Found prior state: {} / {}'.format(packet_fields, record))
         return False
 
     def pbra_data_track_circularpool(self, data, packet_fields):
         # Create a record for a seen packet
-        key = (KEY_DATA_PACKET, (packet_fields['src'], packet_fields['dst']))
-        if not self.has(key):
-            node = uStateDataPacket(packet_fields['src'], packet_fields['dst'])
-            self.add(node)
-        else:
-            node = self.get(key)
+        self.packet_history.add(_packet_key(packet_fields))
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('Tracking packet: {}'.format(packet_fields))
 
-        node.add_record(**packet_fields)
-        self._logger.debug('Tracking packet: {}'.format(packet_fields))
+    def stats_packet_history(self):
+        """ Remove expired heavy hitters and return the metrics of the packet history """
+        self.packet_history.expire()
+        return self.packet_history.stats()
 
 
 def _do_ok(obj, n):
@@ -1328,7 +1595,24 @@ def _do_neutral(obj, n):
         obj.event_neutral()
         print(obj.reputation)
 
+def _benchmark_coalesce(events, periods):
+    # Merge two DNS groups with the given number of events and missed periods
+    group1 = uStateDNSGroup(nodes=['192.0.2.1'])
+    group2 = uStateDNSGroup(nodes=['192.0.2.2'])
+    for view in (group2.reputation_previous, group2.reputation_current):
+        view._store.add(view._period, uReputationStore.OK, view._row, events)
+        view._store.add(view._period, uReputationStore.TOTAL, view._row, events)
+    group2.transition_period(periods)
+    t0 = time.time()
+    group1.merge(group2)
+    return time.time() - t0
+
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    for events, periods in ((10, 1), (10**3, 10), (10**6, 10**3), (10**9, 10**6)):
+        delta = _benchmark_coalesce(events, periods)
+        print('Coalesced DNS groups with {} events and {} missed periods in {:.3f} msec'.format(events, periods, delta * 1000))
+
     obj1 = uReputation()
     #_do_neutral(obj1, 5)
     _do_ok(obj1, 100)
@@ -32,9 +32,14 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 #TODO: Optimize memory by having the pool and then a bytearray per host (1/0)
 
+import asyncio
+import heapq
 import ipaddress
+import itertools
 import logging
 import random
+import socket
+import struct
 
 from helpers_n_wrappers import container3
 
@@ -52,6 +57,24 @@ def _calculate_address_pool(addrmask, ipv6=False):
 
     return [format(addr) for addr in netobj]
 
+def _calculate_address_range(addrmask):
+    """
+    Return the range of integer IPv4 addresses contained in the network.
+
+    @param addrmask: Network in IP/mask format.
+    @return: A range of integers
+    """
+    netobj = ipaddress.IPv4Network(addrmask, strict=False)
+    return range(int(netobj.network_address), int(netobj.broadcast_address) + 1)
+
+def _ipv4_to_int(addr):
+    """ Return the integer representation of an IPv4 address """
+    return struct.unpack('!I', socket.inet_aton(addr))[0]
+
+def _int_to_ipv4(n):
+    """ Return the IPv4 address of an integer representation """
+    return socket.inet_ntoa(struct.pack('!I', n))
+
 class PoolContainer(container3.Container):
     def __init__(self, name='PoolContainer'):
         """ Initialize as a Container """
@@ -88,6 +111,9 @@ class AddressPoolShared(container3.ContainerNode):
         super().__init__(name)
         self._key = key
         self._pool = _AddressPoolUnit('{}{}'.format(name,'Unit'))
+        # Coroutines waiting for a released address as [-priority, seq, future]
+        self._release_waiters = []
+        self._release_seq = itertools.count()
         if addrmask:
             self.add_to_pool(addrmask)
 
@@ -126,7 +152,33 @@ class AddressPoolShared(container3.ContainerNode):
         return self._pool.allocate_random()
 
     def release(self, addr):
-        return self._pool.release(addr)
+        ret = self._pool.release(addr)
+        self._notify_release()
+        return ret
+
+    def _notify_release(self):
+        # Wake up the highest priority waiter that is still pending
+        while self._release_waiters:
+            _, _, fut = heapq.heappop(self._release_waiters)
+            if not fut.done():
+                fut.set_result(True)
+                return
+
+    @asyncio.coroutine
+    def wait_release(self, priority=0, timeout=None):
+        """
+        Wait until an address is released to the pool.
+
+        @param priority: Waiters with higher priority are woken up first.
+        @param timeout: Maximum waiting time (sec).
+        @return: True if an address was released, False if the timeout expired.
+        """
+        fut = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._release_waiters, [-priority, next(self._release_seq), fut])
+        try:
+            return (yield from asyncio.wait_for(fut, timeout))
+        except asyncio.TimeoutError:
+            return False
 
     def __repr__(self):
         return self._name
@@ -192,7 +244,7 @@ class AddressPoolUser(container3.ContainerNode):
     def allocate(self, userid):
         return self._pool[userid].allocate()
 
-    def allocate_random(self):
+    def allocate_random(self, userid):
         return self._pool[userid].allocate_random()
 
     def release(self, userid, addr):
@@ -331,6 +383,101 @@ class _AddressPoolUnit_list(object):
            self._available.sort()
         return addr
 
+class _AddressPoolUnit_int(object):
+    """
+    Address pool unit indexed by the integer representation of IPv4 addresses.
+
+    Available addresses are kept in a min-heap for lowest-address-first allocation,
+    and in an array with a position index for O(1) membership and random allocation.
+    Heap entries of randomly allocated addresses are discarded lazily.
+    """
+    def __init__(self, name='_AddressPoolUnit'):
+        """ Initialize the _AddressPoolUnit """
+        self._logger = logging.getLogger(name)
+        self._pool = set()
+        self._allocated = set()
+        self._available = []        # Array of available addresses
+        self._available_pos = {}    # Indexes available addresses to array position
+        self._available_heap = []   # Min-heap of available addresses, may contain stale entries
+
+    def _to_int(self, addr):
+        try:
+            return _ipv4_to_int(addr)
+        except (OSError, TypeError):
+            return None
+
+    def _push_available(self, n):
+        self._available_pos[n] = len(self._available)
+        self._available.append(n)
+        heapq.heappush(self._available_heap, n)
+
+    def _pop_available(self, n):
+        # Swap with the last element to remove from the array in O(1)
+        pos = self._available_pos.pop(n)
+        last = self._available.pop()
+        if last != n:
+            self._available[pos] = last
+            self._available_pos[last] = pos
+        self._allocated.add(n)
+        # Compact heap if stale entries take over
+        if len(self._available_heap) > 2 * len(self._available) + 64:
+            self._available_heap = list(self._available)
+            heapq.heapify(self._available_heap)
+        return _int_to_ipv4(n)
+
+    def add_to_pool(self, addrmask):
+        self._logger.debug('Add network {} to pool'.format(addrmask))
+        for n in _calculate_address_range(addrmask):
+            if n in self._pool:
+                continue
+            self._pool.add(n)
+            self._push_available(n)
+
+    def get_pool(self):
+        return [_int_to_ipv4(n) for n in sorted(self._pool)]
+
+    def get_allocated(self):
+        return [_int_to_ipv4(n) for n in sorted(self._allocated)]
+
+    def get_available(self):
+        return [_int_to_ipv4(n) for n in sorted(self._available)]
+
+    def get_stats(self):
+        """ Return a tuple of (Total/Allocated/Available) """
+        return (len(self._pool), len(self._allocated), len(self._available))
+
+    def in_pool(self, addr):
+        return (self._to_int(addr) in self._pool)
+
+    def in_allocated(self, addr):
+        return (self._to_int(addr) in self._allocated)
+
+    def in_available(self, addr):
+        return (self._to_int(addr) in self._available_pos)
+
+    def allocate(self):
+        heap = self._available_heap
+        while heap:
+            n = heapq.heappop(heap)
+            if n in self._available_pos:
+                return self._pop_available(n)
+        return None
+
+    def allocate_random(self):
+        if not self._available:
+            return None
+        n = self._available[random.randrange(len(self._available))]
+        return self._pop_available(n)
+
+    def release(self, addr):
+        n = self._to_int(addr)
+        if n not in self._allocated:
+            raise ValueError('Address not allocated: {}'.format(addr))
+        self._allocated.remove(n)
+        self._push_available(n)
+        return addr
+
 # Define AddressPoolUnit in use
-_AddressPoolUnit = _AddressPoolUnit_list #Extracts a controlled element
+_AddressPoolUnit = _AddressPoolUnit_int #Extracts the lowest element in O(log n)
+#_AddressPoolUnit = _AddressPoolUnit_list #Extracts a controlled element
 #_AddressPoolUnit = _AddressPoolUnit_set #Extracts a random element
@@ -0,0 +1,184 @@
+"""
+BSD 3-Clause License
+
+Copyright (c) 2018, Jesus Llorente Santos, Aalto University, Finland
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import socket
+import struct
+
+_EMPTY = object()
+
+
+def parse_prefix(ipaddr, prefixlen = None):
+    """
+    Return a tuple of (family, network, prefixlen) with the network address as integer.
+
+    @param ipaddr: IPv4 or IPv6 address string, host bits are cleared.
+    @param prefixlen: Prefix length, defaults to the full address length.
+    @raise ValueError: If the address or the prefix length are not valid.
+    """
+    try:
+        packed = socket.inet_pton(socket.AF_INET, ipaddr)
+        family, bits = socket.AF_INET, 32
+        value = struct.unpack('!I', packed)[0]
+    except OSError:
+        try:
+            packed = socket.inet_pton(socket.AF_INET6, ipaddr)
+        except OSError:
+            raise ValueError('Invalid IP address {}'.format(ipaddr))
+        family, bits = socket.AF_INET6, 128
+        hi, lo = struct.unpack('!QQ', packed)
+        value = (hi << 64) | lo
+    if prefixlen is None:
+        prefixlen = bits
+    if not 0 <= prefixlen <= bits:
+        raise ValueError('Invalid prefix length {} for {}'.format(prefixlen, ipaddr))
+    return (family, value & ~((1 << (bits - prefixlen)) - 1), prefixlen)
+
+
+def format_prefix(family, network):
+    """ Return the address string of an integer network address """
+    if family == socket.AF_INET:
+        return socket.inet_ntop(family, struct.pack('!I', network))
+    return socket.inet_ntop(family, struct.pack('!QQ', network >> 64, network & 0xFFFFFFFFFFFFFFFF))
+
+
+class PrefixTree(object):
+    """
+    Binary radix tree of integer prefixes with longest-prefix match.
+
+    Each node is a list of [child0, child1, value], lookups walk at most `bits` levels
+    from the most significant bit without building address objects.
+    """
+    def __init__(self, bits = 32):
+        self.bits = bits
+        self._root = [None, None, _EMPTY]
+        self._len = 0
+
+    def _walk(self, network, prefixlen, create = False):
+        node = self._root
+        shift = self.bits - 1
+        for _ in range(prefixlen):
+            bit = (network >> shift) & 1
+            child = node[bit]
+            if child is None:
+                if not create:
+                    return None
+                child = node[bit] = [None, None, _EMPTY]
+            node = child
+            shift -= 1
+        return node
+
+    def insert(self, network, prefixlen, value):
+        """ Add or replace the value of a prefix """
+        node = self._walk(network, prefixlen, create=True)
+        if node[2] is _EMPTY:
+            self._len += 1
+        node[2] = value
+
+    def get(self, network, prefixlen, default = None):
+        """ Return the value of the exact prefix """
+        node = self._walk(network, prefixlen)
+        if node is None or node[2] is _EMPTY:
+            return default
+        return node[2]
+
+    def remove(self, network, prefixlen):
+        """ Remove a prefix and prune the empty branches, raise KeyError if not found """
+        path = []
+        node = self._root
+        shift = self.bits - 1
+        for _ in range(prefixlen):
+            bit = (network >> shift) & 1
+            path.append((node, bit))
+            node = node[bit]
+            if node is None:
+                raise KeyError((network, prefixlen))
+            shift -= 1
+        if node[2] is _EMPTY:
+            raise KeyError((network, prefixlen))
+        node[2] = _EMPTY
+        self._len -= 1
+        # Prune nodes without value nor children
+        while path and node[0] is None and node[1] is None and node[2] is _EMPTY:
+            parent, bit = path.pop()
+            parent[bit] = None
+            node = parent
+
+    def longest_match(self, address, maxlen = None):
+        """
+        Return a tuple of (prefixlen, value) of the longest prefix containing the address or None.
+
+        @param address: Integer address.
+        @param maxlen: Only consider prefixes up to this length, i.e. prefixes covering address/maxlen.
+        """
+        if maxlen is None:
+            maxlen = self.bits
+        node = self._root
+        match = None if node[2] is _EMPTY else (0, node[2])
+        shift = self.bits - 1
+        for depth in range(1, maxlen + 1):
+            node = node[(address >> shift) & 1]
+            if node is None:
+                break
+            if node[2] is not _EMPTY:
+                match = (depth, node[2])
+            shift -= 1
+        return match
+
+    def clear(self):
+        self._root = [None, None, _EMPTY]
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+
+if __name__ == "__main__":
+    import ipaddress
+    import timeit
+    tree = PrefixTree()
+    for prefix in ('10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '192.0.2.128/25'):
+        ipaddr, prefixlen = prefix.split('/')
+        family, network, prefixlen = parse_prefix(ipaddr, int(prefixlen))
+        tree.insert(network, prefixlen, prefix)
+    for address in ('10.1.2.3', '10.1.3.3', '10.2.0.1', '192.0.2.200', '192.0.2.1'):
+        print(address, tree.longest_match(parse_prefix(address)[1]))
+    print('10.1.2.0/24 covered by', tree.longest_match(parse_prefix('10.1.2.0', 24)[1], 16))
+    tree.remove(parse_prefix('10.1.0.0')[1], 16)
+    print(len(tree), tree.longest_match(parse_prefix('10.1.3.3')[1]))
+
+    # Compare with ipaddress objects, ECS lookup key and containment check
+    net = ipaddress.ip_network('10.1.2.0/24')
+    n = 100000
+    t_old = timeit.timeit(lambda: (format(ipaddress.ip_network('10.1.2.77/24', strict=False).network_address),
+                                   ipaddress.ip_address('10.1.2.77') in net), number=n)
+    t_new = timeit.timeit(lambda: tree.longest_match(parse_prefix('10.1.2.77', 24)[1], 24), number=n)
+    print('ipaddress {:.2f} usec / radix {:.2f} usec'.format(t_old / n * 1e6, t_new / n * 1e6))
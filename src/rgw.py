@@ -145,6 +145,12 @@ def parse_arguments():
                         help='Default timeouts for DNS SRV resolution (sec)')
     parser.add_argument('--dns-timeout-naptr', nargs='+', type=float, #default=[0.010, 0.200, 0.200],
                         help='Default timeouts for DNS NAPTR resolution (sec)')
+    parser.add_argument('--dns-tcp-wait', type=float, default=0.50,
+                        help='Maximum hold time of TCP queries waiting for a Circular Pool address (sec)')
+    parser.add_argument('--dns-cache-memory', type=int, default=8*1024*1024,
+                        help='Memory budget of the LAN DNS response cache (bytes)')
+    parser.add_argument('--dns-no-hedging', dest='dns_hedging', action='store_false',
+                        help='Do not duplicate slow LAN resolutions to a second DNS resolver')
 
     # Address pool parameters
     parser.add_argument('--pool-serviceip', nargs='*',
@@ -158,6 +164,16 @@ def parse_arguments():
     parser.add_argument('--ipt-cpool-queue', nargs='*', type=int,
                         metavar=('QUEUENUM'),
                         help='NFQUEUE number')
+    parser.add_argument('--ipt-cpool-workers', dest='ipt_cpool_workers', action='store_true',
+                        help='Serve each NFQUEUE in a worker thread with batched verdicts')
+    parser.add_argument('--ipt-cpool-fail-open', dest='ipt_cpool_fail_open', action='store_true',
+                        help='Accept packets when the NFQUEUE is full (requires --ipt-cpool-workers)')
+    parser.add_argument('--ipt-cpool-maxlen', type=int, default=4096,
+                        metavar=('MAXLEN'),
+                        help='Maximum length of the NFQUEUE (requires --ipt-cpool-workers)')
+    parser.add_argument('--pbra-packet-memory', type=int, default=4*1024*1024,
+                        metavar=('BYTES'),
+                        help='Memory budget for tracking the packets rejected by the Circular Pool')
     parser.add_argument('--ipt-cpool-chain', type=str,
                         metavar=('IPT_CPOOL_CHAIN'),
                         help='Iptables CircularPool nat chain')
@@ -334,7 +350,8 @@ class RealmGateway(object):
                                                    connectiontable = self._connectiontable,
                                                    datarepository  = self._datarepository,
                                                    network         = self._network,
-                                                   cname_soa       = self._config.dns_cname_soa)
+                                                   cname_soa       = self._config.dns_cname_soa,
+                                                   packet_memory   = self._config.pbra_packet_memory)
 
     @asyncio.coroutine
     def _init_packet_callbacks(self):
@@ -343,7 +360,13 @@ class RealmGateway(object):
                                         connectiontable = self._connectiontable,
                                         pbra            = self._pbra)
         # Register NFQUEUE(s) callback
-        self._network.ipt_register_nfqueues(self.packetcb.packet_in_circularpool)
+        if self._config.ipt_cpool_workers:
+            self._network.ipt_register_nfqueue_workers(self.packetcb.packet_in_circularpool,
+                                                       self.packetcb.packet_in_circularpool_fastpath,
+                                                       fail_open = self._config.ipt_cpool_fail_open,
+                                                       maxlen    = self._config.ipt_cpool_maxlen)
+        else:
+            self._network.ipt_register_nfqueues(self.packetcb.packet_in_circularpool)
 
     @asyncio.coroutine
     def _init_dns(self):
@@ -354,7 +377,10 @@ class RealmGateway(object):
                                   hosttable       = self._hosttable,
                                   pooltable       = self._pooltable,
                                   connectiontable = self._connectiontable,
-                                  pbra            = self._pbra)
+                                  pbra            = self._pbra,
+                                  dns_tcp_wait    = self._config.dns_tcp_wait,
+                                  dns_cache_memory = self._config.dns_cache_memory,
+                                  dns_hedging     = self._config.dns_hedging)
 
         # Register defined DNS timeouts
         self._dnscb.dns_register_timeout(self._config.dns_timeout, None)
@@ -420,20 +446,29 @@ class RealmGateway(object):
     def _init_subscriberdata(self):
         self._logger.warning('Initializing subscriber data')
         tzero = self._loop.time()
+        subscribers = []
         for subs_id, subs_data in self._datarepository.get_policy_host_all({}).items():
             ipaddr = subs_data['ID']['ipv4'][0]
             fqdn = subs_data['ID']['fqdn'][0]
             self._logger.debug('Registering subscriber {} / {}@{}'.format(subs_id, fqdn, ipaddr))
-            yield from self._dnscb.ddns_register_user(fqdn, 1, ipaddr)
-        self._logger.info('Completed initializacion of subscriber data in {:.3f} sec'.format(self._loop.time()-tzero))
+            subscribers.append((fqdn, ipaddr))
+        # Provision all subscribers in bulk, previous user data was removed if the tables were flushed
+        timings = yield from self._dnscb.ddns_register_users_bulk(subscribers, flushed = self._config.ipt_flush)
+        self._logger.info('Completed initializacion of {} subscribers in {:.3f} sec / {}'.format(len(subscribers), self._loop.time()-tzero,
+                          ' '.join('{}={:.3f}'.format(k, v) for k, v in timings.items())))
 
     @asyncio.coroutine
     def _init_cleanup_cpool(self, delay):
         self._logger.warning('Initiating cleanup of the Circular Pool every {} seconds'.format(delay))
+        _tstats = self._loop.time()
         while True:
             yield from asyncio.sleep(delay)
             # Update table and remove expired elements
             self._connectiontable.update_all_rgw()
+            # Show the depth and lag of the SYNPROXY write-behind queue every 10 seconds
+            if self._network.synproxy is not None and self._loop.time() - _tstats >= 10.0:
+                _tstats = self._loop.time()
+                self._logger.info('SYNPROXY queue: {}'.format(self._network.synproxy_stats()))
 
     @asyncio.coroutine
     def _init_cleanup_pbra_timers(self, delay):
@@ -442,6 +477,13 @@ class RealmGateway(object):
             yield from asyncio.sleep(delay)
             # Update table and remove expired elements
             self._pbra.cleanup_timers()
+            # Show the metrics of the Circular Pool packet history
+            self._logger.info('Packet history: {}'.format(self._pbra.stats_packet_history()))
+            self._logger.info('Allocation cache: {}'.format(self._pbra.allocation_cache.stats()))
+            self._logger.info('LAN DNS cache: {}'.format(self._dnscb.lan_cache.stats()))
+            self._logger.info('LAN DNS coalescing: {}'.format(self._dnscb.stats_coalescing()))
+            self._logger.info('DNS resolvers: {}'.format(self._dnscb.upstreams.stats()))
+            self._logger.info('DNS wire templates: {}'.format(self._dnscb.wire_builder.stats()))
 
     @asyncio.coroutine
     def _init_show_dnsgroups(self, delay):
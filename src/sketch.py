@@ -0,0 +1,248 @@
+"""
+BSD 3-Clause License
+
+Copyright (c) 2018, Jesus Llorente Santos, Aalto University, Finland
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import collections
+import logging
+import time
+
+# Number of bits set of each byte value
+_POPCOUNT = bytes(bin(i).count('1') for i in range(256))
+
+
+class TimeBucketedBloomFilter(object):
+    """
+    Bloom filter answering "seen in the last ttl seconds" within a fixed memory budget.
+
+    The bit array is split in nbuckets generations of ttl/(nbuckets-1) seconds each.
+    Keys are inserted in the current generation and looked up in all the live ones,
+    so a key is remembered for at least ttl seconds after its last insertion.
+    The oldest generation is cleared on rotation instead of expiring keys one by one.
+    Lookups do not modify the filter and can run in other threads than insertions.
+    """
+    def __init__(self, memory, ttl, nbuckets = 4, nhashes = 4):
+        """
+        @param memory: Memory budget of the bit arrays in bytes.
+        @param ttl: Minimum time a key is remembered in seconds.
+        @param nbuckets: Number of generations.
+        @param nhashes: Number of bit positions per key.
+        """
+        assert(nbuckets > 1 and nhashes > 0)
+        self.ttl = ttl
+        self.nbuckets = nbuckets
+        self.nhashes = nhashes
+        self.width = ttl / (nbuckets - 1)
+        self.nbytes = max(1, memory // nbuckets)
+        self.nbits = self.nbytes * 8
+        self._bits = [bytearray(self.nbytes) for _ in range(nbuckets)]
+        self._epoch = [None] * nbuckets   # Time slot of each generation
+        self.nofrotations = 0
+
+    def add(self, h, now = None):
+        """ Insert the hash value of a key """
+        slot = int((time.time() if now is None else now) // self.width)
+        idx = slot % self.nbuckets
+        if self._epoch[idx] != slot:
+            # Rotate, the generation held keys of an expired time slot
+            self._bits[idx] = bytearray(self.nbytes)
+            self._epoch[idx] = slot
+            self.nofrotations += 1
+        bits, nbits = self._bits[idx], self.nbits
+        # Double hashing of the upper and lower halves of the hash value
+        h1, h2 = h & 0xFFFFFFFF, ((h >> 32) & 0xFFFFFFFF) | 1
+        for i in range(self.nhashes):
+            pos = (h1 + i * h2) % nbits
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def contains(self, h, now = None):
+        """ Return True if the hash value of a key was probably inserted in the last ttl seconds """
+        oldest = int((time.time() if now is None else now) // self.width) - self.nbuckets + 1
+        nbits, nhashes = self.nbits, self.nhashes
+        h1, h2 = h & 0xFFFFFFFF, ((h >> 32) & 0xFFFFFFFF) | 1
+        for idx, epoch in enumerate(self._epoch):
+            if epoch is None or epoch < oldest:
+                continue
+            bits = self._bits[idx]
+            for i in range(nhashes):
+                pos = (h1 + i * h2) % nbits
+                if not bits[pos >> 3] & (1 << (pos & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    def _live(self, now):
+        oldest = int((time.time() if now is None else now) // self.width) - self.nbuckets + 1
+        return [bits for bits, epoch in zip(self._bits, self._epoch) if epoch is not None and epoch >= oldest]
+
+    def fill_ratio(self, now = None):
+        """ Return the ratio of bits set of each live generation """
+        return [sum(bits.translate(_POPCOUNT)) / self.nbits for bits in self._live(now)]
+
+    def fp_rate(self, now = None):
+        """ Return the estimated false positive rate from the fill ratio of the live generations """
+        p_negative = 1.0
+        for ratio in self.fill_ratio(now):
+            p_negative *= 1.0 - ratio ** self.nhashes
+        return 1.0 - p_negative
+
+
+class PacketHistory(object):
+    """
+    Memory bounded record of the packets seen in the last ttl seconds.
+
+    Lookups answer from an LRU-capped exact table of the repeated keys (heavy hitters)
+    and fall back to a TimeBucketedBloomFilter for the rest, so spoofed floods cannot
+    grow the state beyond the memory budget. A key seen again while in the filter is
+    promoted to the exact table, which keeps its counter and end of life.
+
+    A deterministic 1/SAMPLE_RATE of the keys is also stored exactly in a bounded sample
+    to measure the false positive rate of the filter. Counters updated from lookups in
+    other threads are best effort.
+    """
+    SAMPLE_RATE = 64
+    SAMPLE_MAXLEN = 4096
+    # Estimated memory per heavy hitter entry (key tuple, list and OrderedDict link)
+    ENTRY_SIZE = 256
+
+    def __init__(self, memory = 4 * 1024 * 1024, ttl = 20, nbuckets = 4, nhashes = 4, name = 'PacketHistory'):
+        """
+        @param memory: Memory budget in bytes, 7/8 for the filter and 1/8 for the exact table.
+        @param ttl: Minimum time a packet is remembered in seconds.
+        """
+        self._logger = logging.getLogger(name)
+        self.memory = memory
+        self.ttl = ttl
+        self.bloom = TimeBucketedBloomFilter(memory - memory // 8, ttl, nbuckets, nhashes)
+        self.maxentries = max(1, memory // 8 // PacketHistory.ENTRY_SIZE)
+        self._exact = collections.OrderedDict()  # Stores key -> [count, timestamp_eol]
+        self._sample = {}                        # Stores sampled key -> timestamp_eol
+        self.nofqueries = 0
+        self.nofhits_exact = 0
+        self.nofhits_bloom = 0
+        self.nofevictions = 0
+        self.nofsampled = 0
+        self.noffalsepositives = 0
+
+    def _sampled(self, h):
+        return (h >> 8) % PacketHistory.SAMPLE_RATE == 0
+
+    def get(self, key, now = None):
+        """ Return the [count, timestamp_eol] of a heavy hitter, (1, None) if only in the filter or None if not seen """
+        now = time.time() if now is None else now
+        self.nofqueries += 1
+        record = self._exact.get(key)
+        if record is not None and now < record[1]:
+            self.nofhits_exact += 1
+            return record
+        h = hash(key)
+        found = self.bloom.contains(h, now)
+        if self._sampled(h):
+            timestamp_eol = self._sample.get(key)
+            if timestamp_eol is None or now >= timestamp_eol:
+                # Ground truth is not seen, a positive answer is a false positive
+                self.nofsampled += 1
+                if found:
+                    self.noffalsepositives += 1
+        if not found:
+            return None
+        self.nofhits_bloom += 1
+        return (1, None)
+
+    def add(self, key, now = None):
+        """ Record a packet key """
+        now = time.time() if now is None else now
+        timestamp_eol = now + self.ttl
+        record = self._exact.get(key)
+        h = hash(key)
+        if record is not None:
+            record[0] += 1
+            record[1] = timestamp_eol
+            self._exact.move_to_end(key)
+        elif self.bloom.contains(h, now):
+            # Promote repeated key to the exact table
+            self._exact[key] = [2, timestamp_eol]
+            if len(self._exact) > self.maxentries:
+                self._exact.popitem(last=False)
+                self.nofevictions += 1
+        self.bloom.add(h, now)
+        if self._sampled(h):
+            if key not in self._sample and len(self._sample) >= PacketHistory.SAMPLE_MAXLEN:
+                self._expire_sample(now)
+            if key in self._sample or len(self._sample) < PacketHistory.SAMPLE_MAXLEN:
+                self._sample[key] = timestamp_eol
+
+    def _expire_sample(self, now):
+        for key in [k for k, t in self._sample.items() if t <= now]:
+            del self._sample[key]
+
+    def expire(self, now = None):
+        """ Remove expired heavy hitters and samples """
+        now = time.time() if now is None else now
+        exact = self._exact
+        # Entries are kept in order of last insertion, so expired ones are first
+        while exact:
+            key, record = next(iter(exact.items()))
+            if record[1] > now:
+                break
+            del exact[key]
+        self._expire_sample(now)
+
+    def stats(self, now = None):
+        """ Return a dictionary of metrics """
+        return {'memory': self.memory,
+                'queries': self.nofqueries,
+                'hits_exact': self.nofhits_exact,
+                'hits_bloom': self.nofhits_bloom,
+                'heavy_hitters': len(self._exact),
+                'evictions': self.nofevictions,
+                'rotations': self.bloom.nofrotations,
+                'fill_ratio': ['{:.3f}'.format(_) for _ in self.bloom.fill_ratio(now)],
+                'fp_rate_estimated': self.bloom.fp_rate(now),
+                'fp_rate_observed': self.noffalsepositives / self.nofsampled if self.nofsampled else 0.0,
+                'fp_sampled': self.nofsampled}
+
+
+if __name__ == "__main__":
+    # Spoofed SYN flood: every packet has a different source, then retransmissions of a few of them
+    import random
+    history = PacketHistory(memory = 256 * 1024, ttl = 20)
+    now = time.time()
+    keys = [(random.getrandbits(32), 0xC0000201, (random.getrandbits(16), 80, random.getrandbits(32), 0)) for _ in range(200000)]
+    t0 = time.time()
+    for i, key in enumerate(keys):
+        if history.get(key, now + i * 1e-4) is None:
+            history.add(key, now + i * 1e-4)
+    for key in keys[:1000]:
+        history.add(key, now + 20)
+    print('Processed {} packets in {:.3f} sec'.format(len(keys) + 1000, time.time() - t0))
+    print(history.stats(now + 20))
+    assert(all(history.get(key, now + 21) is not None for key in keys[:1000]))
@@ -33,13 +33,14 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import asyncio
 import logging
 import json
-import os
-import subprocess
+
+from conntrack import Conntrack
 
 
 class SuricataAlert(asyncio.DatagramProtocol):
     def __init__(self):
         self._logger = logging.getLogger('SuricataAlert')
+        self.conntrack = Conntrack()
 
     def connection_made(self, transport):
         self._transport = transport
@@ -80,32 +81,28 @@ class SuricataAlert(asyncio.DatagramProtocol):
             msg_d = json.loads(data.decode())
 
             # Incoming packet of a connection originated from WAN
-            wan_in  = 'conntrack -D conntrack --orig-src {}  --orig-dst {}   --proto {} --orig-port-src {}  --orig-port-dst {} '.format(msg_d['src_ip'], msg_d['dest_ip'], msg_d['proto'], msg_d['src_port'], msg_d['dest_port'])
+            wan_in  = ('orig',  msg_d['src_ip'],  msg_d['dest_ip'], msg_d['proto'], msg_d['src_port'],  msg_d['dest_port'])
             # Outgoing packet of a connection originated from WAN
-            wan_out = 'conntrack -D conntrack --orig-src {}  --orig-dst {}   --proto {} --orig-port-src {}  --orig-port-dst {} '.format(msg_d['dest_ip'], msg_d['src_ip'], msg_d['proto'], msg_d['dest_port'], msg_d['src_port'])
+            wan_out = ('orig',  msg_d['dest_ip'], msg_d['src_ip'],  msg_d['proto'], msg_d['dest_port'], msg_d['src_port'])
 
             # Incoming packet of a connection originated from LAN
-            lan_in  = 'conntrack -D conntrack --reply-src {} --reply-dst {}  --proto {} --reply-port-src {} --reply-port-dst {}'.format(msg_d['src_ip'], msg_d['dest_ip'], msg_d['proto'], msg_d['src_port'], msg_d['dest_port'])
+            lan_in  = ('reply', msg_d['src_ip'],  msg_d['dest_ip'], msg_d['proto'], msg_d['src_port'],  msg_d['dest_port'])
             # Outgoing packet of a connection originated from LAN
-            lan_out = 'conntrack -D conntrack --reply-src {} --reply-dst {}  --proto {} --reply-port-src {} --reply-port-dst {}'.format(msg_d['dest_ip'], msg_d['src_ip'], msg_d['proto'], msg_d['dest_port'], msg_d['src_port'])
+            lan_out = ('reply', msg_d['dest_ip'], msg_d['src_ip'],  msg_d['proto'], msg_d['dest_port'], msg_d['src_port'])
 
-            for msg in [wan_in, wan_out, lan_in, lan_out]:
-                if self._conntrack_delete(msg, silent = True):
-                    self._logger.warning('Removed hazardous flow! [{}] {}:{} > {}:{} // {} / {}'.format(msg_d['proto'], msg_d['src_ip'], msg_d['src_port'], msg_d['dest_ip'], msg_d['dest_port'], msg_d['alert']['category'], msg_d['alert']['signature']))
+            # Delete all candidate flows in a single netlink batch
+            if self._conntrack_delete([wan_in, wan_out, lan_in, lan_out]):
+                self._logger.warning('Removed hazardous flow! [{}] {}:{} > {}:{} // {} / {}'.format(msg_d['proto'], msg_d['src_ip'], msg_d['src_port'], msg_d['dest_ip'], msg_d['dest_port'], msg_d['alert']['category'], msg_d['alert']['signature']))
         except:
             self._logger.warning('Failed to process data {} {}'.format(data, addr))
 
 
-    def _conntrack_delete(self, command, silent = False):
+    def _conntrack_delete(self, tuples):
         """ Return True if a flow was removed """
         try:
-            if silent:
-                with open(os.devnull, 'w') as f:
-                    subprocess.check_call(command, shell=True, stdout=f, stderr=f)
-            else:
-                subprocess.check_call(command, shell=True)
-            return True
-        except:
+            return self.conntrack.delete_tuples(tuples) > 0
+        except Exception as e:
+            self._logger.debug('Failed to delete flows {} / {}'.format(tuples, e))
             return False
 
     def _send_msg(self, data_b, addr):